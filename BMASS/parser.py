@@ -1,28 +1,46 @@
 '''
 Parser for BMASS files
+
+Parsed analogies can be cached on disk in compiled form (see readArrays),
+as <analogy file>.<setting>.analogies.npz, so that repeated runs on the
+same file skip parsing.
 '''
 
+import os
 import codecs
+import zipfile
+import hashlib
+import numpy as np
 from . import settings
 
+CACHE_VERSION = 2
+
 def _readMultipleEntries(entry):
+    '''Splits a multi-valued field into entries at each comma outside of
+    quotes; empty entries are kept (and fail to parse as terms)
+    '''
     entries = []
-    cur_entry, in_string = [], False
-    for char in entry:
-        if char == ',' and not in_string:
-            entries.append(''.join(cur_entry))
-            cur_entry = []
+    for piece in entry.split(','):
+        # an odd number of quotes so far means the comma was quoted
+        if len(entries) > 0 and entries[-1].count('"') % 2 == 1:
+            entries[-1] = '%s,%s' % (entries[-1], piece)
         else:
-            cur_entry.append(char)
-            if char == '"': in_string = not in_string
-    entries.append(''.join(cur_entry))
+            entries.append(piece)
     return entries
-                
+
+def _cuiString(s):
+    '''Returns (CUI, string) from a CUI:"string" field
+    '''
+    chunks = s.split(':', 2)
+    if len(chunks) < 2:
+        raise ValueError('Malformed term "%s"' % s)
+    return (chunks[0], chunks[1].strip('"'))
+
 def _parseLine(line, multi_b, multi_d, strings_only):
     if strings_only:
-        cui_str = lambda s: s.split(':')[1].strip('"')
+        cui_str = lambda s: _cuiString(s)[1]
     else:
-        cui_str = lambda s: (s.split(':')[0], s.split(':')[1].strip('"'))
+        cui_str = _cuiString
 
     (a,b,c,d) = [s.strip() for s in line.split('\t')]
     a, c = cui_str(a), cui_str(c)
@@ -39,23 +57,187 @@ def _parseLine(line, multi_b, multi_d, strings_only):
 
     return (a,b,c,d)
 
-def read(analogy_file, setting, strings_only=False):
+def _readLines(analogy_file):
+    # decode the whole file and split it the same way as iterating over
+    # a codecs stream would
+    with open(analogy_file, 'rb') as stream:
+        return codecs.decode(stream.read(), 'utf-8').splitlines()
+
+def read(analogy_file, setting, strings_only=False, use_cache=False):
+    '''Returns { relation : [ (a, b, c, d) ] } for the analogies in
+    analogy_file, where each term is either a (CUI, string) pair or (if
+    strings_only) just the string; in multi-answer settings, d (and, for
+    All-Info, b) is a list of terms.
+
+    If use_cache is True, analogies are read from (or compiled to) the
+    on-disk cache for analogy_file and setting.
+
+    If analogy_file has no relation headers, its analogies are returned
+    under relation None.  Raises ValueError for a malformed analogy line.
+    '''
     multi_b = setting == settings.ALL_INFO
     multi_d = setting in [settings.ALL_INFO, settings.MULTI_ANSWER]
 
+    if use_cache:
+        return fromArrays(readArrays(analogy_file, setting), setting, strings_only=strings_only)
+
     analogies = {}
-    with codecs.open(analogy_file, 'r', 'utf-8') as stream:
-        cur_relation, cur_analogies = None, []
-        for line in stream:
-            # relation separators
-            if line[0] == '#':
-                if cur_relation:
-                    analogies[cur_relation] = cur_analogies
-                cur_relation = line[2:].strip()
-                cur_analogies = []
-            # everything else is an analogy
-            else:
+    cur_relation, cur_analogies = None, []
+    for (line_num, line) in enumerate(_readLines(analogy_file)):
+        if len(line) == 0:
+            continue
+        # relation separators
+        elif line[0] == '#':
+            if cur_relation:
+                analogies[cur_relation] = cur_analogies
+            cur_relation = line[2:].strip()
+            cur_analogies = []
+        # everything else is an analogy
+        else:
+            try:
                 analogy = _parseLine(line, multi_b, multi_d, strings_only)
-                cur_analogies.append(analogy)
-        analogies[cur_relation] = cur_analogies
+            except ValueError as e:
+                raise ValueError('%s, line %d: %s' % (analogy_file, line_num+1, e))
+            cur_analogies.append(analogy)
+    analogies[cur_relation] = cur_analogies
+    return analogies
+
+def readArrays(analogy_file, setting, use_cache=True):
+    '''Returns analogy_file parsed for setting in compiled form, a dict of
+        relations        :: relation names, in file order
+        relation_offsets :: (relations+1) array; the analogies of relation
+                            i are rows relation_offsets[i]:relation_offsets[i+1]
+        cuis, strings    :: CUI and string of each distinct term
+        a, c             :: (analogies) arrays of term indices
+        b, d             :: (analogies x max. entries) arrays of term
+                            indices, padded with -1
+
+    If use_cache is True, the compiled analogies are loaded from the
+    cache if it matches the current contents of analogy_file, and are
+    otherwise parsed and saved to it.
+    '''
+    cache_file = '%s.%d.analogies.npz' % (analogy_file, setting)
+    key = _cacheKey(analogy_file, setting)
+
+    arrays = _readCache(cache_file, key) if use_cache else None
+    if arrays is None:
+        arrays = _compile(analogy_file, setting)
+        if use_cache:
+            # caching is only an optimization; carry on if it can't be written
+            try: _writeCache(cache_file, key, arrays)
+            except OSError: pass
+    return arrays
+
+def fromArrays(arrays, setting, strings_only=False):
+    '''Converts compiled analogies (see readArrays) to the dictionary
+    returned by read
+    '''
+    multi_b = setting == settings.ALL_INFO
+    multi_d = setting in [settings.ALL_INFO, settings.MULTI_ANSWER]
+
+    if strings_only: terms = arrays['strings']
+    else: terms = list(zip(arrays['cuis'], arrays['strings']))
+
+    a, c = arrays['a'].tolist(), arrays['c'].tolist()
+    b, d = arrays['b'].tolist(), arrays['d'].tolist()
+    entries = lambda row: [terms[j] for j in row if j > -1]
+
+    analogies, offsets = {}, arrays['relation_offsets']
+    for i in range(len(arrays['relations'])):
+        analogies[arrays['relations'][i]] = [
+            (
+                terms[a[j]],
+                (entries(b[j]) if multi_b else terms[b[j][0]]),
+                terms[c[j]],
+                (entries(d[j]) if multi_d else terms[d[j][0]]),
+            )
+                for j in range(offsets[i], offsets[i+1])
+        ]
     return analogies
+
+def _compile(analogy_file, setting):
+    analogies = read(analogy_file, setting, strings_only=False)
+    multi_b = setting == settings.ALL_INFO
+    multi_d = setting in [settings.ALL_INFO, settings.MULTI_ANSWER]
+
+    term_ixes = {}
+    termIndex = lambda term: term_ixes.setdefault(term, len(term_ixes))
+    relations, offsets = [], [0]
+    a, b, c, d = [], [], [], []
+    for (relation, rel_analogies) in analogies.items():
+        relations.append(relation)
+        for (a_i, b_i, c_i, d_i) in rel_analogies:
+            a.append(termIndex(a_i))
+            b.append([termIndex(t) for t in (b_i if multi_b else [b_i])])
+            c.append(termIndex(c_i))
+            d.append([termIndex(t) for t in (d_i if multi_d else [d_i])])
+        offsets.append(len(a))
+
+    terms = list(term_ixes.keys())
+    return {
+        'relations': relations,
+        'relation_offsets': np.array(offsets, dtype=np.int64),
+        'cuis': [cui for (cui, _) in terms],
+        'strings': [string for (_, string) in terms],
+        'a': np.array(a, dtype=np.int32),
+        'b': _padded(b),
+        'c': np.array(c, dtype=np.int32),
+        'd': _padded(d),
+    }
+
+def _padded(rows):
+    width = max([len(row) for row in rows] + [1])
+    padded = np.full((len(rows), width), -1, dtype=np.int32)
+    for i in range(len(rows)):
+        padded[i, :len(rows[i])] = rows[i]
+    return padded
+
+def _cacheKey(analogy_file, setting):
+    h = hashlib.sha1()
+    with open(analogy_file, 'rb') as stream:
+        for block in iter(lambda: stream.read(1<<20), b''):
+            h.update(block)
+    h.update(('\0%d\0%d' % (setting, CACHE_VERSION)).encode('utf-8'))
+    return h.hexdigest()
+
+# lists of strings are stored as newline-separated UTF-8 bytes
+_string_lists = ['relations', 'cuis', 'strings']
+
+def _readCache(cache_file, key):
+    if not os.path.isfile(cache_file):
+        return None
+    try:
+        with np.load(cache_file) as cached:
+            if str(cached['key']) != key:
+                return None
+            arrays = {}
+            for name in cached.files:
+                if name == 'key': continue
+                elif name in _string_lists:
+                    arrays[name] = codecs.decode(cached[name].tobytes(), 'utf-8').split('\n')[:-1]
+                else:
+                    arrays[name] = cached[name]
+            unnamed = arrays.pop('unnamed_relations')
+            arrays['relations'] = [(None if unnamed[i] else arrays['relations'][i]) for i in range(len(unnamed))]
+            return arrays
+    except (OSError, ValueError, KeyError, EOFError, zipfile.BadZipFile):
+        # corrupt or truncated; rebuild it
+        return None
+
+def _writeCache(cache_file, key, arrays):
+    # relation None (a file with no headers) is stored as '', and marked
+    # as unnamed
+    stored = {
+        'key': np.array(key),
+        'unnamed_relations': np.array([relation is None for relation in arrays['relations']], dtype=bool),
+    }
+    arrays = dict(arrays, relations=[('' if relation is None else relation) for relation in arrays['relations']])
+    for (name, array) in arrays.items():
+        if name in _string_lists:
+            stored[name] = np.frombuffer(''.join(s + '\n' for s in array).encode('utf-8'), dtype=np.uint8)
+        else:
+            stored[name] = array
+    # np.savez adds the .npz extension to names without it
+    tmp_file = '%s.tmp.npz' % cache_file[:-len('.npz')]
+    np.savez(tmp_file, **stored)
+    os.replace(tmp_file, cache_file)
@@ -1,3 +1,6 @@
 ALL_INFO = 0
 MULTI_ANSWER = 1
 SINGLE_ANSWER = 2
+
+def name(setting):
+    return { ALL_INFO: 'All-Info', MULTI_ANSWER: 'Multi-Answer', SINGLE_ANSWER: 'Single-Answer' }[setting]
@@ -2,96 +2,230 @@
 Adapted from
 https://github.com/tensorflow/tensorflow/blob/r0.11/tensorflow/models/embedding/word2vec.py
 '''
+import time
+import contextlib
 import numpy as np
-import tensorflow as tf
-from lib.ir_metrics import AP_RR
+try:
+    import tensorflow as tf
+except ImportError:
+    tf = None
+from lib.ir_metrics import RankedAP_RR, BatchAccuracy, BatchMetrics
 
 class Mode:
     ThreeCosAdd = 0
     PairwiseDistance = 1
     ThreeCosMul = 2
 
+def modeName(mode):
+    return { Mode.ThreeCosAdd: '3CosAdd', Mode.PairwiseDistance: 'PairwiseDistance', Mode.ThreeCosMul: '3CosMul' }[mode]
+
+class Backend:
+    NumPy = 'numpy'
+    TensorFlow = 'tensorflow'
+    # approximate search over an IVF index, with NumPy
+    IVF = 'ivf'
+    # quantized candidate matrix with exact re-ranking, with NumPy
+    Quantized = 'quantized'
+
 class AnalogyModel:
     '''
     MAP/MRR not reported if not using multi_answer property
     '''
 
     def __init__(self, session, embed_array, mode=Mode.ThreeCosAdd):
+        if tf is None:
+            raise ImportError('TensorFlow is required for the %s backend' % Backend.TensorFlow)
         self._session = session
         self._mode = mode
         self._vocab_size = embed_array.shape[0]
         self._dim = embed_array.shape[1]
+        self._initBatching()
         self._build()
         self._session.run(self._embed_var.assign(self._embed_ph), feed_dict={self._embed_ph: embed_array})
 
-    def eval(self, analogies, analogy_embeds, batch_size=500, report_top_k=5, log=None):
+    def mode(self):
+        return self._mode
+
+    def dtype(self):
+        '''Returns the type that queries are scored in
+        '''
+        return np.dtype(np.float32)
+
+    def scoringStats(self):
+        '''Returns counters describing the scoring done so far (e.g.,
+        similarity rows calculated, queries scored and batches they were
+        scored in), as { name : count }
+        '''
+        return dict(self._batch_stats)
+
+    def batchSize(self, max_bytes):
+        '''Returns the number of queries to score at once within max_bytes
+        of scoring memory (see queryBytes), or fewer if a batch has
+        already run out of memory
+        '''
+        batch_size = max(1, int(max_bytes // self.queryBytes()))
+        if self._batch_limit is not None:
+            batch_size = min(batch_size, self._batch_limit)
+        return batch_size
+
+    def queryBytes(self):
+        '''Estimates the peak memory of scoring one query in a batch: its
+        a, b and c similarity rows, the scores of two methods at once, and
+        the sort keys, indices and answer masks of one, over as many
+        candidates as are scored at once (see _scoringWidth)
+        '''
+        return self._scoringWidth() * (6 * self._scoringItemSize() + 10)
+
+    def eval(self, analogies, analogy_embeds, **kwargs):
+        '''Evaluates one set of analogies with this model's own method,
+        where analogy i is answered by query i (see evalMethods, for the
+        options); returns (correct, MAP, MRR, total, skipped, predictions)
+        '''
         analogies = np.array(analogies, dtype=np.int32)
-        analogy_embeds = np.array(analogy_embeds, dtype=np.float32)
-        batch_start, total = 0, analogies.shape[0]
+        return self.evalMethods(analogy_embeds, [(analogies, np.arange(len(analogies)))], [self._mode], **kwargs)[self._mode][0]
+
+    def evalShared(self, query_embeds, analogy_sets, **kwargs):
+        '''Evaluates several sets of analogies that share queries with this
+        model's own method (see evalMethods); returns the results for each set
+        '''
+        return self.evalMethods(query_embeds, analogy_sets, [self._mode], **kwargs)[self._mode]
+
+    def evalMethods(self, query_embeds, analogy_sets, modes, batch_size=500, max_scoring_bytes=None, report_top_k=5, log=None):
+        '''Evaluates several sets of analogies that share queries, scoring
+        each distinct query once with each of several analogy methods (see
+        _rankModes) and applying each set's answers to the same rankings.
+
+        query_embeds is the (queries x 3 x dim) array of a,b,c embeddings,
+        and analogy_sets is a list of (analogies, query indices) pairs,
+        where each row of analogies holds the vocabulary indices of a,b,c
+        and the answer(s), and is answered by the given query.  Returns
+        { mode : [ (correct, MAP, MRR, total, skipped, predictions) for
+        each set ] }, where predictions is (correct, number of candidates,
+        top k indices, top k scores), with an array of each for the set's
+        analogies; skipped analogies have -1 candidates and indices, and
+        scores are NaN where the model doesn't return them.
+
+        Queries are scored batch_size at a time or, if max_scoring_bytes
+        is given, as many as fit in that much memory (see batchSize).  A
+        batch that runs out of memory is retried at half the size, as are
+        all later ones.
+        '''
+        query_embeds = np.asarray(query_embeds, dtype=self.dtype())
+        batch_start, num_queries = 0, query_embeds.shape[0]
+
+        # find the analogies answered by each batch of queries
+        sets = []
+        for (analogies, query_ixes) in analogy_sets:
+            analogies = np.array(analogies, dtype=np.int32)
+            if analogies.size == 0: analogies = analogies.reshape((0, 4))
+            query_ixes = np.asarray(query_ixes, dtype=np.int64)
+            order = np.argsort(query_ixes, kind='stable')
+            sets.append((analogies, query_ixes, order, query_ixes[order]))
+
+        # per-analogy results, filled in as their queries are scored
+        set_results = {
+            mode: [
+                (
+                    np.zeros(len(analogies), dtype=bool), np.zeros(len(analogies)), np.zeros(len(analogies)),
+                    np.full((len(analogies), report_top_k), -1, dtype=np.int64),
+                    np.full((len(analogies), report_top_k), np.nan, dtype=np.float32)
+                )
+                    for (analogies, _, _, _) in sets
+            ]
+                for mode in modes
+        }
+
+        if max_scoring_bytes is not None:
+            batch_size = self.batchSize(max_scoring_bytes)
+        elif self._batch_limit is not None:
+            batch_size = min(batch_size, self._batch_limit)
+        # batches scored in this call, for their rate (the size may back off)
+        batches_before = self._batch_stats['batches']
+        batch_rate = lambda tracker: ((self._batch_stats['batches'] - batches_before) / tracker.elapsed()) if tracker.elapsed() > 0 else 0.
+        if log: log.track(total=num_queries, message=lambda tracker, args: tracker.format(
+            '  >> Predictions: {current}/{total} ({rate:.0f} queries/s, {1:.1f} batches/s, ETA {eta})', batch_rate(tracker)))
+        span = log.span if log else contextlib.nullcontext
 
-        correct = 0  # accuracy evaluation
-        average_precision_sum, reciprocal_rank_sum = 0, 0  # MAP/MRR evaluation
-        skipped = 0
+        t_start = time.perf_counter()
+        while batch_start < num_queries:
+            limit = min(batch_start + batch_size, num_queries)
+            sub_embs = query_embeds[batch_start:limit, :, :]
+            try:
+                ranked = self._rankModes(sub_embs, max(report_top_k, 4), modes,
+                    answers=(self._batchAnswers(sets, batch_start, limit) if self._tracksAnswers() else None))
+                while True:
+                    with span('score'):
+                        ranking = next(ranked, None)
+                    if ranking is None: break
+                    (mode, ix, scores) = ranking
+                    with span('metrics'):
+                        for i in range(len(sets)):
+                            (analogies, query_ixes, order, sorted_query_ixes) = sets[i]
+                            (is_correct, ap, rr, top_k, top_scores) = set_results[mode][i]
+                            rows = order[np.searchsorted(sorted_query_ixes, batch_start):np.searchsorted(sorted_query_ixes, limit)]
+                            if len(rows) == 0: continue
+                            batch_rows = query_ixes[rows] - batch_start
+                            in_order = len(rows) == len(sub_embs) and (batch_rows == np.arange(len(rows))).all()
+                            sub_ixes = analogies[rows]
+                            answers = sub_ixes[:, 3:]
+                            sub_ix = ix if in_order else ix[batch_rows]
 
-        if log: log.track(message='  >> Predictions: {1}/%d' % total)
+                            # MAP/MRR evaluation (and accuracy, skipping over the other
+                            # terms in the analogy)
+                            if scores is None:
+                                (ap[rows], rr[rows], is_correct[rows]) = BatchMetrics(answers, sub_ix, exclude=sub_ixes[:, :3])
+                                # answers past the end of a partial ranking count as rank infinity
+                                rr[rows] = np.maximum(rr[rows], 0)
+                            else:
+                                sub_scores = scores if in_order else scores[batch_rows]
+                                (ap[rows], rr[rows]) = RankedAP_RR(self._answerRanks(sub_scores, answers))
+                                is_correct[rows] = BatchAccuracy(answers, sub_ix, exclude=sub_ixes[:, :3])
+                                top_scores[rows] = self._topScores(sub_scores, sub_ix[:, :report_top_k])
+                            top_k[rows] = sub_ix[:, :report_top_k]
+            except MemoryError:
+                # drop this batch's partial scores before retrying it smaller
+                ranked = ranking = ix = scores = sub_scores = None
+                if limit - batch_start == 1: raise
+                batch_size = self._batch_limit = (limit - batch_start) // 2
+                self._batch_stats['batch_backoffs'] += 1
+                if log: log.writeln('  [WARNING] Out of memory scoring %d queries at once; retrying in batches of %d' % (
+                    limit - batch_start, batch_size))
+                continue
 
-        predictions = []
-        while batch_start < total:
-            limit = batch_start + batch_size
-            sub_ixes = analogies[batch_start:limit, :]
-            sub_embs = analogy_embeds[batch_start:limit, :, :]
-            _, ix = self._predict(sub_embs)
+            self._batch_stats['batches'] += 1
+            if log: log.tick(by=limit - batch_start)
             batch_start = limit
 
-            for question in range(len(sub_ixes)):
-                
-                # get the set of correct answers
-                expected = set(sub_ixes[question, 3:])
-                expected.discard(-2)
-                expected.discard(-1)
-                if len(expected) == 0:
-                    skipped += 1
-                    predictions.append((False, -1, [-1]))
-                    continue
-                
-                # accuracy evaluation
-                is_correct = False
-                for j in range(4):
-                    # make sure that this isn't one of the other terms in the analogy
-                    # (if so, it doesn't count)
-                    if ix[question, j] in sub_ixes[question, :3]:
-                        continue
-                    # check if this is (one of) the right answer(s)
-                    elif ix[question, j] in expected:
-                        correct += 1
-                        is_correct = True
-                        break
-                    # otherwise, we got it wrong
-                    else:
-                        break
-
-                # MAP/MRR evaluation
-                #print('Question -- %d : %d :: %d : %s' % (sub_ixes[question,0], sub_ixes[question,1], sub_ixes[question,2], expected))
-                (ap, rr) = AP_RR(expected, ix[question])
-
-                # reduce to average precision
-                average_precision_sum += ap
-                # add rr to reciprocal rank summer
-                reciprocal_rank_sum += rr
-
-                predictions.append((is_correct, len(ix[question]), ix[question,:report_top_k]))
-
-            if log: log.tick(min(batch_start, total))
+        self._batch_stats['queries_scored'] += num_queries
+        self._batch_stats['scoring_seconds'] += time.perf_counter() - t_start
+        return { mode: [self._setResults(sets[i][0], set_results[mode][i]) for i in range(len(sets))] for mode in modes }
+
+    def _setResults(self, analogies, set_results):
+        '''Returns (correct, MAP, MRR, total, skipped, predictions) from the
+        per-analogy results of one set
+        '''
+        answers = analogies[:, 3:]
+        (is_correct, ap, rr, top_k, top_scores) = set_results
+        total = len(answers)
+
+        # skip any questions with no valid answers
+        answered = (answers >= 0).any(axis=1)
+        skipped = int(np.count_nonzero(~answered))
+        correct = int(np.count_nonzero(is_correct & answered))
 
         # calculate MAP and MRR
         if (total-skipped) > 0:
-            mean_average_precision = (average_precision_sum / (total-skipped))
-            mean_reciprocal_rank = (reciprocal_rank_sum / (total-skipped))
+            mean_average_precision = (ap[answered].sum() / (total-skipped))
+            mean_reciprocal_rank = (rr[answered].sum() / (total-skipped))
         else:
             mean_average_precision = 0
             mean_reciprocal_rank = 0
 
-        return correct, mean_average_precision, mean_reciprocal_rank, total, skipped, predictions
+        top_k[~answered] = -1
+        top_scores[~answered] = np.nan
+        predictions = (is_correct & answered, np.where(answered, self._vocab_size, -1), top_k, top_scores)
+
+        return (correct, mean_average_precision, mean_reciprocal_rank, total, skipped, predictions)
 
     def _build(self):
         self._embed_ph = tf.placeholder(tf.float32, [self._vocab_size, self._dim])
@@ -108,20 +242,32 @@ class AnalogyModel:
 
             dist = tf.matmul(target, nemb, transpose_b=True)
         elif self._mode == Mode.PairwiseDistance:
+            # cos(b-a, v-c), expanded into dot products so that the
+            # (vocab x dim) offsets v-c are never built for each query
             example_offset = analogy_b - analogy_a
-            query_offsets = embed_var - analogy_c
-
-            example_norm = tf.sqrt(tf.reduce_sum(example_offset**2))
-            query_norms = tf.sqrt(tf.reduce_sum(query_offsets**2, reduction_indices=[1]))
+            example_norms = tf.sqrt(tf.reduce_sum(example_offset**2, reduction_indices=[1], keep_dims=True))
 
-            dist = (
-                tf.matmul(example_offset, query_offsets, transpose_b=True) /
-                tf.transpose(example_norm * query_norms)
+            # (b-a).(v-c) = (b-a).v - (b-a).c
+            numerator = (
+                tf.matmul(example_offset, embed_var, transpose_b=True) -
+                tf.reduce_sum(example_offset * analogy_c, reduction_indices=[1], keep_dims=True)
             )
+            # |v-c|^2 = |v|^2 - 2(v.c) + |c|^2
+            query_norms = tf.sqrt(tf.maximum(
+                tf.reduce_sum(embed_var**2, reduction_indices=[1]) -
+                2 * tf.matmul(analogy_c, embed_var, transpose_b=True) +
+                tf.reduce_sum(analogy_c**2, reduction_indices=[1], keep_dims=True),
+                0.
+            ))
+
+            dist = numerator / (example_norms * query_norms)
         elif self._mode == Mode.ThreeCosMul:
-            numerator_left = tf.matmul(analogy_b, nemb, transpose_b=True) / tf.sqrt(tf.reduce_sum(analogy_b**2))
-            numerator_right = tf.matmul(analogy_c, nemb, transpose_b=True) / tf.sqrt(tf.reduce_sum(analogy_c**2))
-            denominator = tf.matmul(analogy_a, nemb, transpose_b=True) / tf.sqrt(tf.reduce_sum(analogy_a**2))
+            # cosines with each query's own a, b and c (normed per row, as
+            # in the NumPy model, not over the whole batch)
+            row_norms = lambda m: tf.sqrt(tf.reduce_sum(m**2, reduction_indices=[1], keep_dims=True))
+            numerator_left = tf.matmul(analogy_b, nemb, transpose_b=True) / row_norms(analogy_b)
+            numerator_right = tf.matmul(analogy_c, nemb, transpose_b=True) / row_norms(analogy_c)
+            denominator = tf.matmul(analogy_a, nemb, transpose_b=True) / row_norms(analogy_a)
 
             dist = (numerator_left * numerator_right) / (denominator + 0.000001)
 
@@ -133,6 +279,65 @@ class AnalogyModel:
         self._analogy_pred_ix = pred_ix
         self._analogy_pred_dists = nearest_dists
 
+    def _initBatching(self):
+        # largest batch that has not run out of memory, once one has
+        self._batch_limit = None
+        self._batch_stats = { 'queries_scored': 0, 'batches': 0, 'batch_backoffs': 0, 'scoring_seconds': 0. }
+
+    def _scoringWidth(self):
+        '''Returns the number of candidates each query is scored against at once
+        '''
+        return self._vocab_size
+
+    def _scoringItemSize(self):
+        return self.dtype().itemsize
+
+    def _batchAnswers(self, sets, batch_start, limit):
+        '''Returns the (batch x answers) matrix of the distinct answers of
+        each query in [batch_start, limit), across all sets (padded with -1)
+        '''
+        query_answers = [set() for _ in range(limit - batch_start)]
+        for (analogies, query_ixes, order, sorted_query_ixes) in sets:
+            rows = order[np.searchsorted(sorted_query_ixes, batch_start):np.searchsorted(sorted_query_ixes, limit)]
+            for (query, answers) in zip(query_ixes[rows] - batch_start, analogies[rows, 3:]):
+                query_answers[query].update(answers[answers >= 0].tolist())
+        batch_answers = np.full((len(query_answers), max([0] + [len(answers) for answers in query_answers])), -1, dtype=np.int64)
+        for i in range(len(query_answers)):
+            batch_answers[i, :len(query_answers[i])] = sorted(query_answers[i])
+        return batch_answers
+
+    def _tracksAnswers(self):
+        '''Returns True if _rankModes needs the answers of each batch of
+        queries (see _batchAnswers) to find their ranks as it goes
+        '''
+        return False
+
+    def _topScores(self, scores, top_ix):
+        '''Returns the scores of the top_ix candidates for each query, from
+        the scores returned by _rank
+        '''
+        return np.take_along_axis(scores, top_ix, axis=1)
+
+    def _rankModes(self, analogy_embs, depth, modes, answers=None):
+        '''Yields (mode, ranked indices, scores) for a batch of analogies
+        under each of modes (see _rank), given the (batch x answers)
+        matrix of answers for models that track them (see _tracksAnswers);
+        the TensorFlow graph is built for a single mode
+        '''
+        if list(modes) != [self._mode]:
+            raise ValueError('TensorFlow analogy model can only rank with its own method (%s)' % modeName(self._mode))
+        (ix, scores) = self._rank(analogy_embs, depth)
+        yield (self._mode, ix, scores)
+
+    def _rank(self, analogy_embs, depth):
+        '''Returns the ranked candidate indices for a batch of analogies
+        (at least the top depth), along with the candidate scores to find
+        the rank of each answer from (see _answerRanks), or None if the
+        full ranking is returned and metrics should be calculated from it
+        '''
+        _, ix = self._predict(analogy_embs)
+        return ix, None
+
     def _predict(self, analogy_embs):
         dists, idx = self._session.run([self._analogy_pred_dists, self._analogy_pred_ix], {
             self._analogy_a : analogy_embs[:,0,:],
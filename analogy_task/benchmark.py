@@ -0,0 +1,316 @@
+'''
+Micro-benchmarks of each stage of the analogy pipeline, on synthetic data.
+
+Generates word2vec and GloVe binary embeddings, a frequent term list and
+BMASS-format analogy files of a configurable size, then times each stage
+on its own (best of several runs) and measures its peak memory in a
+separate, untimed run under tracemalloc.  Results are written as JSON.
+'''
+
+import os
+import gc
+import sys
+import json
+import time
+import random
+import codecs
+import platform
+import resource
+import tempfile
+import tracemalloc
+import numpy as np
+from BMASS import settings
+from BMASS import parser as bmass_parser
+from analogy_task.analogy_model import Mode, Backend, modeName
+from analogy_task.embedding_wrapper import EmbeddingWrapper
+from analogy_task.task import buildModel, convertAnalogyToMatrices
+from lib import embeddings, ir_metrics, util
+from lib.embeddings import alias
+
+_setting_files = {
+    settings.ALL_INFO: 'bmass_all_info.txt',
+    settings.MULTI_ANSWER: 'bmass_multi_answer.txt',
+    settings.SINGLE_ANSWER: 'bmass_single_answer.txt',
+}
+
+def generateData(data_dir, vocab_size=10000, dim=100, relations=10, pairs=10, max_answers=3,
+        num_terms=None, seed=0):
+    '''Writes synthetic benchmark data to data_dir:
+        emb.bin         :: word2vec binary embeddings of vocab_size words
+        glove.bin       :: GloVe binary embeddings of the same words
+        glove.vocab     :: GloVe vocabulary
+        terms.txt       :: frequent term list of num_terms (default:
+                           1.5 x vocab_size) terms: every word, then
+                           multi-word terms of 2-3 words
+        bmass_*.txt     :: analogy files for each setting, with relations
+                           relations of pairs term pairs each, with
+                           between 1 and max_answers b terms per pair
+    Each relation's b terms are offset from their a terms by a shared
+    vector, so that the analogies can actually be completed.
+    '''
+    random_state = np.random.RandomState(seed)
+    rand = random.Random(seed)
+    if num_terms is None: num_terms = (3 * vocab_size) // 2
+
+    words = ['w%d' % i for i in range(vocab_size)]
+    vectors = random_state.randn(vocab_size, dim).astype(np.float32)
+
+    # terms: all single words first, then multi-word terms
+    terms = list(words[:num_terms])
+    while len(terms) < num_terms:
+        terms.append(' '.join(rand.sample(words, rand.randint(2, 3))))
+
+    # draw each relation's terms without replacement from the single words,
+    # so that their embeddings can be shifted by the relation's offset
+    unused = list(range(vocab_size))
+    rand.shuffle(unused)
+    analogy_pairs = []
+    for _ in range(relations):
+        offset = random_state.randn(dim)
+        rel_pairs = []
+        for _ in range(pairs):
+            if len(unused) < 1 + max_answers:
+                raise ValueError('Vocabulary too small for %d relations of %d pairs' % (relations, pairs))
+            a = unused.pop()
+            bs = [unused.pop() for _ in range(rand.randint(1, max_answers))]
+            for b in bs:
+                vectors[b] = vectors[a] + offset + random_state.randn(dim)
+            rel_pairs.append((a, bs))
+        analogy_pairs.append(rel_pairs)
+
+    embeddings.word2vec.write({ words[i]: vectors[i] for i in range(vocab_size) }, os.path.join(data_dir, 'emb.bin'))
+    # GloVe stores word and context vectors, each with a bias term, as doubles
+    glove = np.zeros((vocab_size, 2*(dim+1)), dtype=np.float64)
+    glove[:, :dim] = vectors / 2
+    glove[:, dim+1:2*dim+1] = vectors / 2
+    glove.tofile(os.path.join(data_dir, 'glove.bin'))
+    with codecs.open(os.path.join(data_dir, 'glove.vocab'), 'w', 'utf-8') as stream:
+        stream.write(''.join('%s 1\n' % word for word in words))
+    with codecs.open(os.path.join(data_dir, 'terms.txt'), 'w', 'utf-8') as stream:
+        stream.write(''.join('%s\n' % term for term in terms))
+
+    entry = lambda i: 'C%07d:"%s"' % (i, words[i])
+    for (setting, fname) in _setting_files.items():
+        with codecs.open(os.path.join(data_dir, fname), 'w', 'utf-8') as stream:
+            for r in range(relations):
+                stream.write('# R%d: relation %d\n' % (r, r))
+                for (a, bs) in analogy_pairs[r]:
+                    for (c, ds) in analogy_pairs[r]:
+                        if a == c: continue
+                        b_entry = ','.join(entry(b) for b in bs) if setting == settings.ALL_INFO else entry(bs[0])
+                        d_entry = ','.join(entry(d) for d in ds) if setting != settings.SINGLE_ANSWER else entry(ds[0])
+                        stream.write('%s\t%s\t%s\t%s\n' % (entry(a), b_entry, entry(c), d_entry))
+
+def measure(stage, fn, items, unit, repeat=3, warm_up=False):
+    '''Runs fn repeat times for timing (after one untimed run, if warm_up
+    is True, e.g. to fill a cache) and then once more under tracemalloc
+    for its peak memory (see peakMemory); returns (stage results, value of
+    fn())
+    '''
+    if warm_up:
+        fn()
+    times = []
+    for _ in range(repeat):
+        gc.collect()
+        t_start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - t_start)
+    (peak, value) = peakMemory(fn)
+    return ({
+        'stage': stage,
+        'items': items,
+        'unit': unit,
+        'seconds': min(times),
+        'mean_seconds': sum(times) / len(times),
+        'throughput': (items / min(times)) if min(times) > 0 else None,
+        'peak_traced_bytes': peak,
+    }, value)
+
+def peakMemory(fn):
+    '''Runs fn under tracemalloc, returning (peak bytes allocated, value of
+    fn())
+    '''
+    gc.collect()
+    tracemalloc.start()
+    try:
+        value = fn()
+        (_, peak) = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return (peak, value)
+
+def runBenchmarks(data_dir, setting=settings.MULTI_ANSWER, modes=[Mode.ThreeCosAdd], backend=Backend.NumPy,
+        batch_size=500, repeat=3, tile_size=None, max_scoring_bytes=None, log=None):
+    '''Times each pipeline stage on the data in data_dir (see generateData),
+    returning a list of per-stage results (see measure)
+    '''
+    stages = []
+    def run(stage, fn, items, unit, warm_up=False):
+        (results, value) = measure(stage, fn, items, unit, repeat=repeat, warm_up=warm_up)
+        stages.append(results)
+        if log: log('%-36s %10.4fs  %12.1f %s/s  peak %s' % (
+            stage, results['seconds'], results['throughput'] or 0, unit, util.formatBytes(results['peak_traced_bytes'])))
+        return value
+
+    embf, glovef = os.path.join(data_dir, 'emb.bin'), os.path.join(data_dir, 'glove.bin')
+    glove_vocabf = os.path.join(data_dir, 'glove.vocab')
+    analogy_file = os.path.join(data_dir, _setting_files[setting])
+
+    (words, embed_array) = run('embeddings.read[word2vec]',
+        lambda: embeddings.readMatrix(embf, use_cache=False), os.path.getsize(embf), 'bytes')
+    run('embeddings.read[glove]',
+        lambda: embeddings.readMatrix(glovef, format=embeddings.Format.Glove, vocab=glove_vocabf, use_cache=False, dtype='float32'),
+        os.path.getsize(glovef), 'bytes')
+
+    analogies = run('parser.read[%s]' % settings.name(setting),
+        lambda: bmass_parser.read(analogy_file, setting, strings_only=True), os.path.getsize(analogy_file), 'bytes')
+    num_analogies = sum(len(rel_analogies) for rel_analogies in analogies.values())
+
+    # timed only once the cache has been written
+    run('parser.read[%s, cached]' % settings.name(setting),
+        lambda: bmass_parser.read(analogy_file, setting, strings_only=True, use_cache=True), num_analogies, 'analogies',
+        warm_up=True)
+
+    terms = util.readList(os.path.join(data_dir, 'terms.txt'), encoding='utf-8')
+    aliases = run('alias.aliasEmbeddings', lambda: alias.aliasEmbeddings(terms, words, embed_array),
+        len(terms), 'terms')
+
+    emb_wrapper = EmbeddingWrapper(aliases, backoff_embeds=(words, embed_array), copy=False)
+
+    def convertAll():
+        converted = {}
+        for (relation, rel_analogies) in analogies.items():
+            max_answers = max([1] + [len(analogy[3]) for analogy in rel_analogies if type(analogy[3]) is list])
+            rel_converted = [convertAnalogyToMatrices(analogy, setting, emb_wrapper, max_answers) for analogy in rel_analogies]
+            converted[relation] = (
+                np.array([ixes for (valid, ixes, _) in rel_converted if valid], dtype=np.int32),
+                np.array([embeds for (valid, _, embeds) in rel_converted if valid], dtype=np.float32),
+            )
+        return converted
+    converted = run('convertAnalogyToMatrices', convertAll, num_analogies, 'analogies')
+
+    for mode in modes:
+        grph = buildModel(emb_wrapper.asArray(), mode=mode, backend=backend, normed=True, norms=emb_wrapper.norms(),
+            tile_size=tile_size)
+        evalAll = lambda: [grph.eval(ixes, embeds, batch_size=batch_size, max_scoring_bytes=max_scoring_bytes)
+            for (ixes, embeds) in converted.values()]
+        run('AnalogyModel.eval[%s, %s]' % (backend, modeName(mode)), evalAll, num_analogies, 'analogies')
+
+    # metrics over rankings as deep as the candidate vocabulary
+    random_state = np.random.RandomState(0)
+    num_queries = min(num_analogies, 2000)
+    depth = len(emb_wrapper)
+    ranked = np.argsort(random_state.rand(num_queries, depth), axis=1)
+    truth = random_state.randint(0, depth, size=(num_queries, 3))
+    run('ir_metrics.BatchMetrics', lambda: ir_metrics.BatchMetrics(truth, ranked, exclude=truth), num_queries, 'queries')
+    ranks = random_state.randint(1, depth+1, size=(num_queries, 3))
+    run('ir_metrics.RankedAP_RR', lambda: ir_metrics.RankedAP_RR(ranks), num_queries, 'queries')
+
+    return stages
+
+def _environment():
+    return {
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'platform': platform.platform(),
+        'processor': platform.processor(),
+        'cpus': os.cpu_count(),
+    }
+
+if __name__ == '__main__':
+
+    def _cli():
+        import optparse
+        parser = optparse.OptionParser(usage='Usage: %prog [options]',
+                description='Time each stage of the analogy pipeline on synthetic data, writing the results as JSON.')
+        parser.add_option('--vocab-size', dest='vocab_size',
+                help='number of words to generate embeddings for (default: %default)',
+                type='int', default=20000)
+        parser.add_option('--dim', dest='dim',
+                help='embedding dimensionality (default: %default)',
+                type='int', default=100)
+        parser.add_option('--relations', dest='relations',
+                help='number of relations (default: %default)',
+                type='int', default=10)
+        parser.add_option('--pairs', dest='pairs',
+                help='number of term pairs per relation (default: %default)',
+                type='int', default=15)
+        parser.add_option('--max-answers', dest='max_answers',
+                help='maximum number of b terms per pair (default: %default)',
+                type='int', default=3)
+        parser.add_option('--terms', dest='num_terms',
+                help='number of frequent (candidate) terms, including multi-word terms (default: 1.5 x vocabulary size)',
+                type='int', default=None)
+        parser.add_option('--setting', dest='setting',
+                help='BMASS variant to parse and score (default: %default)',
+                type='choice', choices=['All-Info', 'Multi-Answer', 'Single-Answer'], default='Multi-Answer')
+        parser.add_option('--analogy-method', dest='analogy_methods',
+                help='analogy method(s) to score with (may be repeated; default: 0)',
+                type='choice', choices=[str(Mode.ThreeCosAdd), str(Mode.PairwiseDistance), str(Mode.ThreeCosMul)],
+                action='append')
+        parser.add_option('--backend', dest='backend',
+                help='scoring backend to use (default: %default)',
+                type='choice', choices=[Backend.NumPy, Backend.TensorFlow, Backend.IVF, Backend.Quantized], default=Backend.NumPy)
+        parser.add_option('--tile-size', dest='tile_size',
+                help='number of candidates to score at a time (NumPy backend; default: all at once)',
+                type='int', default=None)
+        parser.add_option('--max-scoring-memory', dest='max_scoring_memory',
+                help='memory for scoring each batch of queries, to size batches by (e.g., 1G; default: batches of 500)')
+        parser.add_option('--repeat', dest='repeat',
+                help='number of timed runs of each stage (default: %default)',
+                type='int', default=3)
+        parser.add_option('--data-dir', dest='data_dir',
+                help='directory to generate the data in and keep it (default: a temporary directory)')
+        parser.add_option('--seed', dest='seed',
+                help='random seed for data generation (default: %default)',
+                type='int', default=0)
+        parser.add_option('-o', '--output', dest='output',
+                help='file to write JSON results to (default: stdout)')
+        (options, args) = parser.parse_args()
+        if len(args) > 0:
+            parser.print_help()
+            exit()
+        return options
+
+    options = _cli()
+    setting = { 'Single-Answer': settings.SINGLE_ANSWER, 'Multi-Answer': settings.MULTI_ANSWER, 'All-Info': settings.ALL_INFO }[options.setting]
+    modes = [int(m) for m in (options.analogy_methods or [Mode.ThreeCosAdd])]
+    report = lambda message: sys.stderr.write('%s\n' % message)
+
+    config = {
+        'vocab_size': options.vocab_size, 'dim': options.dim, 'relations': options.relations, 'pairs': options.pairs,
+        'max_answers': options.max_answers, 'terms': options.num_terms or (3 * options.vocab_size) // 2,
+        'setting': options.setting, 'methods': [modeName(m) for m in modes], 'backend': options.backend,
+        'tile_size': options.tile_size, 'max_scoring_memory': options.max_scoring_memory, 'repeat': options.repeat, 'seed': options.seed,
+    }
+
+    def benchmark(data_dir):
+        t_start = time.perf_counter()
+        generateData(data_dir, vocab_size=options.vocab_size, dim=options.dim, relations=options.relations,
+            pairs=options.pairs, max_answers=options.max_answers, num_terms=options.num_terms, seed=options.seed)
+        report('Generated data in %s (%.2fs)' % (data_dir, time.perf_counter() - t_start))
+        return runBenchmarks(data_dir, setting=setting, modes=modes, backend=options.backend,
+            repeat=options.repeat, tile_size=options.tile_size,
+            max_scoring_bytes=(util.parseBytes(options.max_scoring_memory) if options.max_scoring_memory else None), log=report)
+
+    if options.data_dir:
+        if not os.path.isdir(options.data_dir):
+            os.makedirs(options.data_dir)
+        stages = benchmark(options.data_dir)
+    else:
+        with tempfile.TemporaryDirectory() as data_dir:
+            stages = benchmark(data_dir)
+
+    results = {
+        'config': config,
+        'environment': _environment(),
+        'stages': stages,
+        # ru_maxrss is in kilobytes on Linux
+        'max_rss_bytes': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+    }
+    if options.output:
+        with open(options.output, 'w') as stream:
+            json.dump(results, stream, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        sys.stdout.write('\n')
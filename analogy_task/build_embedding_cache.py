@@ -0,0 +1,43 @@
+'''
+Build the pre-converted cache (see lib.embeddings.cache) for each
+configured embedding file, or for files given on the command line.
+'''
+
+import config
+from lib import log, embeddings
+
+def buildCache(embedf, glove_vocab=None, clean_vocab=False, log=log):
+    t_sub = log.startTimer('Building embedding cache for %s...' % embedf, newline=False)
+    if not glove_vocab:
+        (words, _) = embeddings.buildCache(embedf, clean=clean_vocab, normed=True)
+    else:
+        (words, _) = embeddings.buildCache(embedf, format=embeddings.Format.Glove, vocab=glove_vocab,
+            clean=clean_vocab, normed=True)
+    log.stopTimer(t_sub, message='Cached %d embeddings ({0:.2f}s)' % len(words))
+
+if __name__ == '__main__':
+
+    def _cli():
+        import optparse
+        parser = optparse.OptionParser(usage='Usage: %prog [options] [EMBEDF ...]',
+                description='Build the pre-converted cache for each EMBEDF (default: all of config.LABELED_EMBEDDINGS)')
+        parser.add_option('--glove-vocab', dest='glove_vocab',
+                help='vocabulary file (reads each EMBEDF as GloVe binary embeddings)')
+        parser.add_option('--clean', dest='clean_vocab',
+                help='clean the embedding vocabulary of each EMBEDF',
+                action='store_true', default=False)
+        (options, args) = parser.parse_args()
+        return args, options.glove_vocab, options.clean_vocab
+
+    (embedfs, glove_vocab, clean_vocab) = _cli()
+
+    if len(embedfs) > 0:
+        for embedf in embedfs:
+            buildCache(embedf, glove_vocab=glove_vocab, clean_vocab=clean_vocab)
+    else:
+        for (embedf, label, vocab_is_dirty) in config.LABELED_EMBEDDINGS:
+            if type(embedf) is tuple:
+                (embedf, glove_vocabf) = embedf
+            else:
+                glove_vocabf = None
+            buildCache(embedf, glove_vocab=glove_vocabf, clean_vocab=vocab_is_dirty)
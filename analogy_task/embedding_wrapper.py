@@ -5,45 +5,125 @@ Abstracted access to embedding for a target phrase; handles word-level backoff u
 import numpy as np
 
 class EmbeddingWrapper:
+    '''
+    Embeddings are held as one contiguous, unit-normed matrix (float32 by
+    default; exposed without copying by asArray()), along with the
+    original norm of each embedding; single and batch accessors return
+    embeddings at their original scale.
+
+    Both embeds and backoff_embeds may be given either as a dictionary
+    of { term : embedding } or as a (terms, embedding matrix) pair.  With
+    copy=False, a writable embedding matrix of the right type is normed
+    in place rather than copied.
+    '''
 
-    _embeds = None
     _embed_vocab = None
+    _embed_vocab_indices = None
     _embed_array = None
-    _backoff_embeds = None
-    
-    def __init__(self, embeds, backoff_embeds=None):
-        # for indexed access, split embeddings dictionary into immutable vocabulary and array
-        self._embed_vocab = tuple(embeds.keys())
+    _embed_norms = None
+    _backoff_vocab_indices = None
+    _backoff_array = None
+
+    def __init__(self, embeds, backoff_embeds=None, dtype=np.float32, copy=True):
+        # for indexed access, split embeddings into immutable vocabulary and array
+        (self._embed_vocab, embed_array) = self._splitVocab(embeds, dtype)
         self._embed_vocab_indices = { self._embed_vocab[i]:i for i in range(len(self._embed_vocab)) }
+        (self._embed_array, self._embed_norms) = self._normedArray(embed_array, dtype, copy)
 
-        self._embeds = embeds
-        self._backoff_embeds = backoff_embeds
+        if backoff_embeds is not None:
+            (backoff_vocab, backoff_array) = self._splitVocab(backoff_embeds, dtype)
+            self._backoff_vocab_indices = { backoff_vocab[i]:i for i in range(len(backoff_vocab)) }
+            self._backoff_array = backoff_array
 
     def index(self, item):
         try:
             return self._embed_vocab_indices[item]
-        except (KeyError, ValueError):
+        except (KeyError, ValueError, TypeError):
             return -1
 
+    def indices(self, items):
+        '''Returns an array of the vocabulary indices of items (-1 if unknown)
+        '''
+        return np.fromiter(
+            (self._embed_vocab_indices.get(item, -1) for item in items),
+            dtype=np.int64, count=len(items)
+        )
+
     def indexToTerm(self, ix):
         return self._embed_vocab[ix]
 
+    def vocab(self):
+        '''Returns the list of terms, in index order (not a copy)
+        '''
+        return self._embed_vocab
+
+    def vectors(self, ixes):
+        '''Returns the (len(ixes) x dim) matrix of embeddings for an array
+        of vocabulary indices
+        '''
+        ixes = np.asarray(ixes)
+        return self._embed_array[ixes] * self._embed_norms[ixes, np.newaxis]
+
     def asArray(self):
-        return np.array([self._embeds[v] for v in self._embed_vocab])
+        '''Returns the unit-normed embedding matrix (not a copy)
+        '''
+        return self._embed_array
+
+    def norms(self):
+        '''Returns the original norm of each embedding (not a copy)
+        '''
+        return self._embed_norms
+
+    def __len__(self):
+        return len(self._embed_vocab)
 
     def __getitem__(self, item):
-        if not type(item) is int:
+        if not type(item) in [int, np.int32, np.int64]:
             # use pre-calculated phrase embedding if known, else back off to averaging known words
-            if self._embeds.get(item, None) != None: return self._embeds[item]
+            ix = self.index(item)
+            if ix > -1: return self.vectors(ix)
             else:
-                return self._laxTokenAverage(item, self._backoff_embeds)
+                return self._laxTokenAverage(item)
+        else:
+            return self.vectors(item)
+
+    def _laxTokenAverage(self, item):
+        if self._backoff_vocab_indices is None: raise KeyError(item)
+        token_ixes = [self._backoff_vocab_indices.get(t, -1) for t in item.split()]
+        token_ixes = [ix for ix in token_ixes if ix > -1]
+        if len(token_ixes) > 0:
+            return np.mean(self._backoff_array[token_ixes], axis=0)
+        else: raise KeyError(item)
+
+    def nbytes(self):
+        '''Returns the memory used by the embedding (and backoff) matrices
+        '''
+        nbytes = self._embed_array.nbytes + self._embed_norms.nbytes
+        if self._backoff_array is not None: nbytes += self._backoff_array.nbytes
+        return nbytes
+
+    @staticmethod
+    def _splitVocab(embeds, dtype):
+        if type(embeds) is dict:
+            vocab = tuple(embeds.keys())
+            return (vocab, np.array([embeds[v] for v in vocab], dtype=dtype))
+        else:
+            (vocab, embed_array) = embeds
+            return (tuple(vocab), embed_array)
+
+    @staticmethod
+    def _normedArray(embed_array, dtype, copy):
+        '''Returns (unit-normed version of embed_array, original norms);
+        embed_array is used as is if it is already of type dtype and
+        unit-normed
+        '''
+        converted = np.ascontiguousarray(embed_array, dtype=dtype)
+        norms = np.sqrt(np.einsum('ij,ij->i', converted, converted))
+        nonzero = norms > 0
+        if np.allclose(norms[nonzero], 1, atol=1e-5):
+            norms = nonzero.astype(dtype)
+        elif (converted is not embed_array or not copy) and converted.flags.writeable:
+            converted /= np.where(nonzero, norms, 1)[:, np.newaxis]
         else:
-            return self._embeds[self._embed_vocab[item]]
-
-    def _laxTokenAverage(self, item, embeds):
-        token_embeds = []
-        for t in item.split():
-            if not embeds.get(t, None) is None: token_embeds.append(embeds[t])
-        if len(token_embeds) > 0:
-            return np.mean(token_embeds, axis=0)
-        else: raise KeyError
+            converted = converted / np.where(nonzero, norms, 1)[:, np.newaxis]
+        return (converted, norms)
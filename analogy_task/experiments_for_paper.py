@@ -2,125 +2,203 @@ import os
 import numpy as np
 import config
 from BMASS import settings
+from BMASS import parser as bmass_parser
 from analogy_task.embedding_wrapper import EmbeddingWrapper
-from analogy_task.analogy_model import Mode
-from analogy_task.task import analogyTask
-from lib import util, log, preprocessing, embeddings
-from lib.prm import PersistentResultsMatrix as PRM
-
-def saveResults(results_dir, relation, results):
-    prms = [
-        PRM(1, path=os.path.join(results_dir, '%s.acc.npy' % relation.replace(': ', '-'))),
-        PRM(1, path=os.path.join(results_dir, '%s.map.npy' % relation.replace(': ', '-'))),
-        PRM(1, path=os.path.join(results_dir, '%s.mrr.npy' % relation.replace(': ', '-'))),
-        PRM(1, path=os.path.join(results_dir, '%s.cor.npy' % relation.replace(': ', '-'))),
-        PRM(1, path=os.path.join(results_dir, '%s.ttl.npy' % relation.replace(': ', '-'))),
-    ]
-
-    (correct, MAP, MRR, total, skipped, _) = results
-    if total == 0:
-        for i in range(5):
-            prms[i][0] = -1
-    else:
-        prms[0][0] = float(correct) / total
-        prms[1][0] = MAP
-        prms[2][0] = MRR
-        prms[3][0] = correct
-        prms[4][0] = total-skipped
-
-    for prm in prms:
-        prm.save()
-
-def evaluate(embedf, analogy_file, setting, freqtermf, unigrams, analogy_method,
-        log=log, predictions_file=None, predictions_file_mode='w',
-        report_top_k=5, glove_vocab=None, clean_vocab=False):
-    t_main = log.startTimer()
-
-    # read main embeddings file
-    t_sub = log.startTimer('Reading embeddings from %s...' % embedf, newline=False)
+from analogy_task.analogy_model import Mode, Backend, modeName
+from analogy_task.task import analogyMethodsTask
+from analogy_task.predictions import Format as PredictionsFormat
+from analogy_task.quantized_model import Precision
+from lib import util, log, embeddings
+from lib.embeddings import alias
+from lib.results_store import ResultsStore
+
+# name of the results store in each results directory
+RESULTS_STORE = 'results.db'
+
+# names of the spans recorded in a run's trace (see lib.logging.Trace),
+# any of which can be profiled
+STAGES = ['parse', 'load', 'read', 'clean', 'norm', 'terms', 'alias', 'wrapper', 'model',
+    'relation', 'preprocess', 'score', 'metrics', 'write', 'flush', 'store']
+
+def saveResults(store, embeddings_name, setting, method, results):
+    '''Adds the results for each relation, given as { relation : results },
+    to a ResultsStore; all but the total are -1 for empty relations
+    '''
+    rows = []
+    for (relation, (correct, MAP, MRR, total, skipped, _)) in results.items():
+        rows.append({
+            'embeddings': embeddings_name,
+            'setting': settings.name(setting),
+            'method': modeName(method),
+            'relation': relation,
+            'accuracy': (float(correct) / total) if total > 0 else -1,
+            'map': float(MAP) if total > 0 else -1,
+            'mrr': float(MRR) if total > 0 else -1,
+            'correct': correct if total > 0 else -1,
+            'answered': (total - skipped) if total > 0 else -1,
+            'total': total,
+        })
+    store.append(rows)
+
+def evaluate(embedf, analogy_file, setting, freqtermf, unigrams, analogy_method, predictions_file=None, analogies=None, **kwargs):
+    '''Runs the analogy task on embedf for one setting and analogy method
+    (see evaluateMethods, for the other options), returning
+    { relation : results }
+    '''
+    return evaluateMethods(embedf, { setting: analogy_file }, freqtermf, unigrams, [analogy_method],
+        predictions_files=({ (analogy_method, setting): predictions_file } if predictions_file else None),
+        analogies=({ setting: analogies } if analogies is not None else None), **kwargs)[analogy_method][setting]
+
+def evaluateSettings(embedf, analogy_files, freqtermf, unigrams, analogy_method, predictions_files=None, **kwargs):
+    '''Runs the analogy task on embedf for each of { setting : analogy file }
+    in one pass, with one analogy method (see evaluateMethods);
+    predictions_files are given as { setting : file }.  Returns
+    { setting : { relation : results } }
+    '''
+    if predictions_files is None: predictions_files = {}
+    return evaluateMethods(embedf, analogy_files, freqtermf, unigrams, [analogy_method],
+        predictions_files={ (analogy_method, setting): predictions_file for (setting, predictions_file) in predictions_files.items() },
+        **kwargs)[analogy_method]
+
+def evaluateMethods(embedf, analogy_files, freqtermf, unigrams, analogy_methods,
+        log=log, predictions_files=None, predictions_file_mode='w',
+        report_top_k=5, glove_vocab=None, clean_vocab=False, backend=Backend.NumPy,
+        dtype='float32', workers=1, analogies=None, row_cache_bytes=1<<28, ivf_options=None,
+        predictions_format=PredictionsFormat.Text, quantized_options=None, tile_size=None, max_scoring_bytes=None):
+    '''Runs the analogy task on embedf for each of { setting : analogy file }
+    in one pass, ranking with each of analogy_methods (see
+    task.analogyMethodsTask); predictions_files are given as
+    { (method, setting) : file }.  Returns
+    { method : { setting : { relation : results } } }
+
+    With the IVF backend, the index is cached next to the embedding cache
+    for embedf (see lib.embeddings.ivf).
+    '''
+    with log.span('evaluate'):
+        t_main = log.startTimer()
+
+        # read main embeddings file (cleaned and unit-normed, to simplify cosine
+        # similarity; uses the pre-converted cache, if one has been built)
+        with log.span('load'):
+            t_sub = log.startTimer('Reading embeddings from %s...' % embedf, newline=False)
+            if not glove_vocab:
+                (words, embed_array) = embeddings.readMatrix(embedf, clean=clean_vocab, normed=True, dtype=dtype)
+            else:
+                (words, embed_array) = embeddings.readMatrix(embedf, format=embeddings.Format.Glove, vocab=glove_vocab,
+                    clean=clean_vocab, normed=True, dtype=dtype)
+            log.stopTimer(t_sub, message='Read %d embeddings [%s] ({0:.2f}s)' % (len(words), util.formatBytes(embed_array.nbytes)))
+
+        # finally, if using non-unigram data, construct the embedding vocabulary by averaging
+        # the token embeddings for all known strings; treat word embeddings like backoff
+        if not unigrams:
+            with log.span('terms'):
+                t_sub = log.startTimer('Reading frequent term vocabulary...', newline=False)
+                str_vocab = util.readList(freqtermf, encoding='utf-8')
+                log.stopTimer(t_sub, message='Read %d vocabulary terms ({0:.2f}s).' % len(str_vocab))
+
+            # the sparse term/token averaging matrix is cached alongside the term list
+            with log.span('alias'):
+                t_sub = log.startTimer('Constructing alias vocabulary...', newline=False)
+                backoff_embeds = (words, embed_array)
+                embeds = alias.aliasEmbeddings(str_vocab, words, embed_array, cache_prefix=freqtermf)
+                log.stopTimer(t_sub, message='Constructed %d aliases ({0:.2f}s).' % len(embeds[0]))
+        # if using unigram data, just take the word embeddings as the candidate vocabulary
+        else: 
+            embeds = (words, embed_array)
+            backoff_embeds = None
+
+        # abstract away the embedding access
+        with log.span('wrapper'):
+            t_sub = log.startTimer('Building embedding wrapper...', newline=False)
+            emb_wrapper = EmbeddingWrapper(embeds, backoff_embeds=backoff_embeds, dtype=dtype, copy=False)
+            log.stopTimer(t_sub, message='Complete [%s] ({0:.2f}s).' % util.formatBytes(emb_wrapper.nbytes()))
+
+        # the IVF index is keyed on the files the candidate embeddings came from
+        ivf_sources = [embedf] + ([glove_vocab] if glove_vocab else []) + ([freqtermf] if not unigrams else [])
+        ivf_prefix = embeddings.cache.prefix(embedf) + ('.clean' if clean_vocab else '')
+
+        results = analogyMethodsTask(analogy_files, emb_wrapper, analogy_methods, log=log, predictions_files=predictions_files, predictions_file_mode=predictions_file_mode, report_top_k=report_top_k,
+            backend=backend, workers=workers, analogies=analogies, row_cache_bytes=row_cache_bytes,
+            ivf_options=dict(ivf_options or {}, cache_prefix=ivf_prefix, cache_sources=ivf_sources),
+            predictions_format=predictions_format, quantized_options=quantized_options, tile_size=tile_size,
+            max_scoring_bytes=max_scoring_bytes)
+
+        log.stopTimer(t_main, message='Program complete in {0:.2f}s.')
+
+    return results
+
+def estimateMemory(embedf, glove_vocab=None, clean_vocab=False, num_aliases=0, dtype='float32', backend=Backend.NumPy,
+        workers=1, row_cache_bytes=1<<28, max_scoring_bytes=None, batch_size=500, tile_size=None, ivf_options=None,
+        quantized_options=None):
+    '''Returns a rough estimate of the peak memory (in bytes) of running
+    evaluate() on embedf, based on the shape of its embedding matrix and
+    the candidate vocabulary (num_aliases terms, or its words), along with
+    what the scoring backend keeps and each of workers uses to score a
+    batch of queries: cached similarity rows, the batch's scores (see
+    AnalogyModel.queryBytes), any quantized copy of the candidates, and
+    tile and gathering buffers
+    '''
     if not glove_vocab:
-        embeds = embeddings.read(embedf)
+        (num_words, dim) = embeddings.readShape(embedf)
     else:
-        embeds = embeddings.read(embedf, format=embeddings.Format.Glove, vocab=glove_vocab)
-
-    if clean_vocab:
-        clean = lambda k: ' '.join(preprocessing.tokenize(k))
-        keys = set(embeds.keys())
-        cleaned_embeds, keys_set_aside = {}, []
-        # first, find keys that are already clean
-        for key in keys:
-            clean_key = clean(key)
-            if clean_key == key: cleaned_embeds[key] = embeds[key]
-            else: keys_set_aside.append(key)
-        # put the keys set aside into deterministic order (preferring "To" to "TO")
-        keys_set_aside.sort()
-        keys_set_aside.reverse()
-        # then, find ones not already in the embedding list and add them
-        for key in keys_set_aside:
-            clean_key = clean(key)
-            if cleaned_embeds.get(clean_key, None) is None:
-                cleaned_embeds[clean_key] = embeds[key]
-        embeds = cleaned_embeds
-
-    log.stopTimer(t_sub, message='Read %d embeddings ({0:.2f}s)' % len(embeds))
-                    
-    # unit-norm each embedding to simplify cosine similarity
-    t_sub = log.startTimer('Norming embeddings...', newline=False)
-    for (k,v) in embeds.items():
-        embeds[k] = np.array(embeds[k]) / np.linalg.norm(embeds[k])
-    log.stopTimer(t_sub, message='Complete ({0:.2f}s).')
-
-    # finally, if using non-unigram data, construct the embedding vocabulary by averaging
-    # the token embeddings for all known strings; treat word embeddings like backoff
-    if not unigrams:
-        t_sub = log.startTimer('Reading frequent term vocabulary...', newline=False)
-        str_vocab = util.readList(freqtermf, encoding='utf-8')
-        log.stopTimer(t_sub, message='Read %d vocabulary terms ({0:.2f}s).' % len(str_vocab))
-
-        t_sub = log.startTimer('Constructing alias vocabulary...', newline=False)
-        backoff_embeds = embeds
-        averaged_embeds = {}
-        for known_str in str_vocab:
-            token_embeds = []
-            for t in known_str.split():
-                if not backoff_embeds.get(t, None) is None:
-                    token_embeds.append(backoff_embeds[t])
-            if len(token_embeds) > 0:
-                averaged_embeds[known_str] = np.mean(token_embeds, axis=0)
-        embeds = averaged_embeds
-        log.stopTimer(t_sub, message='Complete ({0:.2f}s).')
-    # if using unigram data, just take the word embeddings as the candidate vocabulary
-    else: 
-        backoff_embeds = None
-
-    # abstract away the embedding access
-    t_sub = log.startTimer('Building embedding wrapper...', newline=False)
-    emb_wrapper = EmbeddingWrapper(embeds, backoff_embeds=backoff_embeds)
-    log.stopTimer(t_sub, message='Complete ({0:.2f}s).')
-
-    results = analogyTask(analogy_file, setting, emb_wrapper, log=log, predictions_file=predictions_file, predictions_file_mode=predictions_file_mode, report_top_k=report_top_k)
-
-    log.stopTimer(t_main, message='Program complete in {0:.2f}s.')
+        (num_words, dim) = embeddings.readShape(embedf, format=embeddings.Format.Glove, vocab=glove_vocab)
+    itemsize = np.dtype(dtype).itemsize
+    num_candidates = num_aliases or num_words
+    # cleaning the vocabulary makes a second copy of the matrix
+    matrix_copies = 2 if clean_vocab else 1
+    shared = (matrix_copies * num_words + num_aliases) * dim * itemsize
+    ivf_options, quantized_options = (ivf_options or {}), (quantized_options or {})
 
-    return results
+    # scoring memory of each query, over the candidates scored at once
+    query_bytes = lambda width: width * (6 * itemsize + 10)
+    if backend == Backend.Quantized:
+        tile_bytes = quantized_options.get('tile_bytes', 1<<24)
+        rerank_depth = min(num_candidates, quantized_options.get('rerank_depth', 100))
+        query_bytes = query_bytes(min(num_candidates, max(1, tile_bytes // (4 * dim)))) + rerank_depth * (6 * itemsize + 16)
+        # the quantized copy (int8 with a float32 scale per row, or float16)
+        if quantized_options.get('precision', Precision.Int8) == Precision.Int8:
+            shared += num_candidates * (dim + 4)
+        else:
+            shared += num_candidates * dim * 2
+        # a dequantized tile, and the full-precision candidates gathered for re-ranking
+        worker = tile_bytes + quantized_options.get('gather_bytes', 1<<26)
+    elif backend == Backend.IVF:
+        query_bytes = query_bytes(num_candidates)
+        # the index's candidate order, and the shortlisted candidates gathered at once
+        shared += num_candidates * 8
+        worker = row_cache_bytes + ivf_options.get('gather_bytes', 1<<26)
+    else:
+        query_bytes = query_bytes(min(num_candidates, tile_size or num_candidates))
+        # only untiled NumPy scoring caches similarity rows
+        worker = row_cache_bytes if (backend == Backend.NumPy and tile_size is None) else 0
+    worker += max_scoring_bytes if max_scoring_bytes is not None else batch_size * query_bytes
+    return shared + workers * worker
 
 
 if __name__ == '__main__':
 
     def _cli():
         import optparse
-        parser = optparse.OptionParser(usage='Usage: %prog ANALOGY_FILE RESULTS_DIR',
-                description='Run the analogy task on analogies in ANALOGY_FILE')
+        parser = optparse.OptionParser(usage='Usage: %prog ANALOGY_FILE RESULTS_DIR [ANALOGY_FILE RESULTS_DIR ...]',
+                description='Run the analogy task on analogies in ANALOGY_FILE.  Several settings can be'
+                            ' evaluated in one pass by repeating --setting, with an ANALOGY_FILE and'
+                            ' RESULTS_DIR (and, optionally, a --predictions-file) for each, in order.  Results'
+                            ' for each relation are added to RESULTS_DIR/%s (see lib.results_store).' % RESULTS_STORE)
         parser.add_option('--frequent-term-list', dest='freqtermf',
                 help='list of frequent terms to use as completion vocabulary',
                 default=config.FREQUENT_TERMS)
-        parser.add_option('--setting', dest='setting',
-                help='BMASS variant',
-                type='choice', choices=['All-Info', 'Multi-Answer', 'Single-Answer'])
+        parser.add_option('--setting', dest='settings',
+                help='BMASS variant (may be repeated)',
+                type='choice', choices=['All-Info', 'Multi-Answer', 'Single-Answer'], action='append')
         parser.add_option('-l', '--logfile', dest='logfile',
                 help='logfile')
-        parser.add_option('--predictions-file', dest='predictions_file',
-                help='file to write predictions for individual analogies to')
+        parser.add_option('--predictions-file', dest='predictions_files',
+                help='file to write predictions for individual analogies to (one per --setting)',
+                action='append')
+        parser.add_option('--predictions-format', dest='predictions_format',
+                help='format to write predictions in: verbose text, or a directory of per-relation .npz files'
+                     ' of indices into a shared vocabulary file (default: %default)',
+                type='choice', choices=[PredictionsFormat.Text, PredictionsFormat.Binary], default=PredictionsFormat.Text)
         parser.add_option('--predictions-top-k', dest='report_top_k',
                 help='number of predictions to log in the predictions file (default: %default)',
                 type='int', default=5)
@@ -130,56 +208,251 @@ if __name__ == '__main__':
         parser.add_option('--unigram-mwe-compare', dest='unigram_mwe_comparison',
                 help='evaluate on unigram data (using MWE candidates)',
                 action='store_true', default=False)
-        parser.add_option('--analogy-method', dest='analogy_method',
-                help='method to use for analogy completion',
-                type='int', default=Mode.ThreeCosAdd)
+        parser.add_option('--analogy-method', dest='analogy_methods',
+                help='method to use for analogy completion (%d: 3CosAdd, %d: PairwiseDistance, %d: 3CosMul; default: %d);'
+                     ' may be repeated to score several methods in one pass, with results and predictions'
+                     ' for each kept separately by method name' % (
+                    Mode.ThreeCosAdd, Mode.PairwiseDistance, Mode.ThreeCosMul, Mode.ThreeCosAdd),
+                type='choice', choices=[str(m) for m in [Mode.ThreeCosAdd, Mode.PairwiseDistance, Mode.ThreeCosMul]],
+                action='append')
+        parser.add_option('--dtype', dest='dtype',
+                help='floating-point type to hold embeddings in (default: %default)',
+                type='choice', choices=['float32', 'float64'], default='float32')
+        parser.add_option('--backend', dest='backend',
+                help='scoring backend to use (default: %default)',
+                type='choice', choices=[Backend.NumPy, Backend.TensorFlow, Backend.IVF, Backend.Quantized], default=Backend.NumPy)
+        parser.add_option('--workers', dest='workers',
+                help='number of processes to complete relations in (NumPy backend only; default: %default)',
+                type='int', default=1)
+        parser.add_option('--concurrent-sets', dest='concurrent_sets',
+                help='number of embedding sets to evaluate at once, in separate processes (default: %default)',
+                type='int', default=1)
+        parser.add_option('--memory-budget', dest='memory_budget',
+                help='memory available to concurrently evaluated embedding sets (e.g., 64G; default: no limit)')
+        parser.add_option('--row-cache-size', dest='row_cache_size',
+                help='memory for caching the similarity rows of repeated query terms, in each worker'
+                     ' (NumPy backend only; 0 to disable; default: %default)',
+                default='256M')
+        parser.add_option('--max-scoring-memory', dest='max_scoring_memory',
+                help='memory for scoring each batch of queries, in each worker (e.g., 4G); batches are sized'
+                     ' from the vocabulary size, dimensionality and dtype to fit, and halved if they run out'
+                     ' of memory (default: batches of 500 queries)')
+        parser.add_option('--tile-size', dest='tile_size',
+                help='number of candidates to score at a time, keeping a running top-k and answer ranks, to bound'
+                     ' scoring memory on large vocabularies (NumPy backend only; a few thousand or more;'
+                     ' default: all at once)',
+                type='int', default=None)
+        parser.add_option('--ivf-lists', dest='ivf_lists',
+                help='number of lists in the IVF index (IVF backend only; default: 4x the square root of the vocabulary size)',
+                type='int', default=None)
+        parser.add_option('--ivf-probes', dest='ivf_probes',
+                help='number of IVF lists to search for each query (default: %default)',
+                type='int', default=8)
+        parser.add_option('--ivf-rerank-depth', dest='ivf_rerank_depth',
+                help='number of approximate candidates to rank for each query (default: %default)',
+                type='int', default=100)
+        parser.add_option('--ivf-recall-sample', dest='ivf_recall_sample',
+                help='number of queries per batch to also rank by exact search, for reporting recall@10 (default: %default)',
+                type='int', default=10)
+        parser.add_option('--quantized-precision', dest='quantized_precision',
+                help='precision to store candidates in for quantized scoring (quantized backend only; default: %default)',
+                type='choice', choices=[Precision.Float16, Precision.Int8], default=Precision.Int8)
+        parser.add_option('--quantized-rerank-depth', dest='quantized_rerank_depth',
+                help='number of top quantized candidates to re-rank exactly for each query (default: %default)',
+                type='int', default=100)
+        parser.add_option('--quantized-check-sample', dest='quantized_check_sample',
+                help='number of queries per relation to also rank exactly, for reporting how often the'
+                     ' results differ (default: %default)',
+                type='int', default=20)
+        parser.add_option('--trace', dest='trace_file',
+                help='file to write a JSON trace of the wall time, CPU time and memory of each stage to'
+                     ' (with --concurrent-sets, one per set, named for it); stages run in --workers'
+                     ' processes are only recorded as a whole')
+        parser.add_option('--trace-memory', dest='trace_memory',
+                help='also trace the peak memory allocated by Python in each stage (slow)',
+                action='store_true', default=False)
+        parser.add_option('--profile', dest='profile',
+                help='stage to run under cProfile (one of: %s); the top functions are logged, and the'
+                     ' full statistics saved next to the --trace file' % ', '.join(STAGES),
+                type='choice', choices=STAGES)
         (options, args) = parser.parse_args()
-        if len(args) != 2 \
+        if not options.settings or len(args) != 2*len(options.settings) \
+                or (options.predictions_files and len(options.predictions_files) != len(options.settings)) \
+                or len(set(options.settings)) != len(options.settings) \
+                or (options.analogy_methods and len(set(options.analogy_methods)) != len(options.analogy_methods)) \
                 or (not options.unigrams and not options.freqtermf):
             parser.print_help()
             exit()
 
-        analogy_file, results_dir = args
-
-        if options.setting == 'Single-Answer': options.setting = settings.SINGLE_ANSWER
-        elif options.setting == 'Multi-Answer': options.setting = settings.MULTI_ANSWER
-        elif options.setting == 'All-Info': options.setting = settings.ALL_INFO
+        setting_ids = { 'Single-Answer': settings.SINGLE_ANSWER, 'Multi-Answer': settings.MULTI_ANSWER, 'All-Info': settings.ALL_INFO }
+        setting_list = [setting_ids[setting] for setting in options.settings]
+        analogy_files = { setting_list[i]: args[2*i] for i in range(len(setting_list)) }
+        results_dirs = { setting_list[i]: args[2*i + 1] for i in range(len(setting_list)) }
+        predictions_files = { setting_list[i]: options.predictions_files[i] for i in range(len(setting_list)) } \
+            if options.predictions_files else {}
 
-        return (analogy_file, options.setting, results_dir,
+        return (analogy_files, results_dirs,
             options.freqtermf, options.unigrams, options.unigram_mwe_comparison, 
-            options.analogy_method, 
-            options.logfile, options.predictions_file, options.report_top_k,
+            [int(m) for m in (options.analogy_methods or [Mode.ThreeCosAdd])],
+            options.logfile, predictions_files, options.report_top_k,
+            options.backend, options.dtype, options.workers,
+            options.concurrent_sets, (util.parseBytes(options.memory_budget) if options.memory_budget else None),
+            util.parseBytes(options.row_cache_size),
+            { 'lists': options.ivf_lists, 'probes': options.ivf_probes, 'rerank_depth': options.ivf_rerank_depth,
+              'recall_sample': options.ivf_recall_sample },
+            options.predictions_format, options.trace_file, options.trace_memory, options.profile,
+            { 'precision': options.quantized_precision, 'rerank_depth': options.quantized_rerank_depth,
+              'check_sample': options.quantized_check_sample },
+            options.tile_size,
+            (util.parseBytes(options.max_scoring_memory) if options.max_scoring_memory else None),
         )
     
-    (analogy_file, setting, results_dir, freqtermf, unigrams, unigram_mwe_comparison, 
-        analogy_method, logfile, predictions_file, report_top_k) = args = _cli()
+    (analogy_files, results_dirs, freqtermf, unigrams, unigram_mwe_comparison, 
+        analogy_methods, logfile, predictions_files, report_top_k, backend, dtype, workers,
+        concurrent_sets, memory_budget, row_cache_bytes, ivf_options, predictions_format,
+        trace_file, trace_memory, profile, quantized_options, tile_size, max_scoring_bytes) = args = _cli()
     log.start(logfile=logfile, stdout_also=True)
+    # spans are only recorded when they will be written or profiled
+    tracing = bool(trace_file or profile)
+    if tracing:
+        log.startTrace(trace_memory=trace_memory, profile=profile)
 
-    # if storing predictions, clear the file here
-    if predictions_file:
-        with open(predictions_file, 'w') as stream:
-            pass
+    # parse the analogies once, for all embedding sets
+    analogies = {}
+    for (setting, analogy_file) in analogy_files.items():
+        with log.span('parse'):
+            t_sub = log.startTimer('Reading analogies from %s...' % analogy_file, newline=False)
+            analogies[setting] = bmass_parser.read(analogy_file, setting, strings_only=True, use_cache=True)
+            log.stopTimer(t_sub, message='Read %d relations ({0:.2f}s).' % len(analogies[setting]))
 
+    # with several analogy methods, predictions for each are kept under
+    # its own name (results are stored together, keyed by method)
+    suffixed = lambda fname, suffix: '%s.%s%s' % (os.path.splitext(fname)[0], suffix, os.path.splitext(fname)[1])
+    if len(analogy_methods) > 1:
+        predictions_files = {
+            (method, setting): suffixed(predictions_file, modeName(method))
+                for method in analogy_methods for (setting, predictions_file) in predictions_files.items()
+        }
+    else:
+        predictions_files = { (analogy_methods[0], setting): predictions_file for (setting, predictions_file) in predictions_files.items() }
+    results_stores = { setting: os.path.join(results_dir, RESULTS_STORE) for (setting, results_dir) in results_dirs.items() }
+    for results_dir in results_dirs.values():
+        if not os.path.isdir(results_dir):
+            os.makedirs(results_dir)
+
+    # if storing predictions, clear the files here
+    if concurrent_sets <= 1 and predictions_format == PredictionsFormat.Text:
+        for predictions_file in predictions_files.values():
+            open(predictions_file, 'w').close()
+
+    embedding_sets = []
     for (embedf, label, vocab_is_dirty) in config.LABELED_EMBEDDINGS:
         if type(embedf) is tuple:
             (embedf, glove_vocabf) = embedf
         else:
             glove_vocabf = None
+        set_name = os.path.splitext(os.path.basename(embedf))[0]
+        embedding_sets.append((embedf, glove_vocabf, label, vocab_is_dirty, set_name))
 
-        these_results_dir = os.path.join(results_dir, os.path.splitext(os.path.basename(embedf))[0])
-        if not os.path.isdir(these_results_dir):
-            os.mkdir(these_results_dir)
+    def setPredictionsFiles(set_name, own_files):
+        '''Binary predictions for each set go in their own directory
+        (under the one given); text predictions for all sets are written
+        to the same file, unless own_files is True
+        '''
+        if predictions_format == PredictionsFormat.Binary:
+            return { key: os.path.join(predictions_file, set_name) for (key, predictions_file) in predictions_files.items() }
+        elif own_files:
+            return { key: suffixed(predictions_file, set_name) for (key, predictions_file) in predictions_files.items() }
+        else:
+            return predictions_files
 
-        log.writeln(('\n\n\n{0}\nEmbeddings: %s\n{0}\n\n' % label).format('-'*79))
+    def runSet(embedf, glove_vocabf, label, vocab_is_dirty, set_name, set_predictions_files, set_results_stores):
+        with log.span('embeddings %s' % set_name):
+            log.writeln(('\n\n\n{0}\nEmbeddings: %s\n{0}\n\n' % label).format('-'*79))
 
-        if predictions_file:
-            with open(predictions_file, 'a') as stream:
-                stream.write(('\n\n\n{0}\nEmbeddings: %s\n{0}\n\n\n' % label).format('-'*79))
+            if predictions_format == PredictionsFormat.Text:
+                for set_predictions_file in set_predictions_files.values():
+                    with open(set_predictions_file, 'a') as stream:
+                        stream.write(('\n\n\n{0}\nEmbeddings: %s\n{0}\n\n\n' % label).format('-'*79))
 
-        results = evaluate(embedf, analogy_file, setting, freqtermf,
-            unigrams, analogy_method, log=log, 
-            predictions_file=predictions_file, predictions_file_mode='a', report_top_k=report_top_k,
-            glove_vocab=glove_vocabf, clean_vocab=vocab_is_dirty)
+            # all settings and methods are evaluated together, sharing
+            # embeddings, queries and similarity rows
+            results = evaluateMethods(embedf, analogy_files, freqtermf,
+                unigrams, analogy_methods, log=log, 
+                predictions_files=set_predictions_files, predictions_file_mode='a', report_top_k=report_top_k,
+                glove_vocab=glove_vocabf, clean_vocab=vocab_is_dirty, backend=backend, dtype=dtype,
+                workers=workers, analogies=analogies, row_cache_bytes=row_cache_bytes, ivf_options=ivf_options,
+                predictions_format=predictions_format, quantized_options=quantized_options, tile_size=tile_size,
+                max_scoring_bytes=max_scoring_bytes)
         
-        for (relation, rel_results) in results.items():
-            saveResults(these_results_dir, relation, rel_results)
+            with log.span('store'):
+                for (method, method_results) in results.items():
+                    for (setting, setting_results) in method_results.items():
+                        with ResultsStore(set_results_stores[setting]) as store:
+                            saveResults(store, set_name, setting, method, setting_results)
+
+    failed = False
+    if concurrent_sets <= 1:
+        for embedding_set in embedding_sets:
+            runSet(*embedding_set, set_predictions_files=setPredictionsFiles(embedding_set[-1], False),
+                set_results_stores=results_stores)
+
+    else:
+        # each set is evaluated in its own process, logging to its own log,
+        # predictions files and results stores (named for the set) alongside
+        # the main ones; this process alone writes the main results stores,
+        # merging in those of each set once all are done
+        setResultsStores = lambda set_name: {
+            setting: suffixed(results_store, set_name) for (setting, results_store) in results_stores.items()
+        }
+
+        def setJob(embedding_set):
+            (embedf, glove_vocabf, label, vocab_is_dirty, set_name) = embedding_set
+            def job():
+                log.start(logfile=(suffixed(logfile, set_name) if logfile else None))
+                if tracing:
+                    log.startTrace(trace_memory=trace_memory, profile=profile)
+                set_predictions_files = setPredictionsFiles(set_name, True)
+                if predictions_format == PredictionsFormat.Text:
+                    for set_predictions_file in set_predictions_files.values():
+                        open(set_predictions_file, 'w').close()
+                set_results_stores = setResultsStores(set_name)
+                for set_results_store in set_results_stores.values():
+                    if os.path.exists(set_results_store):
+                        os.remove(set_results_store)
+                runSet(*embedding_set, set_predictions_files=set_predictions_files, set_results_stores=set_results_stores)
+                log.stopTrace(suffixed(trace_file, set_name) if trace_file else None)
+                log.stop()
+            return job
+
+        num_aliases = 0 if unigrams else len(util.readList(freqtermf, encoding='utf-8'))
+        jobs = []
+        for embedding_set in embedding_sets:
+            (embedf, glove_vocabf, label, vocab_is_dirty, set_name) = embedding_set
+            estimate = estimateMemory(embedf, glove_vocab=glove_vocabf, clean_vocab=vocab_is_dirty,
+                num_aliases=num_aliases, dtype=dtype, backend=backend, workers=workers, row_cache_bytes=row_cache_bytes,
+                max_scoring_bytes=max_scoring_bytes, tile_size=tile_size, ivf_options=ivf_options,
+                quantized_options=quantized_options)
+            jobs.append((setJob(embedding_set), estimate))
+
+        log.writeln('Evaluating %d embedding sets, %d at a time (memory budget: %s)' % (
+            len(jobs), concurrent_sets, (util.formatBytes(memory_budget) if memory_budget else 'none')))
+        onStart = lambda i: log.writeln('  Started: %s [~%s]' % (embedding_sets[i][2], util.formatBytes(jobs[i][1])))
+        onFinish = lambda i, exitcode: log.writeln('  %s: %s' % (
+            ('Completed' if exitcode == 0 else 'FAILED (exit code %s)' % str(exitcode)), embedding_sets[i][2]))
+        exitcodes = util.budgetedExecute(jobs, concurrent_sets, memory_budget=memory_budget,
+            onStart=onStart, onFinish=onFinish)
+        failed = any(exitcode != 0 for exitcode in exitcodes)
+
+        # results of failed sets are kept, for whichever settings they stored
+        for (setting, results_store) in results_stores.items():
+            with ResultsStore(results_store) as store:
+                for embedding_set in embedding_sets:
+                    set_results_store = setResultsStores(embedding_set[-1])[setting]
+                    if os.path.exists(set_results_store):
+                        store.merge(set_results_store)
+                        os.remove(set_results_store)
+
+    log.stopTrace(trace_file)
+    if failed:
+        exit(1)
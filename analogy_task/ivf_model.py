@@ -0,0 +1,113 @@
+'''
+Approximate analogy completion over an IVF index of the candidates (see
+lib.embeddings.ivf), for very large candidate vocabularies.
+'''
+import numpy as np
+from analogy_task.analogy_model import Mode
+from analogy_task.numpy_model import NumpyAnalogyModel
+from lib.embeddings import ivf
+
+class IVFAnalogyModel(NumpyAnalogyModel):
+    '''
+    Finds the candidates for each query in the probes lists of the index
+    nearest its 3CosAdd target (b-a+c), and ranks them exactly with each
+    analogy method.  Rankings are only rerank_depth candidates deep, so
+    MAP and MRR only count answers found within them.
+
+    Unless given, the index is built over the (unit-normed) candidates
+    with the given number of lists, and cached under cache_prefix if one
+    is given, keyed on the files in cache_sources that the candidates
+    were read from (see lib.embeddings.ivf.loadOrBuild).
+
+    Shortlisted candidates are gathered and scored for as many queries at
+    once as fit in gather_bytes.
+
+    To measure what is lost, the first recall_sample queries of each batch
+    are also ranked by exact search, and recall@recall_k of the
+    approximate rankings against it is counted (see scoringStats).
+    '''
+
+    def __init__(self, embed_array, mode=Mode.ThreeCosAdd, normed=False, norms=None, index=None, lists=None,
+            cache_prefix=None, cache_sources=(), probes=8, rerank_depth=100, recall_k=10, recall_sample=10,
+            row_cache_bytes=1<<28, gather_bytes=1<<26):
+        NumpyAnalogyModel.__init__(self, embed_array, mode=mode, normed=normed, norms=norms, row_cache_bytes=row_cache_bytes)
+        if index is None:
+            index = ivf.loadOrBuild(self._embeds, cache_prefix=cache_prefix, sources=cache_sources, num_lists=lists)
+        self._index = index
+        self._gather_bytes = gather_bytes
+        self._probes = probes
+        self._rerank_depth = rerank_depth
+        self._recall_k = min(recall_k, self._vocab_size)
+        self._recall_sample = recall_sample
+        self._recall_hits = {}
+        self._recall_total = {}
+
+    def index(self):
+        return self._index
+
+    def recallK(self):
+        return self._recall_k
+
+    def scoringStats(self):
+        stats = NumpyAnalogyModel.scoringStats(self)
+        for mode in self._recall_total.keys():
+            stats[('recall_hits', mode)] = self._recall_hits[mode]
+            stats[('recall_total', mode)] = self._recall_total[mode]
+        return stats
+
+    def _rank(self, analogy_embs, depth):
+        ((_, ix, scores),) = self._rankModes(analogy_embs, depth, [self._mode])
+        return ix, scores
+
+    def _rankModes(self, analogy_embs, depth, modes, answers=None):
+        '''Yields (mode, ranked indices, None) for each of modes, from the
+        candidates shortlisted for each query by the index
+        '''
+        analogy_embs = np.asarray(analogy_embs, dtype=self._embeds.dtype)
+        width = min(self._vocab_size, max(depth, self._rerank_depth, self._recall_k))
+        targets = (analogy_embs[:,1,:] - analogy_embs[:,0,:]) + analogy_embs[:,2,:]
+        shortlists = self._index.probe(targets, self._probes, min_candidates=width)
+
+        ranked = { mode: np.empty((len(analogy_embs), width), dtype=np.int64) for mode in modes }
+        max_candidates = max(len(candidates) for candidates in shortlists)
+        chunk_size = max(1, self._gather_bytes // (max_candidates * self._dim * self._embeds.dtype.itemsize))
+        for start in range(0, len(analogy_embs), chunk_size):
+            stop = min(start + chunk_size, len(analogy_embs))
+            chunk_embs = analogy_embs[start:stop]
+
+            # (chunk x max. shortlist) candidate matrix, padded with the
+            # first candidate (masked out below)
+            lengths = np.array([len(candidates) for candidates in shortlists[start:stop]])
+            valid = np.arange(max_candidates) < lengths[:, np.newaxis]
+            candidates = np.zeros((stop - start, max_candidates), dtype=np.int64)
+            for i in range(stop - start):
+                candidates[i, :lengths[i]] = shortlists[start + i]
+
+            # a, b and c similarities to each query's own candidates
+            dots = np.matmul(self._embeds[candidates], chunk_embs.transpose(0, 2, 1))
+            rows = (dots[:,:,0], dots[:,:,1], dots[:,:,2])
+            # ties broken by lower index, as in exact ranking (padding last)
+            tie_keys = np.where(valid, candidates, self._vocab_size)
+            for mode in modes:
+                dists = self._scoreFromRows(mode, rows, chunk_embs, norms=self._norms[candidates])
+                dists[~valid] = -np.inf
+                order = np.lexsort((tie_keys, -dists), axis=1)[:, :width]
+                ranked[mode][start:stop] = np.take_along_axis(candidates, order, axis=1)
+
+        if self._recall_sample > 0:
+            self._countRecall(analogy_embs[:self._recall_sample], modes, ranked)
+        for mode in modes:
+            yield (mode, ranked[mode], None)
+
+    def _countRecall(self, analogy_embs, modes, ranked):
+        '''Counts how many of the exact top recall_k candidates for each
+        of analogy_embs are in the top recall_k of its approximate ranking
+        '''
+        k = self._recall_k
+        rows = self._similarityRows(analogy_embs)
+        for mode in modes:
+            exact = self._topK(self._scoreFromRows(mode, rows, analogy_embs), k)
+            approximate = ranked[mode][:len(analogy_embs), :k]
+            hits = np.count_nonzero((approximate[:, :, np.newaxis] == exact[:, np.newaxis, :]).any(axis=2))
+            self._recall_hits[mode] = self._recall_hits.get(mode, 0) + hits
+            self._recall_total[mode] = self._recall_total.get(mode, 0) + exact.size
@@ -0,0 +1,368 @@
+'''
+NumPy/BLAS implementation of the analogy completion model; drop-in
+replacement for the TensorFlow AnalogyModel.
+'''
+import numpy as np
+from analogy_task.analogy_model import AnalogyModel, Mode
+from analogy_task.row_cache import SimilarityRowCache, similarityRows
+
+class NumpyAnalogyModel(AnalogyModel):
+    '''
+    Scores analogies with float32 (or float64, if given) matrix products
+    against a unit-normed copy of the candidate embeddings.  Shares eval() with AnalogyModel,
+    so results are directly comparable with the TensorFlow backend.
+
+    PairwiseDistance is calculated against the candidates at their
+    original scale, given by norms (the original norm of each candidate;
+    by default, the norms found when normalizing embed_array, or 1 if it
+    is already normed).
+
+    By default, only the top of each ranking is selected (with
+    argpartition), and MAP/MRR are calculated exactly from the rank of
+    each answer, found by counting the candidates that outscore it.
+    Pass full_sort=True to sort the complete candidate list instead.
+
+    Scores are combined from the similarity rows of the distinct a, b and
+    c terms in each batch, as analogies in a relation share most of their
+    terms; rows are kept for later batches in an LRU cache of up to
+    row_cache_bytes (0 to only share rows within a batch).  Each row is
+    calculated the same way whichever batch it is first needed in (see
+    row_cache.similarityRows), so results do not depend on what is cached.
+
+    If tile_size is given, candidates are instead scored tile_size at a
+    time, keeping a running top of each ranking and counting the
+    candidates that outscore each answer, so that no (batch x vocab)
+    matrix is ever built and memory is set by tile_size rather than the
+    vocabulary size (similarity rows are then not cached).
+    '''
+
+    def __init__(self, embed_array, mode=Mode.ThreeCosAdd, normed=False, norms=None, full_sort=False, row_cache_bytes=1<<28,
+            tile_size=None):
+        self._mode = mode
+        self._full_sort = full_sort
+        self._tile_size = tile_size if (tile_size and not full_sort) else None
+        embed_array = np.asarray(embed_array)
+        if not embed_array.dtype in [np.float32, np.float64]:
+            embed_array = embed_array.astype(np.float32)
+        if not normed:
+            row_norms = np.linalg.norm(embed_array, axis=1)
+            embed_array = embed_array / np.where(row_norms > 0, row_norms, 1)[:, np.newaxis]
+            if norms is None: norms = row_norms
+        self._embeds = np.ascontiguousarray(embed_array)
+        self._vocab_size = self._embeds.shape[0]
+        self._dim = self._embeds.shape[1]
+
+        # original candidate norms, for PairwiseDistance
+        if norms is None: norms = np.ones(self._vocab_size)
+        self._norms = np.asarray(norms, dtype=self._embeds.dtype)
+        self._identical_tolerance = 16 * np.sqrt(self._dim) * np.finfo(self._embeds.dtype).eps
+
+        self._row_cache = SimilarityRowCache(self._embeds, max_bytes=row_cache_bytes)
+        self._initBatching()
+
+    def rowCache(self):
+        return self._row_cache
+
+    def scoringStats(self):
+        stats = AnalogyModel.scoringStats(self)
+        # tiled scoring does not go through the row cache
+        if self._tile_size is None:
+            stats.update({ 'rows_calculated': self._row_cache.misses, 'rows_reused': self._row_cache.hits })
+        return stats
+
+    def _scoreBatch(self, analogy_embs):
+        '''Returns the (batch x vocab) matrix of candidate scores
+        '''
+        return self._scoreFromRows(self._mode, self._similarityRows(analogy_embs), analogy_embs)
+
+    def _distinctTerms(self, analogy_embs):
+        '''Returns (keys, vectors, indices) for the distinct a, b and c
+        term vectors in a batch, where indices is the (3 x batch) array of
+        the position of each query's a, b and c among them
+        '''
+        (batch, _, dim) = analogy_embs.shape
+        terms = np.ascontiguousarray(analogy_embs.transpose(1, 0, 2)).reshape((3*batch, dim))
+        term_ixes = {}
+        indices = np.array([term_ixes.setdefault(key, len(term_ixes)) for key in self._row_cache.keys(terms)], dtype=np.int64)
+        (_, first) = np.unique(indices, return_index=True)
+        return (list(term_ixes.keys()), terms[first], indices.reshape((3, batch)))
+
+    def _similarityRows(self, analogy_embs):
+        '''Returns the (batch x vocab) similarities of a, b and c to each
+        candidate, calculating only the rows of distinct terms not already
+        in the row cache
+        '''
+        (keys, vectors, indices) = self._distinctTerms(analogy_embs)
+        rows = self._row_cache.rows(vectors, keys=keys)
+        return (rows[indices[0]], rows[indices[1]], rows[indices[2]])
+
+    def _scoreFromRows(self, mode, rows, analogy_embs, norms=None):
+        '''Returns the candidate scores for mode, derived from the
+        similarity rows of a, b and c (which are left unchanged); if the
+        rows only cover some candidates, norms gives their original norms
+        '''
+        (a_dots, b_dots, c_dots) = rows
+        if mode == Mode.ThreeCosAdd:
+            dist = b_dots - a_dots
+            dist += c_dots
+        elif mode == Mode.PairwiseDistance:
+            dist = self._pairwiseDistance(analogy_embs[:,0,:], analogy_embs[:,1,:], analogy_embs[:,2,:], rows=rows, norms=norms)
+        elif mode == Mode.ThreeCosMul:
+            inv_norms = lambda i: 1. / np.linalg.norm(analogy_embs[:,i,:], axis=1, keepdims=True)
+            dist = self._threeCosMul(a_dots * inv_norms(0), b_dots * inv_norms(1), c_dots * inv_norms(2))
+        return dist
+
+    def _threeCosMul(self, a_cos, b_cos, c_cos):
+        '''Combines the cosine similarities of unit-normed a, b and c into
+        3CosMul scores; overwrites the given matrices
+        '''
+        a_cos += 0.000001
+        dist = b_cos
+        dist *= c_cos
+        dist /= a_cos
+        return dist
+
+    def _pairwiseDistance(self, analogy_a, analogy_b, analogy_c, rows, norms=None):
+        '''Calculates cos(b-a, v-c) for each candidate v at its original
+        scale (the unit-normed candidate times its norm), expanded into dot
+        products of the similarity rows of a, b and c, so that the (vocab x
+        dim) offsets v-c are never built; norms are those of the
+        candidates the rows cover, if not all of them
+        '''
+        if norms is None: norms = self._norms
+        example_offsets = analogy_b - analogy_a
+        example_norms = np.linalg.norm(example_offsets, axis=1)[:, np.newaxis]
+        c_sq_norms = np.einsum('ij,ij->i', analogy_c, analogy_c)[:, np.newaxis]
+
+        # (b-a).(v-c) = |v|((b-a).u) - (b-a).c, for unit-normed candidate u
+        (a_dots, b_dots, c_dots) = rows
+        dist = b_dots - a_dots
+        dist *= norms
+        dist -= np.einsum('ij,ij->i', example_offsets, analogy_c)[:, np.newaxis]
+
+        # |v-c|^2 = |v|^2 - 2|v|(u.c) + |c|^2
+        query_sq_norms = c_dots * (-2 * norms)
+        sq_norms = norms * norms
+        query_sq_norms += sq_norms
+        query_sq_norms += c_sq_norms
+        # candidates (numerically) identical to c have no offset; rank them last
+        identical = query_sq_norms <= self._identical_tolerance * (sq_norms + c_sq_norms)
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            dist /= np.sqrt(np.maximum(query_sq_norms, 0), out=query_sq_norms)
+            dist /= example_norms
+        dist[identical | np.isnan(dist)] = -np.inf
+        return dist
+
+    def _tracksAnswers(self):
+        return self._tile_size is not None
+
+    def _scoringWidth(self):
+        return min(self._tile_size or self._vocab_size, self._vocab_size)
+
+    def dtype(self):
+        return self._embeds.dtype
+
+    def _rank(self, analogy_embs, depth):
+        if self._full_sort:
+            return AnalogyModel._rank(self, analogy_embs, depth)
+        dists = self._scoreBatch(np.asarray(analogy_embs, dtype=self._embeds.dtype))
+        return self._topK(dists, depth), dists
+
+    def _rankModes(self, analogy_embs, depth, modes, answers=None):
+        '''Yields (mode, ranked indices, scores) for each of modes; for
+        anything but this model's own mode alone, the scores are derived
+        from similarity rows of a, b and c computed once for all modes
+        '''
+        if self._tile_size is not None:
+            yield from self._rankTiled(np.asarray(analogy_embs, dtype=self._embeds.dtype), depth, modes, answers)
+            return
+        if list(modes) == [self._mode]:
+            (ix, dists) = self._rank(analogy_embs, depth)
+            yield (self._mode, ix, dists)
+            return
+
+        analogy_embs = np.asarray(analogy_embs, dtype=self._embeds.dtype)
+        rows = self._similarityRows(analogy_embs)
+        for mode in modes:
+            dists = self._scoreFromRows(mode, rows, analogy_embs)
+            if self._full_sort:
+                yield (mode, np.argsort(-dists, axis=1, kind='stable'), None)
+            else:
+                yield (mode, self._topK(dists, depth), dists)
+
+    def _rankTiled(self, analogy_embs, depth, modes, answers, candidate_dots=None):
+        '''Yields (mode, ranked indices, _RankedAnswers) for each of modes,
+        scoring one tile of candidates at a time for all modes; answers
+        is the (batch x answers) matrix of candidates to find the ranks of,
+        and candidate_dots calculates similarities to the candidates (by
+        default, _candidateDots)
+        '''
+        if candidate_dots is None: candidate_dots = self._candidateDots
+        batch = len(analogy_embs)
+        depth = min(depth, self._vocab_size)
+        (_, vectors, indices) = self._distinctTerms(analogy_embs)
+        if answers is None: answers = np.full((batch, 0), -1, dtype=np.int64)
+        answer_ixes = np.where(answers >= 0, answers, 0)
+
+        # each answer is scored in its own tile; until then, candidates are
+        # counted against its provisional score, from the same products
+        # computed for it alone, and it is recounted if the two differ
+        answer_dists = self._provisionalScores(vectors, indices, analogy_embs, answer_ixes, modes, candidate_dots)
+        changed = np.zeros(answers.shape, dtype=bool)
+
+        top_ix = { mode: np.zeros((batch, 0), dtype=np.int64) for mode in modes }
+        top_dists = { mode: np.zeros((batch, 0), dtype=self._embeds.dtype) for mode in modes }
+        outscored = { mode: np.zeros(answers.shape, dtype=np.int64) for mode in modes }
+        for (start, stop, rows) in self._tileRows(vectors, indices, candidate_dots):
+            in_tile = np.nonzero((answer_ixes >= start) & (answer_ixes < stop))
+            for mode in modes:
+                dists = self._scoreFromRows(mode, rows, analogy_embs, norms=self._norms[start:stop])
+
+                # merge the tile's top candidates into the running top
+                tile_ix = self._topK(dists, min(depth, stop - start))
+                merged_ix = np.concatenate([top_ix[mode], tile_ix + start], axis=1)
+                merged_dists = np.concatenate([top_dists[mode], np.take_along_axis(dists, tile_ix, axis=1)], axis=1)
+                order = np.lexsort((merged_ix, -merged_dists), axis=1)[:, :depth]
+                top_ix[mode] = np.take_along_axis(merged_ix, order, axis=1)
+                top_dists[mode] = np.take_along_axis(merged_dists, order, axis=1)
+
+                tile_scores = dists[in_tile[0], answer_ixes[in_tile] - start]
+                provisional = answer_dists[mode][in_tile]
+                changed[in_tile] |= ~((tile_scores == provisional) | (np.isnan(tile_scores) & np.isnan(provisional)))
+                answer_dists[mode][in_tile] = tile_scores
+
+                outscored[mode] += self._countOutscoring(dists, start, answer_dists[mode], answer_ixes)
+
+        recount = np.flatnonzero((changed & (answers >= 0)).any(axis=1))
+        if len(recount) > 0:
+            (_, vectors, indices) = self._distinctTerms(analogy_embs[recount])
+            for mode in modes: outscored[mode][recount] = 0
+            for (start, stop, rows) in self._tileRows(vectors, indices, candidate_dots):
+                for mode in modes:
+                    dists = self._scoreFromRows(mode, rows, analogy_embs[recount], norms=self._norms[start:stop])
+                    outscored[mode][recount] += self._countOutscoring(dists, start, answer_dists[mode][recount], answer_ixes[recount])
+
+        for mode in modes:
+            ranks = np.where(answers >= 0, 1 + outscored[mode], 0)
+            yield (mode, top_ix[mode], _RankedAnswers(answers, ranks, top_dists[mode]))
+
+    def _candidateDots(self, vectors, candidates):
+        '''Returns the similarities of vectors to the candidates selected by
+        candidates (a slice or array of indices), as scored in tiles
+        '''
+        return similarityRows(vectors, self._embeds[candidates])
+
+    def _tileRows(self, vectors, indices, candidate_dots):
+        '''Yields (start, stop, similarity rows of a, b and c) for each tile
+        of candidates, from the distinct term vectors of a batch (see
+        _distinctTerms)
+        '''
+        for start in range(0, self._vocab_size, self._tile_size):
+            stop = min(start + self._tile_size, self._vocab_size)
+            tile_dots = candidate_dots(vectors, slice(start, stop))
+            yield (start, stop, (tile_dots[indices[0]], tile_dots[indices[1]], tile_dots[indices[2]]))
+
+    def _provisionalScores(self, vectors, indices, analogy_embs, answer_ixes, modes, candidate_dots):
+        '''Returns { mode : (batch x answers) scores of answer_ixes }, with
+        the answers scored on their own
+        '''
+        (unique_answers, answer_columns) = np.unique(answer_ixes, return_inverse=True)
+        answer_columns = answer_columns.reshape(answer_ixes.shape)
+        answer_dots = candidate_dots(vectors, unique_answers)
+        answer_rows = tuple(np.take_along_axis(answer_dots[indices[i]], answer_columns, axis=1) for i in range(3))
+        return {
+            mode: self._scoreFromRows(mode, answer_rows, analogy_embs, norms=self._norms[answer_ixes])
+                for mode in modes
+        }
+
+    def _countOutscoring(self, dists, start, answer_dists, answer_ixes):
+        '''Returns the (batch x answers) number of candidates in a tile
+        (starting at start) ranked above each answer; as in _answerRanks,
+        ties go to the lower index
+        '''
+        candidates = np.arange(start, start + dists.shape[1])
+        counts = np.zeros(answer_ixes.shape, dtype=np.int64)
+        for j in range(answer_ixes.shape[1]):
+            answer_dist = answer_dists[:, j:j+1]
+            answer_ix = answer_ixes[:, j:j+1]
+            counts[:, j] = np.count_nonzero(
+                ((dists > answer_dist) & (candidates != answer_ix)) |
+                ((dists == answer_dist) & (candidates < answer_ix)),
+                axis=1
+            )
+        return counts
+
+    def _topScores(self, dists, top_ix):
+        if isinstance(dists, _RankedAnswers):
+            return dists.top_dists[:, :top_ix.shape[1]]
+        return AnalogyModel._topScores(self, dists, top_ix)
+
+    def _topK(self, dists, k):
+        '''Returns the indices of the k highest-scoring candidates for each
+        query, in ranked order (ties broken by lower index)
+        '''
+        if k >= dists.shape[1]:
+            return np.argsort(-dists, axis=1, kind='stable')
+        top_ix = np.argpartition(-dists, k-1, axis=1)[:, :k]
+        top_dists = np.take_along_axis(dists, top_ix, axis=1)
+        order = np.lexsort((top_ix, -top_dists), axis=1)
+        top_ix = np.take_along_axis(top_ix, order, axis=1)
+
+        # argpartition picks arbitrarily among candidates tied at the
+        # cutoff; fall back to a stable sort for the (rare) rows with ties
+        cutoff = np.take_along_axis(dists, top_ix[:, -1:], axis=1)
+        tied_rows = np.flatnonzero(np.count_nonzero(dists >= cutoff, axis=1) > k)
+        for row in tied_rows:
+            top_ix[row] = np.argsort(-dists[row], kind='stable')[:k]
+        return top_ix
+
+    def _answerRanks(self, dists, answers):
+        '''Returns the (1-based) rank of each answer in the full ranking
+        of candidates, or 0 for padding entries (-1/-2)
+        '''
+        if isinstance(dists, _RankedAnswers):
+            return dists.answerRanks(answers)
+        rows = np.arange(dists.shape[0])
+        candidates = np.arange(self._vocab_size)
+        ranks = np.zeros(answers.shape, dtype=np.int64)
+        for j in range(answers.shape[1]):
+            valid = answers[:, j] >= 0
+            if not valid.any(): continue
+            answer_ix = np.where(valid, answers[:, j], 0)
+            answer_dists = dists[rows, answer_ix][:, np.newaxis]
+            outscored = np.count_nonzero(dists > answer_dists, axis=1)
+            tied = np.count_nonzero(
+                (dists == answer_dists) & (candidates < answer_ix[:, np.newaxis]),
+                axis=1
+            )
+            ranks[:, j] = np.where(valid, 1 + outscored + tied, 0)
+        return ranks
+
+    def _predict(self, analogy_embs):
+        dists = self._scoreBatch(np.asarray(analogy_embs, dtype=self._embeds.dtype))
+        # stable sort breaks ties by lower index, as tf.nn.top_k does
+        idx = np.argsort(-dists, axis=1, kind='stable')
+        dists = np.take_along_axis(dists, idx, axis=1)
+        return dists, idx
+
+class _RankedAnswers:
+    '''Stands in for the (batch x vocab) scores of tiled ranking (see
+    NumpyAnalogyModel._rankTiled): the ranks of the tracked answers of
+    each query, and the scores of its top ranked candidates
+    '''
+
+    def __init__(self, answers, ranks, top_dists):
+        self.answers = answers
+        self.ranks = ranks
+        self.top_dists = top_dists
+
+    def __getitem__(self, rows):
+        return _RankedAnswers(self.answers[rows], self.ranks[rows], self.top_dists[rows])
+
+    def answerRanks(self, answers):
+        '''Returns the ranks of answers (a subset of each query's tracked
+        answers), or 0 for padding entries
+        '''
+        matches = (answers[:, :, np.newaxis] == self.answers[:, np.newaxis, :]) & (answers[:, :, np.newaxis] >= 0)
+        return (matches * self.ranks[:, np.newaxis, :]).sum(axis=2)
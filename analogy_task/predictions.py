@@ -0,0 +1,171 @@
+'''
+Predictions for individual analogies, and writing them to disk.
+
+Predictions are written by a background thread as each relation is
+completed, either as text (the original verbose format) or in a binary
+format: a directory holding one .npz file of arrays per relation, along
+with a single vocabulary file (vocab.txt, one term per line) that the
+indices in them refer to.
+'''
+import os
+import queue
+import codecs
+import threading
+import numpy as np
+from lib import log
+
+class Format:
+    Text = 'text'
+    Binary = 'npz'
+
+class RelationPredictions:
+    '''Predictions for the analogies of one relation under one setting:
+        analogies  :: the (string) analogies, as read by BMASS.parser
+        ixes       :: (analogies x 3+answers) matrix of the vocabulary
+                      indices of a, b, c and the answers (see
+                      task.convertAnalogyToMatrices)
+        correct    :: Boolean array of correct predictions
+        candidates :: number of candidates ranked for each analogy (-1
+                      if skipped)
+        top_k      :: (analogies x k) matrix of top predicted indices
+        scores     :: (analogies x k) matrix of their scores (NaN if
+                      the scoring backend does not report them)
+    '''
+
+    def __init__(self, analogies, ixes, correct, candidates, top_k, scores):
+        self.analogies = analogies
+        self.ixes = ixes
+        self.correct = correct
+        self.candidates = candidates
+        self.top_k = top_k
+        self.scores = scores
+
+    def __len__(self):
+        return len(self.analogies)
+
+    def strings(self, vocab):
+        '''Returns [ ((a, b, c, d), correct, number of candidates, [top k terms]) ]
+        '''
+        predictions = []
+        for i in range(len(self.analogies)):
+            if self.candidates[i] < 0:
+                predicted = ['>>> SKIPPED <<<']
+            else:
+                predicted = [vocab[ix] for ix in self.top_k[i]]
+            predictions.append((self.analogies[i], bool(self.correct[i]), int(self.candidates[i]), predicted))
+        return predictions
+
+class PredictionsWriter:
+    '''Writes the predictions of each relation (see write) to fname from a
+    background thread, through a buffer of buffer_size bytes; for the
+    binary format, fname is the directory to write to.  Call close() to
+    finish writing, or use the writer as a context manager.
+
+    An error in the writing thread is raised (as an IOError, from the
+    original) by the next call to write or close.
+    '''
+
+    def __init__(self, fname, vocab, format=Format.Text, mode='w', setting=None, buffer_size=1<<24, max_queued=16):
+        self._fname = fname
+        self._vocab = vocab
+        self._format = format
+        self._setting = setting
+        self._error = None
+        self._closed = False
+        self._queue = queue.Queue(maxsize=max_queued)
+
+        if format == Format.Text:
+            self._stream = codecs.open(fname, mode, 'utf-8', buffering=buffer_size)
+        elif format == Format.Binary:
+            if not os.path.isdir(fname):
+                os.makedirs(fname)
+            self._stream = None
+        else:
+            raise ValueError('Unknown predictions format "%s"' % format)
+
+        self._thread = threading.Thread(target=self._run)
+        self._thread.start()
+        if format == Format.Binary:
+            self._queue.put((self._writeVocab, ()))
+
+    def write(self, relation, predictions):
+        '''Queues the RelationPredictions for relation to be written
+        '''
+        self._checkError()
+        if self._format == Format.Text:
+            self._queue.put((self._writeText, (relation, predictions)))
+        else:
+            self._queue.put((self._writeBinary, (relation, predictions)))
+
+    def close(self):
+        '''Waits for the queued predictions to be written and closes the
+        file; safe to call more than once
+        '''
+        if not self._closed:
+            self._closed = True
+            self._queue.put(None)
+            self._thread.join()
+            if self._stream is not None:
+                self._stream.close()
+        self._checkError()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # don't mask an error raised in the with block with a writing error
+        if exc_type is None:
+            self.close()
+        else:
+            try:
+                self.close()
+            except IOError:
+                pass
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            # after an error, keep draining the queue so that writers never block
+            if self._error is None:
+                (fn, args) = item
+                try:
+                    with log.span('write'):
+                        fn(*args)
+                except Exception as e:
+                    self._error = e
+
+    def _checkError(self):
+        if self._error is not None:
+            raise IOError('Failed writing predictions to %s: %s' % (self._fname, self._error)) from self._error
+
+    def _writeText(self, relation, predictions):
+        chunks = [('{0}\n  %s\n{0}\n'.format('-'*79)) % relation]
+        for ((a,b,c,d), is_correct, num_candidates, top_k) in predictions.strings(self._vocab):
+            chunks.append('\n%s:%s::%s:%s\nCorrect: %s\nPredictions: %d\n%s\n' % (
+                a,b,c,d,
+                str(is_correct),
+                num_candidates,
+                '\n'.join([('    %s' % guess) for guess in top_k])
+            ))
+        self._stream.write(''.join(chunks))
+
+    def _writeVocab(self):
+        with codecs.open(os.path.join(self._fname, 'vocab.txt'), 'w', 'utf-8') as stream:
+            stream.write(''.join('%s\n' % term for term in self._vocab))
+
+    def _writeBinary(self, relation, predictions):
+        # relation names may contain path separators
+        fname = os.path.join(self._fname, '%s.npz' % relation.replace(': ', '-').replace(os.sep, '_'))
+        arrays = {
+            'relation': np.array(relation),
+            'ixes': np.asarray(predictions.ixes, dtype=np.int32),
+            'correct': predictions.correct,
+            'candidates': predictions.candidates,
+            'top_k': predictions.top_k,
+            'scores': predictions.scores,
+        }
+        if self._setting is not None:
+            arrays['setting'] = np.array(self._setting)
+        np.savez(fname, **arrays)
@@ -0,0 +1,209 @@
+'''
+Analogy completion scored against a quantized (float16 or int8) copy of
+the candidate matrix, with exact re-ranking of the top candidates.
+'''
+import numpy as np
+from analogy_task.analogy_model import Mode
+from analogy_task.numpy_model import NumpyAnalogyModel, _RankedAnswers
+from analogy_task.row_cache import similarityRows
+from lib.ir_metrics import BatchAccuracy
+
+class Precision:
+    Float16 = 'float16'
+    # per-row scaled
+    Int8 = 'int8'
+
+def quantize(embed_array, precision):
+    '''Returns (quantized matrix, per-row scales or None) for embed_array
+    '''
+    if precision == Precision.Float16:
+        return (embed_array.astype(np.float16), None)
+    elif precision == Precision.Int8:
+        scales = np.abs(embed_array).max(axis=1) / 127.
+        scales[scales == 0] = 1
+        quantized = np.rint(embed_array / scales[:, np.newaxis]).astype(np.int8)
+        return (quantized, scales.astype(np.float32))
+    else:
+        raise ValueError('Unknown quantization precision "%s"' % precision)
+
+class QuantizedAnalogyModel(NumpyAnalogyModel):
+    '''
+    Scores every candidate against a quantized copy of the (unit-normed)
+    candidate matrix, then re-scores the top rerank_depth candidates of
+    each query exactly, from their full-precision embeddings.  Rankings
+    hold the exact order of those candidates; an answer among them is
+    ranked by its place in that order, and any other by its approximate
+    score (which puts it beyond them).
+
+    The quantized matrix is scored in tiles of tile_bytes (as float32),
+    keeping a running top of each ranking (see NumpyAnalogyModel).  No
+    full-precision copy of the candidates is kept: shortlisted ones are
+    gathered from embed_array as given (and normed as they are read, if
+    normed is False), so it can be left memory-mapped.  Shortlists are
+    re-ranked for as many queries at once as have similarity rows to
+    their gathered candidates within gather_bytes.
+
+    To measure what is lost, the first check_sample queries of each
+    evaluation are also ranked exactly, and the analogies they answer for
+    which the answer ranks or correctness differ are counted (see
+    scoringStats).
+    '''
+
+    def __init__(self, embed_array, mode=Mode.ThreeCosAdd, normed=False, norms=None, precision=Precision.Int8,
+            rerank_depth=100, check_sample=20, tile_bytes=1<<24, gather_bytes=1<<26):
+        embed_array = np.asarray(embed_array)
+        if not embed_array.dtype in [np.float32, np.float64]:
+            embed_array = embed_array.astype(np.float32)
+        tile_rows = max(1, tile_bytes // (4 * embed_array.shape[1]))
+        tiles = [slice(start, start + tile_rows) for start in range(0, embed_array.shape[0], tile_rows)]
+
+        # norms of the candidates as given, to divide them by as they are read
+        if normed:
+            self._row_norms = None
+        else:
+            row_norms = np.concatenate([np.linalg.norm(embed_array[tile], axis=1) for tile in tiles])
+            if norms is None: norms = row_norms
+            self._row_norms = np.where(row_norms > 0, row_norms, 1)
+        NumpyAnalogyModel.__init__(self, embed_array, mode=mode, normed=True, norms=norms, row_cache_bytes=0,
+            tile_size=tile_rows)
+
+        self._precision = precision
+        quantized = [quantize(self._exactRows(tile), precision) for tile in tiles]
+        self._quantized = np.concatenate([tile_quantized for (tile_quantized, _) in quantized])
+        self._scales = np.concatenate([scales for (_, scales) in quantized]) if precision == Precision.Int8 else None
+        self._rerank_depth = rerank_depth
+        self._check_sample = check_sample
+        self._gather_bytes = gather_bytes
+        self._checked = {}
+        self._ranks_differ = {}
+        self._correct_differs = {}
+
+    def precision(self):
+        return self._precision
+
+    def nbytes(self):
+        '''Returns the size of the quantized candidate matrix (and scales)
+        '''
+        return self._quantized.nbytes + (self._scales.nbytes if self._scales is not None else 0)
+
+    def queryBytes(self):
+        # plus the exact similarity rows, scores and order of each query's shortlist
+        return NumpyAnalogyModel.queryBytes(self) + min(self._vocab_size, self._rerank_depth) * (6 * self._embeds.dtype.itemsize + 16)
+
+    def scoringStats(self):
+        stats = NumpyAnalogyModel.scoringStats(self)
+        for mode in self._checked.keys():
+            stats[('quantized_checked', mode)] = self._checked[mode]
+            stats[('quantized_ranks_differ', mode)] = self._ranks_differ[mode]
+            stats[('quantized_correct_differs', mode)] = self._correct_differs[mode]
+        return stats
+
+    def evalMethods(self, query_embeds, analogy_sets, modes, batch_size=500, max_scoring_bytes=None, report_top_k=5, log=None):
+        results = NumpyAnalogyModel.evalMethods(self, query_embeds, analogy_sets, modes,
+            batch_size=batch_size, max_scoring_bytes=max_scoring_bytes, report_top_k=report_top_k, log=log)
+        num_checked = min(self._check_sample, len(query_embeds))
+        if num_checked > 0:
+            self._countDifferences(np.asarray(query_embeds[:num_checked], dtype=self._embeds.dtype), analogy_sets, modes)
+        return results
+
+    def _rank(self, analogy_embs, depth):
+        ((_, ix, scores),) = self._rankModes(analogy_embs, depth, [self._mode])
+        return ix, scores
+
+    def _rankModes(self, analogy_embs, depth, modes, answers=None):
+        '''Yields (mode, ranked indices, _RankedAnswers) for each of modes,
+        where the top candidates by quantized scoring are ranked exactly
+        '''
+        analogy_embs = np.asarray(analogy_embs, dtype=self._embeds.dtype)
+        width = min(self._vocab_size, max(depth, self._rerank_depth))
+        for (mode, shortlist, approximate) in self._rankTiled(analogy_embs, width, modes, answers):
+            (ix, dists) = self._rerank(mode, analogy_embs, shortlist)
+
+            # answers in the shortlist are ranked by their exact place in it
+            matches = ix[:, np.newaxis, :] == approximate.answers[:, :, np.newaxis]
+            ranks = np.where(matches.any(axis=2), matches.argmax(axis=2) + 1, approximate.ranks)
+            ranks[approximate.answers < 0] = 0
+            yield (mode, ix, _RankedAnswers(approximate.answers, ranks, dists))
+
+    def _rerank(self, mode, analogy_embs, shortlist):
+        '''Returns (shortlist, scores) for each query, in exact order of
+        its shortlisted candidates; ties are broken by lower index, as in
+        exact ranking
+        '''
+        ranked = np.empty_like(shortlist)
+        ranked_dists = np.empty(shortlist.shape, dtype=self._embeds.dtype)
+        # queries at a time whose (up to 3 x queries x width) rows fit in gather_bytes
+        chunk_size = max(1, int(np.sqrt(self._gather_bytes / (3. * shortlist.shape[1] * self._embeds.dtype.itemsize))))
+        for start in range(0, len(shortlist), chunk_size):
+            stop = min(start + chunk_size, len(shortlist))
+            (chunk_embs, chunk) = (analogy_embs[start:stop], shortlist[start:stop])
+
+            # similarities of the chunk's distinct terms to all of its shortlisted candidates
+            (_, vectors, indices) = self._distinctTerms(chunk_embs)
+            (columns, positions) = np.unique(chunk, return_inverse=True)
+            positions = positions.reshape(chunk.shape)
+            dots = self._exactDots(vectors, columns)
+            rows = tuple(np.take_along_axis(dots[indices[i]], positions, axis=1) for i in range(3))
+
+            dists = self._scoreFromRows(mode, rows, chunk_embs, norms=self._norms[chunk])
+            order = np.lexsort((chunk, -dists), axis=1)
+            ranked[start:stop] = np.take_along_axis(chunk, order, axis=1)
+            ranked_dists[start:stop] = np.take_along_axis(dists, order, axis=1)
+        return (ranked, ranked_dists)
+
+    def _exactRows(self, candidates):
+        '''Returns the unit-normed full-precision embeddings of candidates
+        (a slice or array of indices)
+        '''
+        rows = self._embeds[candidates]
+        if self._row_norms is not None:
+            rows = rows / self._row_norms[candidates][:, np.newaxis]
+        return rows
+
+    def _exactDots(self, vectors, candidates):
+        return similarityRows(vectors, self._exactRows(candidates))
+
+    def _candidateDots(self, vectors, candidates):
+        '''Returns the similarities of vectors to the quantized candidates
+        (see NumpyAnalogyModel._candidateDots), in float32
+        '''
+        tile = self._quantized[candidates].astype(np.float32)
+        if self._scales is not None:
+            tile *= self._scales[candidates][:, np.newaxis]
+        return similarityRows(vectors, tile)
+
+    def _countDifferences(self, analogy_embs, analogy_sets, modes):
+        '''Counts the analogies answered by analogy_embs (the first queries)
+        whose answer ranks or correctness differ between quantized and
+        exact scoring
+        '''
+        depth = 4
+        sets = []
+        for (analogies, query_ixes) in analogy_sets:
+            analogies = np.array(analogies, dtype=np.int32)
+            if analogies.size == 0: continue
+            query_ixes = np.asarray(query_ixes, dtype=np.int64)
+            order = np.argsort(query_ixes, kind='stable')
+            sets.append((analogies, query_ixes, order, query_ixes[order]))
+        answers = self._batchAnswers(sets, 0, len(analogy_embs))
+
+        approximate = { mode: (ix, ranked) for (mode, ix, ranked) in self._rankModes(analogy_embs, depth, modes, answers) }
+        exact = { mode: (ix, ranked) for (mode, ix, ranked) in
+            self._rankTiled(analogy_embs, depth, modes, answers, candidate_dots=self._exactDots) }
+        for mode in modes:
+            (exact_ix, exact_ranked) = exact[mode]
+            (approx_ix, approx_ranked) = approximate[mode]
+            for (analogies, query_ixes, _, _) in sets:
+                checked = (query_ixes < len(analogy_embs)) & (analogies[:, 3:] >= 0).any(axis=1)
+                if not checked.any(): continue
+                (sub_ixes, sub_queries) = (analogies[checked], query_ixes[checked])
+                answers = sub_ixes[:, 3:]
+
+                ranks_differ = (self._answerRanks(exact_ranked[sub_queries], answers) !=
+                    self._answerRanks(approx_ranked[sub_queries], answers)).any(axis=1)
+                correct_differs = (BatchAccuracy(answers, exact_ix[sub_queries], exclude=sub_ixes[:, :3]) !=
+                    BatchAccuracy(answers, approx_ix[sub_queries], exclude=sub_ixes[:, :3]))
+
+                self._checked[mode] = self._checked.get(mode, 0) + len(sub_ixes)
+                self._ranks_differ[mode] = self._ranks_differ.get(mode, 0) + int(np.count_nonzero(ranks_differ))
+                self._correct_differs[mode] = self._correct_differs.get(mode, 0) + int(np.count_nonzero(correct_differs))
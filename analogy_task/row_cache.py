@@ -0,0 +1,94 @@
+'''
+Cache of the similarity rows of analogy query terms against the
+candidate vocabulary.
+
+BMASS relations are built from all pairs of a few dozen term pairs, so
+the same a, b and c terms recur across many analogies; the similarity
+row of each distinct term only needs to be calculated once.
+'''
+import collections
+import numpy as np
+
+# similarity rows are calculated this many at a time (padded with zeros),
+# against at least this many candidates (likewise), as BLAS takes other
+# code paths for single rows and narrow matrices; each row then comes
+# out the same whichever other rows and candidates it is calculated with
+ROW_BLOCK = 32
+MIN_COLUMNS = 64
+
+def similarityRows(vectors, embeds):
+    '''Returns the (len(vectors) x len(embeds)) matrix of dot products of
+    vectors with the rows of embeds, calculating each row the same way
+    regardless of the other vectors and candidates (see ROW_BLOCK)
+    '''
+    vectors = np.asarray(vectors, dtype=embeds.dtype)
+    (num_rows, num_columns) = (len(vectors), embeds.shape[0])
+    rows = np.empty((num_rows, num_columns), dtype=embeds.dtype)
+    if num_columns < MIN_COLUMNS:
+        embeds = np.concatenate([embeds, np.zeros((MIN_COLUMNS - num_columns, embeds.shape[1]), dtype=embeds.dtype)])
+    block = np.zeros((ROW_BLOCK, embeds.shape[1]), dtype=embeds.dtype)
+    for start in range(0, num_rows, ROW_BLOCK):
+        stop = min(start + ROW_BLOCK, num_rows)
+        block[:stop-start] = vectors[start:stop]
+        block[stop-start:] = 0
+        rows[start:stop] = np.dot(block, embeds.T)[:stop-start, :num_columns]
+    return rows
+
+class SimilarityRowCache:
+    '''LRU cache of (term vector . candidate matrix) rows, keyed by the
+    bytes of the term vector, holding at most max_bytes of rows.  With
+    max_bytes=0, nothing is kept between calls to rows().
+    '''
+
+    def __init__(self, embeds, max_bytes=1<<28):
+        self._embeds = embeds
+        self._max_bytes = max_bytes
+        self._rows = collections.OrderedDict()
+        self._nbytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def rows(self, vectors, keys=None):
+        '''Returns the (len(vectors) x vocab) similarity rows of a matrix
+        of distinct term vectors (with their keys, if already known)
+        '''
+        vectors = np.asarray(vectors, dtype=self._embeds.dtype)
+        if keys is None: keys = self.keys(vectors)
+        rows = np.empty((len(vectors), self._embeds.shape[0]), dtype=self._embeds.dtype)
+
+        missing = []
+        for i in range(len(keys)):
+            cached = self._rows.get(keys[i], None)
+            if cached is None:
+                missing.append(i)
+            else:
+                self._rows.move_to_end(keys[i])
+                rows[i] = cached
+        self.hits += len(keys) - len(missing)
+        self.misses += len(missing)
+
+        if len(missing) > 0:
+            rows[missing] = similarityRows(vectors[missing], self._embeds)
+            for i in missing:
+                self._store(keys[i], rows[i].copy())
+        return rows
+
+    def keys(self, vectors):
+        return [vector.tobytes() for vector in vectors]
+
+    def nbytes(self):
+        return self._nbytes
+
+    def clear(self):
+        self._rows.clear()
+        self._nbytes = 0
+
+    def _store(self, key, row):
+        if row.nbytes > self._max_bytes:
+            return
+        self._rows[key] = row
+        self._nbytes += row.nbytes
+        # evict least recently used rows until back within the limit
+        while self._nbytes > self._max_bytes:
+            (_, evicted) = self._rows.popitem(last=False)
+            self._nbytes -= evicted.nbytes
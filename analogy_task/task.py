@@ -2,52 +2,118 @@
 Run trained embeddings through generated analogy task.
 '''
 
-import codecs
-import tensorflow as tf
+import os
+import contextlib
+import collections
+import multiprocessing
+import numpy as np
 from BMASS import parser, settings
-from analogy_task.analogy_model import AnalogyModel
-from lib import log
-
-def completeAnalogySet(str_analogies, setting, emb_wrapper, grph, report_top_k=5, log=log):
-    analogies, embedded_analogies, kept_str_analogies = [], [], []
-
-    # if using multi_answer, find the maximum number of answers for any analogy in this set
-    if setting in [settings.ALL_INFO, settings.MULTI_ANSWER]:
-        max_answers = 0
-        for analogy in str_analogies:
-            max_answers = max(max_answers, len(analogy[3]))
-
-    # convert analogies to a matrix of indices and a matrix of embeddings
-    log.track(message='  >> Preprocessing: {0}/%d' % len(str_analogies), writeInterval=50)
-    for analogy in str_analogies:
-        valid, analogy_ixes, analogy_embeds = convertAnalogyToMatrices(analogy, setting, emb_wrapper, max_answers)
-
-        if valid:
-            analogies.append(analogy_ixes)
-            embedded_analogies.append(analogy_embeds)
-            kept_str_analogies.append(analogy)
-        log.tick()
-    log.flushTracker()
+from analogy_task.analogy_model import AnalogyModel, Backend, Mode, modeName
+from analogy_task.numpy_model import NumpyAnalogyModel
+from analogy_task.ivf_model import IVFAnalogyModel
+from analogy_task.quantized_model import QuantizedAnalogyModel
+from analogy_task.predictions import Format, RelationPredictions, PredictionsWriter
+from lib import log, util
+from lib.logging import ProgressTracker
+
+# backends built on NumpyAnalogyModel, which can score several methods at
+# once and be shared with forked workers
+_numpy_backends = [Backend.NumPy, Backend.IVF, Backend.Quantized]
 
-    correct, MAP, MRR, total, skipped, predictions = grph.eval(analogies, embedded_analogies, report_top_k=report_top_k, log=log)
-    log.flushTracker(len(analogies))
+def buildModel(embed_array, mode=Mode.ThreeCosAdd, backend=Backend.NumPy, normed=False, norms=None, row_cache_bytes=1<<28,
+        ivf_options=None, quantized_options=None, tile_size=None):
+    '''Builds the analogy completion model for the chosen scoring backend
+    (norms gives the original norms of normed candidates, for
+    PairwiseDistance; row_cache_bytes bounds the NumPy model's similarity
+    row cache, and tile_size sets the number of candidates it scores at a
+    time; ivf_options and quantized_options are passed on to
+    IVFAnalogyModel and QuantizedAnalogyModel)
+    '''
+    if backend == Backend.NumPy:
+        return NumpyAnalogyModel(embed_array, mode=mode, normed=normed, norms=norms, row_cache_bytes=row_cache_bytes,
+            tile_size=tile_size)
+    elif backend == Backend.IVF:
+        return IVFAnalogyModel(embed_array, mode=mode, normed=normed, norms=norms, row_cache_bytes=row_cache_bytes,
+            **(ivf_options or {}))
+    elif backend == Backend.Quantized:
+        return QuantizedAnalogyModel(embed_array, mode=mode, normed=normed, norms=norms, **(quantized_options or {}))
+    elif backend == Backend.TensorFlow:
+        import tensorflow as tf
+        # the graph norms candidates itself, and needs them at their original scale for PairwiseDistance
+        if norms is not None: embed_array = embed_array * np.asarray(norms)[:, np.newaxis]
+        return AnalogyModel(tf.Session(), embed_array, mode=mode)
+    else:
+        raise ValueError('Unknown scoring backend "%s"' % backend)
 
-    str_predictions = []
-    for i in range(len(predictions)):
-        (is_correct, num_candidates, predicted_ixes) = predictions[i]
+def completeAnalogySet(str_analogies, setting, emb_wrapper, grph, **kwargs):
+    '''Completes the analogies of one relation under one setting, with the
+    model's own analogy method (see completeAnalogyMethods); returns
+    (correct, MAP, MRR, total, skipped, predictions)
+    '''
+    return completeAnalogyMethods({ setting: str_analogies }, emb_wrapper, grph, [grph.mode()], **kwargs)[grph.mode()][setting]
 
-        if len(predicted_ixes) > 1:
-            predicted_strings = [emb_wrapper.indexToTerm(ix) for ix in predicted_ixes]
-        elif predicted_ixes[0] == -1:
-            predicted_strings = ['>>> SKIPPED <<<']
+def completeAnalogySettings(str_analogies, emb_wrapper, grph, **kwargs):
+    '''Completes the analogies of one relation under several settings,
+    with the model's own analogy method (see completeAnalogyMethods);
+    returns { setting : (correct, MAP, MRR, total, skipped, predictions) }
+    '''
+    return completeAnalogyMethods(str_analogies, emb_wrapper, grph, [grph.mode()], **kwargs)[grph.mode()]
 
-        str_predictions.append((
-            kept_str_analogies[i],
-            is_correct,
-            num_candidates,
-            predicted_strings
-        ))
-    return (correct, MAP, MRR, total, skipped, str_predictions)
+def completeAnalogyMethods(str_analogies, emb_wrapper, grph, modes, report_top_k=5, log=log, max_scoring_bytes=None):
+    '''Completes the analogies of one relation under several settings,
+    given as { setting : analogies }, ranking each query with each of the
+    analogy methods in modes (see AnalogyModel.evalMethods), in batches
+    that fit in max_scoring_bytes, if given; each distinct a:b::c query is
+    scored once, and shared between all the settings that ask it.
+
+    Returns { mode : { setting : (correct, MAP, MRR, total, skipped, predictions) } },
+    with the predictions for each analogy as a RelationPredictions.
+    '''
+    query_ixes, query_embeds, analogy_sets, kept_str_analogies = {}, [], [], {}
+
+    total = sum(len(set_analogies) for set_analogies in str_analogies.values())
+    log.track(total=total, message='  >> Preprocessing: {current}/{total} ({rate:.0f} analogies/s, ETA {eta})')
+    with log.span('preprocess'):
+        for (setting, set_analogies) in str_analogies.items():
+            analogies, analogy_query_ixes, kept_str_analogies[setting] = [], [], []
+
+            # if using multi_answer, find the maximum number of answers for any analogy in this set
+            max_answers = 1
+            if setting in [settings.ALL_INFO, settings.MULTI_ANSWER]:
+                max_answers = 0
+                for analogy in set_analogies:
+                    max_answers = max(max_answers, len(analogy[3]))
+
+            # convert analogies to a matrix of indices and a matrix of embeddings
+            for analogy in set_analogies:
+                valid, analogy_ixes, analogy_embeds = convertAnalogyToMatrices(analogy, setting, emb_wrapper, max_answers)
+
+                if valid:
+                    # the query embedding depends only on a, c and the b term(s)
+                    query = (analogy[0], tuple(analogy[1]) if type(analogy[1]) is list else (analogy[1],), analogy[2])
+                    if not query in query_ixes:
+                        query_ixes[query] = len(query_embeds)
+                        query_embeds.append(analogy_embeds)
+                    analogies.append(analogy_ixes)
+                    analogy_query_ixes.append(query_ixes[query])
+                    kept_str_analogies[setting].append(analogy)
+                log.tick()
+            analogy_sets.append((analogies, analogy_query_ixes))
+    log.flushTracker()
+
+    all_set_results = grph.evalMethods(query_embeds, analogy_sets, modes, max_scoring_bytes=max_scoring_bytes,
+        report_top_k=report_top_k, log=log)
+    log.flushTracker(len(query_embeds))
+
+    results = { mode: {} for mode in modes }
+    for mode in modes:
+        for (setting, set_results, (analogies, _)) in zip(str_analogies.keys(), all_set_results[mode], analogy_sets):
+            (correct, MAP, MRR, total, skipped, (is_correct, num_candidates, top_k, top_scores)) = set_results
+            predictions = RelationPredictions(kept_str_analogies[setting],
+                (np.array(analogies, dtype=np.int32) if len(analogies) > 0 else np.zeros((0, 4), dtype=np.int32)),
+                is_correct, num_candidates, top_k, top_scores)
+            results[mode][setting] = (correct, MAP, MRR, total, skipped, predictions)
+    return results
 
 
 
@@ -125,42 +191,244 @@ def convertAnalogyToMatrices(analogy, setting, emb_wrapper, max_answers):
 
 
 
-def analogyTask(analogy_file, setting, emb_wrapper, log=log, report_top_k=5, predictions_file=None, predictions_file_mode='w'):
-    analogies = parser.read(analogy_file, setting, strings_only=True)
+def analogyTask(analogy_file, setting, emb_wrapper, mode=Mode.ThreeCosAdd, predictions_file=None, analogies=None, **kwargs):
+    '''Runs the analogy task on each relation in analogy_file, under one
+    setting and with one analogy method (see analogyMethodsTask, for the
+    other options); analogies and predictions_file are those for the
+    setting alone.  Returns
+    { relation : (correct, MAP, MRR, total, skipped, predictions) }
+    '''
+    return analogyMethodsTask({ setting: analogy_file }, emb_wrapper, [mode],
+        predictions_files=({ (mode, setting): predictions_file } if predictions_file else None),
+        analogies=({ setting: analogies } if analogies is not None else None), **kwargs)[mode][setting]
 
-    # if we're saving the predictions, start that file first
-    if predictions_file: pred_stream = codecs.open(predictions_file, predictions_file_mode, 'utf-8')
+def analogySettingsTask(analogy_files, emb_wrapper, mode=Mode.ThreeCosAdd, predictions_files=None, **kwargs):
+    '''Runs the analogy task for several settings at once, with one
+    analogy method (see analogyMethodsTask); predictions_files are given
+    as { setting : predictions file }.  Returns
+    { setting : { relation : (correct, MAP, MRR, total, skipped, predictions) } }
+    '''
+    if predictions_files is None: predictions_files = {}
+    return analogyMethodsTask(analogy_files, emb_wrapper, [mode],
+        predictions_files={ (mode, setting): predictions_file for (setting, predictions_file) in predictions_files.items() },
+        **kwargs)[mode]
 
-    # build the analogy completion model
-    sess = tf.Session()
-    grph = AnalogyModel(sess, emb_wrapper.asArray())
+def analogyMethodsTask(analogy_files, emb_wrapper, modes, log=log, report_top_k=5, predictions_files=None, predictions_file_mode='w',
+        backend=Backend.NumPy, workers=1, analogies=None, row_cache_bytes=1<<28, ivf_options=None, predictions_format=Format.Text,
+        quantized_options=None, tile_size=None, max_scoring_bytes=None):
+    '''Runs the analogy task on each relation in each of several
+    settings, given as { setting : analogy file } (and, optionally,
+    { setting : parsed analogies }, as read by BMASS.parser.read with
+    strings_only=True, so that files are not parsed again), ranking each
+    query with each of the analogy methods in modes.  Relations of the
+    same name are completed together, scoring each query they share only
+    once, and all methods are ranked from shared similarity rows
+    (NumPy-based backends only, for more than one method; see
+    completeAnalogyMethods).
 
-    completed, results = 0, {}
-    for (relation, rel_analogies) in analogies.items():
-        t_file = log.startTimer('  Starting relation: %s (%d/%d)' % (relation, completed+1, len(analogies)))
+    predictions_files are given as { (mode, setting) : predictions file },
+    and are written in predictions_format (see analogy_task.predictions)
+    by background threads, as each relation is completed.
 
-        rel_results = completeAnalogySet(rel_analogies, setting, emb_wrapper, grph, report_top_k, log=log)
-        results[relation] = rel_results
+    With workers > 1 (NumPy-based backends only), relations are
+    completed in a pool of forked processes, which share the embedding
+    matrix and model with this one rather than copying them; results are
+    still logged and written in relation order.
 
-        (correct, MAP, MRR, total, skipped, predictions) = rel_results
-        log.stopTimer(t_file, message='  Completed file: %s (%d/%d) [{0:.2f}s]\n    >> Skipped %d/%d' % (
-            relation, completed+1, len(analogies), skipped, total
-        ))
+    If max_scoring_bytes is given, queries are scored in batches sized to
+    fit in that much memory (per worker), rather than 500 at a time (see
+    AnalogyModel.evalMethods).  With the NumPy backend, the similarity
+    rows of repeated query terms are cached, up to row_cache_bytes in each
+    process, unless candidates are scored tile_size at a time (see
+    NumpyAnalogyModel).  With the IVF backend, the recall@k of the
+    approximate rankings is logged for each relation, and with the
+    quantized backend, how often the answer ranks and correctness of a
+    sample of analogies differ from exact scoring.
+
+    Returns { mode : { setting : { relation : (correct, MAP, MRR, total, skipped, predictions) } } }
+    '''
+    if len(modes) > 1 and not backend in _numpy_backends:
+        raise ValueError('Scoring several analogy methods at once needs one of the %s backends' % ', '.join(_numpy_backends))
+
+    if analogies is None: analogies = {}
+    analogies = {
+        setting: (analogies[setting] if setting in analogies else parser.read(analogy_file, setting, strings_only=True, use_cache=True))
+            for (setting, analogy_file) in analogy_files.items()
+    }
+    if predictions_files is None: predictions_files = {}
 
-        if predictions_file:
-            pred_stream.write(('{0}\n  %s\n{0}\n'.format('-'*79)) % relation)
-            for prediction in predictions:
-                ((a,b,c,d), is_correct, num_candidates, top_k) = prediction
-                pred_stream.write('\n%s:%s::%s:%s\nCorrect: %s\nPredictions: %d\n%s\n' % (
-                    a,b,c,d,
-                    str(is_correct),
-                    num_candidates,
-                    '\n'.join([('    %s' % guess) for guess in top_k])
+    # group the analogies of each relation, in order of first appearance
+    relations = {}
+    for (setting, set_analogies) in analogies.items():
+        for (relation, rel_analogies) in set_analogies.items():
+            if not relation in relations: relations[relation] = {}
+            relations[relation][setting] = rel_analogies
+
+    # if we're saving the predictions, start those files first (closed
+    # on the way out, even if completing the analogies fails)
+    with contextlib.ExitStack() as open_writers:
+        pred_writers = {
+            (mode, setting): open_writers.enter_context(PredictionsWriter(predictions_file, emb_wrapper.vocab(),
+                    format=predictions_format, mode=predictions_file_mode, setting=setting))
+                for ((mode, setting), predictions_file) in predictions_files.items() if predictions_file
+        }
+
+        # build the analogy completion model
+        t_sub = log.startTimer()
+        with log.span('model'):
+            grph = buildModel(emb_wrapper.asArray(), mode=modes[0], backend=backend, normed=True, norms=emb_wrapper.norms(),
+                row_cache_bytes=row_cache_bytes, ivf_options=ivf_options, quantized_options=quantized_options, tile_size=tile_size)
+        if backend == Backend.IVF:
+            log.stopTimer(t_sub, message='  Loaded IVF index: %d lists, up to %d candidates each ({0:.2f}s)' % (
+                grph.index().numLists(), grph.index().listSizes().max()))
+        elif backend == Backend.Quantized:
+            log.stopTimer(t_sub, message='  Quantized candidates to %s [%s] ({0:.2f}s)' % (
+                grph.precision(), util.formatBytes(grph.nbytes())))
+        if max_scoring_bytes is not None:
+            log.writeln('  Scoring up to %d queries per batch within %s (about %s each)' % (
+                grph.batchSize(max_scoring_bytes), util.formatBytes(max_scoring_bytes), util.formatBytes(grph.queryBytes())))
+
+        if workers > 1 and not backend in _numpy_backends:
+            log.writeln('[WARNING] Parallel relations are only supported with the %s backends; using 1 worker' % ', '.join(_numpy_backends))
+            workers = 1
+        elif workers > 1 and not 'fork' in multiprocessing.get_all_start_methods():
+            log.writeln('[WARNING] Parallel relations need fork() to share embeddings; using 1 worker')
+            workers = 1
+
+        # progress over the whole run, counted as each relation is completed
+        # (in whichever worker) and logged at most every 10 seconds
+        progress = ProgressTracker(
+            sum(len(set_analogies) for rel_analogies in relations.values() for set_analogies in rel_analogies.values()),
+            onIncrement=lambda tracker, args: log.writeln(tracker.format('  >> Run: {current}/{total} analogies ({rate:.1f}/s, ETA {eta})')),
+            interval=10, shared=workers > 1)
+
+        if workers > 1:
+            log.writeln('  Completing %d relations with %d workers' % (len(relations), workers))
+            all_rel_results = _parallelRelations(relations, emb_wrapper, grph, modes, report_top_k, workers, progress, max_scoring_bytes)
+        else:
+            all_rel_results = None
+
+        completed, results = 0, { mode: { setting: {} for setting in analogies.keys() } for mode in modes }
+        stats = collections.Counter()
+        for (relation, rel_analogies) in relations.items():
+            with log.span('relation'):
+                if all_rel_results is None:
+                    t_file = log.startTimer('  Starting relation: %s (%d/%d)' % (relation, completed+1, len(relations)))
+                    (rel_results, rel_stats) = _completeRelation(rel_analogies, emb_wrapper, grph, modes, report_top_k, progress,
+                        max_scoring_bytes)
+                else:
+                    # pool results arrive in relation order; time each from the last one
+                    t_file = log.startTimer()
+                    (rel_results, rel_stats) = next(all_rel_results)
+                stats.update(rel_stats)
+
+                summary = []
+                for mode in modes:
+                    if ('recall_total', mode) in rel_stats:
+                        summary.append('\n    >> %sRecall@%d vs. exact search: %.4f' % (
+                            (('[%s] ' % modeName(mode)) if len(modes) > 1 else ''), grph.recallK(),
+                            _ratio(rel_stats[('recall_hits', mode)], rel_stats[('recall_total', mode)])
+                        ))
+                    if rel_stats.get(('quantized_checked', mode), 0) > 0:
+                        summary.append('\n    >> %sVs. exact scoring: ranks differ for %d/%d checked analogies, correctness for %d' % (
+                            (('[%s] ' % modeName(mode)) if len(modes) > 1 else ''), rel_stats[('quantized_ranks_differ', mode)],
+                            rel_stats[('quantized_checked', mode)], rel_stats[('quantized_correct_differs', mode)]
+                        ))
+                    for (setting, set_results) in rel_results[mode].items():
+                        results[mode][setting][relation] = set_results
+                        (correct, MAP, MRR, total, skipped, predictions) = set_results
+                        labels = ([settings.name(setting)] if len(analogies) > 1 else []) + ([modeName(mode)] if len(modes) > 1 else [])
+                        summary.append('\n    >> %sSkipped %d/%d' % (
+                            (('[%s] ' % ', '.join(labels)) if len(labels) > 0 else ''), skipped, total
+                        ))
+
+                        if (mode, setting) in pred_writers:
+                            pred_writers[(mode, setting)].write(relation, predictions)
+
+                log.stopTimer(t_file, message='  Completed file: %s (%d/%d) [{0:.2f}s]%s' % (
+                    relation, completed+1, len(relations), ''.join(summary)
                 ))
+            progress.update()
+
+            completed += 1
+        progress.showProgress()
 
-        completed += 1
+        # tie off the predictions files
+        with log.span('flush'):
+            for pred_writer in pred_writers.values(): pred_writer.close()
 
-    # tie off the predictions file
-    if predictions_file: pred_stream.close()
+    if stats['batches'] > 0:
+        log.writeln('  Scored %d queries in %d batches (%.1f per batch; %.1f queries/s%s)%s' % (
+            stats['queries_scored'], stats['batches'], _ratio(stats['queries_scored'], stats['batches']),
+            _ratio(stats['queries_scored'], stats['scoring_seconds']), (' per worker' if workers > 1 else ''),
+            ('; %d batches ran out of memory and were retried at half the size' % stats['batch_backoffs'])
+                if stats['batch_backoffs'] > 0 else ''
+        ))
+    if 'rows_calculated' in stats:
+        log.writeln('  Similarity rows: %d calculated, %d reused from cache' % (stats['rows_calculated'], stats['rows_reused']))
+    for mode in modes:
+        if ('recall_total', mode) in stats:
+            log.writeln('  %s recall@%d vs. exact search: %.4f (%d queries checked)' % (
+                modeName(mode), grph.recallK(),
+                _ratio(stats[('recall_hits', mode)], stats[('recall_total', mode)]), stats[('recall_total', mode)] // grph.recallK()))
+        if ('quantized_checked', mode) in stats:
+            log.writeln('  %s vs. exact scoring: answer ranks differ for %.4f, correctness for %.4f (%d analogies checked)' % (
+                modeName(mode),
+                _ratio(stats[('quantized_ranks_differ', mode)], stats[('quantized_checked', mode)]),
+                _ratio(stats[('quantized_correct_differs', mode)], stats[('quantized_checked', mode)]),
+                stats[('quantized_checked', mode)]))
 
     return results
+
+
+def _completeRelation(rel_analogies, emb_wrapper, grph, modes, report_top_k, progress=None, max_scoring_bytes=None):
+    '''Returns (completeAnalogyMethods results, scoring stats) for one
+    relation, where the stats count only the scoring done for it; its
+    analogies are added to the progress tracker, if given
+    '''
+    before = grph.scoringStats()
+    rel_results = completeAnalogyMethods(rel_analogies, emb_wrapper, grph, modes, report_top_k, log=log,
+        max_scoring_bytes=max_scoring_bytes)
+    rel_stats = { key: count - before.get(key, 0) for (key, count) in grph.scoringStats().items() }
+    if progress is not None:
+        progress.add(sum(len(set_analogies) for set_analogies in rel_analogies.values()))
+    return (rel_results, rel_stats)
+
+def _ratio(numerator, denominator):
+    return (numerator / denominator) if denominator > 0 else 0.
+
+# state inherited by forked relation workers (see _parallelRelations)
+_worker_state = None
+
+def _parallelRelations(relations, emb_wrapper, grph, modes, report_top_k, workers, progress, max_scoring_bytes=None):
+    '''Generator over _completeRelation results for each relation in
+    relations, in order, as computed by a pool of forked workers; the
+    (shared) progress tracker is updated by the workers, and rendered
+    while waiting on them
+    '''
+    global _worker_state
+    _worker_state = (emb_wrapper, grph, modes, report_top_k, progress, max_scoring_bytes)
+    try:
+        ctx = multiprocessing.get_context('fork')
+        with ctx.Pool(processes=workers, initializer=_initRelationWorker) as pool:
+            all_rel_results = pool.imap(_relationWorker, relations.values(), chunksize=1)
+            for _ in range(len(relations)):
+                while True:
+                    try:
+                        rel_results = all_rel_results.next(timeout=progress.interval)
+                        break
+                    except multiprocessing.TimeoutError:
+                        progress.update()
+                yield rel_results
+    finally:
+        _worker_state = None
+
+def _initRelationWorker():
+    # per-relation progress from several processes would just interleave;
+    # the parent logs each relation as it is merged
+    log.logfile = open(os.devnull, 'w')
+    log.stdout_also = False
+
+def _relationWorker(rel_analogies):
+    (emb_wrapper, grph, modes, report_top_k, progress, max_scoring_bytes) = _worker_state
+    return _completeRelation(rel_analogies, emb_wrapper, grph, modes, report_top_k, progress, max_scoring_bytes)
@@ -3,7 +3,8 @@
 # grab up-to-date Python 3
 apt-get update
 apt-get install python3-pip python3-dev
-# install Tensorflow (CPU only)
+# install NumPy/SciPy, and Tensorflow (CPU only) for the original scoring backend
+pip3 install numpy scipy
 pip3 install tensorflow
 
 # grab pre-trained embeddings
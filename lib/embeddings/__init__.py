@@ -9,21 +9,138 @@ from ..logging import log
 from .common import *
 from . import word2vec
 from . import glove
+from . import cache
 from .glove import GloveMode
+from .. import preprocessing
 
-def read(fname, format=Format.Word2Vec, **kwargs):
-    '''Returns array of words and word embedding matrix
+def read(fname, format=Format.Word2Vec, clean=False, normed=False, use_cache=True, **kwargs):
+    '''Returns dictionary of { word : embedding }
+
+    See readMatrix for the clean/normed/use_cache options.
     '''
-    if format == Format.Word2Vec:
-        (words, vectors) = word2vec.read(fname, **kwargs)
-    elif format == Format.Glove:
-        (words, vectors) = glove.read(fname, **kwargs)
+    (words, vectors) = readMatrix(fname, format=format, clean=clean,
+        normed=normed, use_cache=use_cache, **kwargs)
 
     wordmap = {}
     for i in range(len(words)):
         wordmap[words[i]] = vectors[i]
     return wordmap
 
+def readMatrix(fname, format=Format.Word2Vec, clean=False, normed=False, use_cache=True, dtype=None, **kwargs):
+    '''Returns list of words and word embedding matrix
+
+    Parameters
+        clean     :: tokenize/lowercase the vocabulary (see cleanVocab)
+        normed    :: unit-norm the embeddings
+        use_cache :: load from the pre-converted cache of fname (see
+                     lib.embeddings.cache) if one exists for the same
+                     options and is up to date; the cache is float32, so
+                     it is not used for any wider dtype
+        dtype     :: convert the matrix to this type (default: as read)
+    '''
+    options = _cacheOptions(format, clean, normed, kwargs)
+    if dtype and numpy.dtype(dtype) != cache.DTYPE:
+        use_cache = False
+    if use_cache and options and cache.isFresh(fname, options, inputs=_cacheInputs(kwargs)):
+        with log.span('read'):
+            (words, vectors) = cache.read(fname)
+            if dtype: vectors = vectors.astype(dtype, copy=False)
+        return (words, vectors)
+
+    # GloVe vectors are stored as doubles, so downcast while reading
+    with log.span('read'):
+        if format == Format.Word2Vec:
+            (words, vectors) = word2vec.read(fname, **kwargs)
+        elif format == Format.Glove:
+            (words, vectors) = glove.read(fname, dtype=dtype, **kwargs)
+        vectors = numpy.asarray(vectors)
+        if dtype: vectors = vectors.astype(dtype, copy=False)
+
+    if clean:
+        with log.span('clean'):
+            (words, row_ixes) = cleanVocab(words)
+            vectors = vectors[row_ixes]
+    if normed:
+        # norm in place, unless the matrix is a read-only view of the file
+        with log.span('norm'):
+            vectors = normalize(vectors, inplace=vectors.flags.writeable)
+    return (words, vectors)
+
+def readShape(fname, format=Format.Word2Vec, **kwargs):
+    '''Returns (number of words, dimensionality) of the embeddings in
+    fname, from its cache header if there is one or else from the file,
+    without reading the vectors themselves
+    '''
+    header = cache.readHeader(fname)
+    if header is not None:
+        return tuple(header['shape'])
+    if format == Format.Word2Vec:
+        return word2vec.readShape(fname)
+    elif format == Format.Glove:
+        return glove.readShape(fname, kwargs['vocab'], include_bias=kwargs.get('include_bias', False))
+
+def buildCache(fname, format=Format.Word2Vec, clean=False, normed=True, **kwargs):
+    '''Reads an embedding file and writes its pre-converted cache
+    (see lib.embeddings.cache); returns (words, matrix)
+    '''
+    options = _cacheOptions(format, clean, normed, kwargs)
+    if not options:
+        raise ValueError('Cannot cache embeddings read with options %s' % str(kwargs))
+    (words, vectors) = readMatrix(fname, format=format, clean=clean, normed=normed,
+        use_cache=False, **kwargs)
+    cache.write(fname, words, vectors, options, inputs=_cacheInputs(kwargs))
+    return (words, vectors)
+
+def _cacheOptions(format, clean, normed, kwargs):
+    '''Returns the options identifying a cache, or None if the reader
+    arguments can't be stored (e.g., an in-memory vocabulary)
+    '''
+    for v in kwargs.values():
+        if not (v is None or type(v) in [str, int, float, bool]):
+            return None
+    return { 'format': format, 'clean': clean, 'normed': normed, 'reader': kwargs }
+
+def _cacheInputs(kwargs):
+    '''Returns the files other than the embedding file itself that the
+    reader arguments name (e.g., a GloVe vocabulary), which a cache
+    depends on
+    '''
+    return [kwargs['vocab']] if kwargs.get('vocab') else []
+
+def cleanVocab(words):
+    '''Tokenizes and lowercases each word in the vocabulary, keeping
+    words that were already clean and adding cleaned versions of the
+    others where they don't collide with an existing word.
+
+    Returns (cleaned words, indices of their rows in the original vocabulary)
+    '''
+    clean = lambda k: ' '.join(preprocessing.tokenize(k))
+    cleaned, keys_set_aside = {}, []
+    # first, find keys that are already clean
+    for i in range(len(words)):
+        if clean(words[i]) == words[i]: cleaned[words[i]] = i
+        else: keys_set_aside.append(i)
+    # put the keys set aside into deterministic order (preferring "To" to "TO")
+    keys_set_aside.sort(key=lambda i: words[i], reverse=True)
+    # then, find ones not already in the embedding list and add them
+    for i in keys_set_aside:
+        clean_key = clean(words[i])
+        if cleaned.get(clean_key, None) is None:
+            cleaned[clean_key] = i
+    return (list(cleaned.keys()), numpy.array(list(cleaned.values()), dtype=numpy.int64))
+
+def normalize(embed_array, inplace=False):
+    '''Returns a matrix of embeddings with each row unit-normed (all-zero
+    rows are left as is); modifies embed_array itself if inplace=True
+    '''
+    norms = numpy.sqrt(numpy.einsum('ij,ij->i', embed_array, embed_array))
+    norms[norms == 0] = 1
+    if inplace:
+        embed_array /= norms[:, numpy.newaxis]
+        return embed_array
+    else:
+        return embed_array / norms[:, numpy.newaxis]
+
 def load(*args, **kwargs):
     '''Alias for read'''
     return read(*args, **kwargs)
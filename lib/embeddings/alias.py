@@ -0,0 +1,95 @@
+'''
+Embeddings for multi-word terms ("aliases"), calculated as the average
+of the embeddings of their known tokens.
+
+Averaging is done as a single product of a sparse (terms x tokens)
+averaging matrix with the token embedding matrix.  As building the
+averaging matrix means tokenizing every term, it can be cached on disk
+for each pair of term list and embedding vocabulary.
+'''
+import os
+import zipfile
+import hashlib
+import numpy as np
+import scipy.sparse
+
+def averagingMatrix(terms, words):
+    '''Returns (indices of kept terms, sparse averaging matrix), where row
+    i of the (kept terms x words) CSR matrix averages the known tokens of
+    terms[kept[i]].  Repeated terms are kept once, and terms with no known
+    tokens are dropped.
+    '''
+    token_ixes = { words[i]:i for i in range(len(words)) }
+    seen = set()
+    kept, indptr, indices = [], [0], []
+    for i in range(len(terms)):
+        if terms[i] in seen: continue
+        seen.add(terms[i])
+        known_ixes = [token_ixes[t] for t in terms[i].split() if t in token_ixes]
+        if len(known_ixes) > 0:
+            kept.append(i)
+            indices.extend(known_ixes)
+            indptr.append(len(indices))
+
+    indptr = np.array(indptr, dtype=np.int64)
+    indices = np.array(indices, dtype=np.int64)
+    counts = np.diff(indptr)
+    data = np.repeat(1. / np.maximum(counts, 1), counts)
+    averaging = scipy.sparse.csr_matrix((data, indices, indptr), shape=(len(kept), len(words)))
+    return (np.array(kept, dtype=np.int64), averaging)
+
+def aliasEmbeddings(terms, words, embed_array, cache_prefix=None):
+    '''Returns (alias terms, alias embedding matrix) for the terms with at
+    least one token in words, averaging rows of embed_array.
+
+    If cache_prefix is given, the averaging matrix is saved to (and later
+    loaded from) <cache_prefix>.<key>.alias.npz, where key identifies
+    the terms and words used.
+    '''
+    key = _cacheKey(terms, words)
+    cache_file = ('%s.%s.alias.npz' % (cache_prefix, key[:16])) if cache_prefix else None
+
+    cached = _readCache(cache_file, key) if cache_file else None
+    if cached is None:
+        (kept, averaging) = averagingMatrix(terms, words)
+        if cache_file:
+            # caching is only an optimization; carry on if it can't be written
+            try: _writeCache(cache_file, key, kept, averaging)
+            except OSError: pass
+    else:
+        (kept, averaging) = cached
+
+    averaging = averaging.astype(embed_array.dtype)
+    alias_terms = [terms[i] for i in kept]
+    return (alias_terms, np.asarray(averaging @ embed_array))
+
+def _cacheKey(terms, words):
+    h = hashlib.sha1()
+    for lst in [terms, words]:
+        h.update('\n'.join(lst).encode('utf-8'))
+        h.update(b'\0')
+    return h.hexdigest()
+
+def _readCache(cache_file, key):
+    if not os.path.isfile(cache_file):
+        return None
+    try:
+        with np.load(cache_file) as cached:
+            if str(cached['key']) != key:
+                return None
+            averaging = scipy.sparse.csr_matrix(
+                (cached['data'], cached['indices'], cached['indptr']),
+                shape=tuple(cached['shape'])
+            )
+            return (cached['kept'], averaging)
+    except (OSError, ValueError, KeyError, EOFError, zipfile.BadZipFile):
+        # corrupt or truncated; rebuild it
+        return None
+
+def _writeCache(cache_file, key, kept, averaging):
+    # np.savez adds the .npz extension to names without it
+    tmp_file = '%s.tmp.npz' % cache_file[:-len('.npz')]
+    np.savez(tmp_file, key=np.array(key), kept=kept, data=averaging.data,
+        indices=averaging.indices, indptr=averaging.indptr,
+        shape=np.array(averaging.shape))
+    os.replace(tmp_file, cache_file)
@@ -0,0 +1,123 @@
+'''
+Pre-converted cache of an embedding file, for fast repeated loading.
+
+A cache is stored next to its source file as three pieces:
+    <source>.cache.npy   :: float32 embedding matrix (memory-mappable)
+    <source>.cache.vocab :: vocabulary, one term per line, in row order
+    <source>.cache.json  :: header describing the source file (and any
+                            other files read with it, e.g. a GloVe
+                            vocabulary) and the options (format,
+                            cleaning, norming) used
+'''
+import os
+import json
+import codecs
+import hashlib
+import numpy as np
+
+VERSION = 2
+
+# type of the stored matrix; reads needing more precision bypass the cache
+DTYPE = np.float32
+
+def prefix(fname):
+    return '%s.cache' % fname
+
+def checksum(fname, blocksize=1<<20):
+    '''Returns the SHA-1 hex digest of a file's contents
+    '''
+    h = hashlib.sha1()
+    with open(fname, 'rb') as stream:
+        block = stream.read(blocksize)
+        while len(block) > 0:
+            h.update(block)
+            block = stream.read(blocksize)
+    return h.hexdigest()
+
+def _sourceStats(fname):
+    stats = os.stat(fname)
+    return { 'size': stats.st_size, 'mtime_ns': stats.st_mtime_ns }
+
+def _inputStats(inputs):
+    return [dict(_sourceStats(input_fname), path=input_fname) for input_fname in inputs]
+
+def readHeader(fname):
+    '''Returns the header of the cache for fname, or None if there is none
+    '''
+    try:
+        with codecs.open('%s.json' % prefix(fname), 'r', 'utf-8') as stream:
+            return json.load(stream)
+    except (IOError, ValueError):
+        return None
+
+def isFresh(fname, options, verify=False, inputs=()):
+    '''Checks if a cache exists for fname that was built with the same
+    options and from the current version of the file, and of each of the
+    other files in inputs.  Files are matched on size and modification
+    time; use verify=True to also recompute their checksums.
+    '''
+    header = readHeader(fname)
+    if header is None or header.get('version') != VERSION:
+        return False
+    if header['options'] != _jsonable(options):
+        return False
+    if not os.path.isfile(fname) or header['source'] != _sourceStats(fname):
+        return False
+    if not all(os.path.isfile(input_fname) for input_fname in inputs) or header['inputs'] != _inputStats(inputs):
+        return False
+    for ext in ['npy', 'vocab']:
+        if not os.path.isfile('%s.%s' % (prefix(fname), ext)):
+            return False
+    if verify and header['checksum'] != checksum(fname):
+        return False
+    if verify and header['input_checksums'] != [checksum(input_fname) for input_fname in inputs]:
+        return False
+    return True
+
+def write(fname, words, matrix, options, inputs=()):
+    '''Writes the cache for fname, given its (processed) vocabulary and
+    embedding matrix, the options used to produce them, and any other
+    files they were read from.
+    '''
+    base = prefix(fname)
+    matrix = np.asarray(matrix, dtype=DTYPE)
+
+    # write each piece under a temporary name and move it into place, so
+    # a half-written cache is never picked up
+    with open('%s.npy.tmp' % base, 'wb') as stream:
+        np.save(stream, matrix)
+    with codecs.open('%s.vocab.tmp' % base, 'w', 'utf-8') as stream:
+        for word in words:
+            stream.write(word)
+            stream.write('\n')
+    header = {
+        'version': VERSION,
+        'source': _sourceStats(fname),
+        'checksum': checksum(fname),
+        'inputs': _inputStats(inputs),
+        'input_checksums': [checksum(input_fname) for input_fname in inputs],
+        'options': _jsonable(options),
+        'shape': list(matrix.shape),
+        'dtype': str(matrix.dtype),
+    }
+    with codecs.open('%s.json.tmp' % base, 'w', 'utf-8') as stream:
+        json.dump(header, stream, indent=2, sort_keys=True)
+
+    for ext in ['npy', 'vocab', 'json']:
+        os.replace('%s.%s.tmp' % (base, ext), '%s.%s' % (base, ext))
+
+def read(fname, mmap=True):
+    '''Returns (words, matrix) from the cache for fname; the matrix is
+    memory-mapped read-only unless mmap=False.
+    '''
+    base = prefix(fname)
+    matrix = np.load('%s.npy' % base, mmap_mode=('r' if mmap else None))
+    with codecs.open('%s.vocab' % base, 'r', 'utf-8') as stream:
+        words = stream.read().split('\n')[:-1]
+    assert len(words) == matrix.shape[0]
+    return (words, matrix)
+
+def _jsonable(options):
+    '''Round-trips options through JSON, for comparison with a stored header
+    '''
+    return json.loads(json.dumps(options, sort_keys=True))
@@ -1,18 +1,28 @@
+import os
 import codecs
-import array
 import numpy as np
-from .common import *
 
 class GloveMode:
     IgnoreContexts = 0
     SumContexts = 1
     GetContexts = 2
 
-def read(fname, vocab=None, mode=GloveMode.SumContexts, include_bias=False):
+def read(fname, vocab=None, mode=GloveMode.SumContexts, include_bias=False, dtype=None):
+    '''Returns list of words and embedding matrix from a GloVe binary file.
+
+    The file is memory-mapped as a (words x 2*dim) matrix of doubles, and
+    word/context vectors are taken as slices of it:
+        IgnoreContexts :: (words x dim) word vectors
+        SumContexts    :: (words x dim) sums of word and context vectors
+        GetContexts    :: (words x 2 x dim) word and context vectors
+    dim includes the bias term only if include_bias is True.  If dtype is
+    given (e.g., 'float32'), vectors are converted to it in the same step;
+    otherwise IgnoreContexts/GetContexts return read-only views of the file.
+    '''
     if not vocab:
         raise Exception("vocab must be specified for GloVe embeddings")
 
-    words, vectors = [], []
+    words = []
 
     # get the embedding vocabulary
     if type(vocab) is str:
@@ -23,29 +33,37 @@ def read(fname, vocab=None, mode=GloveMode.SumContexts, include_bias=False):
     else:
         words = vocab.copy()
 
-    inf = open(fname, 'rb')
-
     # set up for parsing the stored numbers
     real_size = 8  # default double precision
-    file_size = getFileSize(inf)
+    file_size = os.path.getsize(fname)
     dim = int((float(file_size) / (real_size * len(words))) / 2)
+    stored = np.memmap(fname, dtype=np.float64, mode='r', shape=(len(words), 2*dim))
+
+    # the bias term is the last element of each of the word/context vectors
+    out_dim = dim if include_bias else dim-1
 
     # extract the stored vectors
-    for i in range(len(words)):
-        vector = array.array('d', inf.read(dim*2*real_size))
-        if mode == GloveMode.IgnoreContexts:
-            vector = vector[:dim]
-            if not include_bias: vector = vector[:-1]
-        elif mode == GloveMode.SumContexts:
-            vector = array.array('d',
-                np.array(vector[:dim]) + np.array(vector[dim:])
-            )
-            if not include_bias: vector = vector[:-1]
-        elif mode == GloveMode.GetContexts:
-            vector = (vector[:dim], vector[dim:])
-            if not include_bias: vector = (vector[0][:-1], vector[1][:-1])
-        vectors.append(vector)
-
-    inf.close()
+    if mode == GloveMode.IgnoreContexts:
+        vectors = stored[:, :out_dim]
+    elif mode == GloveMode.SumContexts:
+        vectors = np.empty((len(words), out_dim), dtype=(dtype or np.float64))
+        np.add(stored[:, :out_dim], stored[:, dim:dim+out_dim], out=vectors, casting='same_kind')
+    elif mode == GloveMode.GetContexts:
+        vectors = stored.reshape((len(words), 2, dim))[:, :, :out_dim]
+
+    if dtype:
+        vectors = vectors.astype(dtype, copy=False)
 
     return (words, vectors)
+
+def readShape(fname, vocab, include_bias=False):
+    '''Returns (number of words, dimensionality) of the vectors read from
+    a GloVe binary file, without reading them
+    '''
+    if type(vocab) is str:
+        with codecs.open(vocab, 'r', 'utf-8') as h:
+            num_words = sum(1 for line in h)
+    else:
+        num_words = len(vocab)
+    dim = int((float(os.path.getsize(fname)) / (8 * num_words)) / 2)
+    return (num_words, dim if include_bias else dim-1)
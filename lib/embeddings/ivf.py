@@ -0,0 +1,143 @@
+'''
+Inverted-file (IVF) index over an embedding matrix, for approximate
+maximum inner product search with NumPy alone.
+
+Embeddings are clustered by spherical k-means into lists around unit
+centroids; a query is only compared against the embeddings in the few
+lists whose centroids it scores highest against.  As building the index
+means clustering the whole matrix, it can be cached on disk next to the
+embeddings it was built for.
+'''
+import os
+import zipfile
+import hashlib
+import numpy as np
+
+VERSION = 2
+
+class IVFIndex:
+    '''Embedding indices grouped by list: the members of list i are
+    order[offsets[i]:offsets[i+1]]
+    '''
+
+    def __init__(self, centroids, order, offsets):
+        self.centroids = centroids
+        self.order = order
+        self.offsets = offsets
+
+    def numLists(self):
+        return self.centroids.shape[0]
+
+    def listSizes(self):
+        return np.diff(self.offsets)
+
+    def probe(self, queries, probes, min_candidates=0):
+        '''Returns the candidate embedding indices for each of a matrix of
+        queries, from the (at least) probes lists with the highest-scoring
+        centroids; further lists are added until there are min_candidates
+        '''
+        list_scores = np.dot(queries, self.centroids.T)
+        ranked_lists = np.argsort(-list_scores, axis=1, kind='stable')
+        sizes = self.listSizes()
+
+        candidates = []
+        for i in range(len(queries)):
+            cumulative = np.cumsum(sizes[ranked_lists[i]])
+            num_lists = max(probes, int(np.searchsorted(cumulative, min_candidates)) + 1)
+            candidates.append(np.concatenate([
+                self.order[self.offsets[j]:self.offsets[j+1]]
+                    for j in ranked_lists[i, :num_lists]
+            ]))
+        return candidates
+
+def buildIndex(embed_array, num_lists=None, iterations=10, sample_size=None, seed=0, batch_size=1<<16):
+    '''Clusters the rows of embed_array into num_lists lists (default: 4
+    times the square root of the number of rows) with spherical k-means,
+    trained on a random sample of sample_size rows (default: 64 per list)
+    '''
+    num_rows = embed_array.shape[0]
+    if num_lists is None: num_lists = int(4 * np.sqrt(num_rows))
+    num_lists = max(1, min(num_lists, num_rows))
+    if sample_size is None: sample_size = 64 * num_lists
+    random = np.random.RandomState(seed)
+
+    sample = np.asarray(embed_array[np.sort(random.choice(num_rows, min(sample_size, num_rows), replace=False))])
+    centroids = _unitNorm(sample[random.choice(len(sample), num_lists, replace=False)])
+    for _ in range(iterations):
+        assignments = _nearestLists(sample, centroids, batch_size)
+        order = np.argsort(assignments, kind='stable')
+        (lists, starts) = np.unique(assignments[order], return_index=True)
+        sums = np.add.reduceat(sample[order], starts, axis=0)
+        # lists that lost all their members are restarted from random rows
+        empty = np.setdiff1d(np.arange(num_lists), lists)
+        centroids[lists] = _unitNorm(sums)
+        centroids[empty] = _unitNorm(sample[random.choice(len(sample), len(empty), replace=False)])
+
+    assignments = _nearestLists(embed_array, centroids, batch_size)
+    order = np.argsort(assignments, kind='stable')
+    offsets = np.concatenate([[0], np.cumsum(np.bincount(assignments, minlength=num_lists))])
+    return IVFIndex(centroids, order.astype(np.int64), offsets.astype(np.int64))
+
+def loadOrBuild(embed_array, cache_prefix=None, sources=(), num_lists=None, iterations=10, seed=0):
+    '''Returns the IVF index for embed_array (see buildIndex).
+
+    If cache_prefix is given, the index is saved to (and later loaded
+    from) <cache_prefix>.<key>.ivf.npz, where key identifies the
+    embeddings and index parameters used.  The embeddings are identified
+    by their shape and type and the path, size and modification time of
+    each of the files in sources they were read from (e.g., the embedding
+    file and alias term list) or, if none are given, by their contents.
+    '''
+    key = _cacheKey(embed_array, sources, num_lists, iterations, seed)
+    cache_file = ('%s.%s.ivf.npz' % (cache_prefix, key[:16])) if cache_prefix else None
+
+    index = _readCache(cache_file, key) if cache_file else None
+    if index is None:
+        index = buildIndex(embed_array, num_lists=num_lists, iterations=iterations, seed=seed)
+        if cache_file:
+            # caching is only an optimization; carry on if it can't be written
+            try: _writeCache(cache_file, key, index)
+            except OSError: pass
+    return index
+
+def _unitNorm(matrix):
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return matrix / norms
+
+def _nearestLists(embed_array, centroids, batch_size):
+    assignments = np.empty(embed_array.shape[0], dtype=np.int64)
+    for start in range(0, embed_array.shape[0], batch_size):
+        batch = np.asarray(embed_array[start:start+batch_size], dtype=centroids.dtype)
+        assignments[start:start+batch_size] = np.dot(batch, centroids.T).argmax(axis=1)
+    return assignments
+
+def _cacheKey(embed_array, sources, num_lists, iterations, seed):
+    h = hashlib.sha1()
+    h.update(str((VERSION, embed_array.shape, str(embed_array.dtype), num_lists, iterations, seed)).encode('utf-8'))
+    if len(sources) > 0:
+        for source in sources:
+            stats = os.stat(source)
+            h.update(str((os.path.abspath(source), stats.st_size, stats.st_mtime_ns)).encode('utf-8'))
+    else:
+        h.update(np.ascontiguousarray(embed_array).data)
+    return h.hexdigest()
+
+def _readCache(cache_file, key):
+    if not os.path.isfile(cache_file):
+        return None
+    try:
+        with np.load(cache_file) as cached:
+            if str(cached['key']) != key:
+                return None
+            return IVFIndex(cached['centroids'], cached['order'], cached['offsets'])
+    except (OSError, ValueError, KeyError, EOFError, zipfile.BadZipFile):
+        # corrupt or truncated; rebuild it
+        return None
+
+def _writeCache(cache_file, key, index):
+    # np.savez adds the .npz extension to names without it
+    tmp_file = '%s.tmp.npz' % cache_file[:-len('.npz')]
+    np.savez(tmp_file, key=np.array(key), centroids=index.centroids,
+        order=index.order, offsets=index.offsets)
+    os.replace(tmp_file, cache_file)
@@ -1,16 +1,28 @@
 import codecs
-import array
+import mmap
 import sys
 import numpy as np
 from .common import *
 
-def read(fname, mode=Mode.Binary):
+def read(fname, mode=Mode.Binary, matrix_file=None):
     '''Returns array of words and word embedding matrix
+
+    For binary files, matrix_file optionally gives a path to hold the
+    matrix as a memory-mapped .npy file (see _readBin).
     '''
     if mode == Mode.Text: (words, vectors) = _readTxt(fname)
-    elif mode == Mode.Binary: (words, vectors) = _readBin(fname)
+    elif mode == Mode.Binary: (words, vectors) = _readBin(fname, matrix_file=matrix_file)
     return (words, vectors)
 
+def readShape(fname):
+    '''Returns (number of words, dimensionality) from the header of a
+    word2vec file (text or binary), without reading the vectors
+    '''
+    with open(fname, 'rb') as inf:
+        summary = inf.readline().decode('utf-8')
+    (numWords, dim) = [int(s.strip()) for s in summary.split()][:2]
+    return (numWords, dim)
+
 #def write(embeds, fname, mode=Mode.Binary):
 #    '''Writes a dictionary of embeddings { term : embed}
 #    to a file, in the format specified.
@@ -38,7 +50,7 @@ def _readTxt(fname):
     assert len(words) == numWords
     for v in vectors: assert len(v) == dim
 
-    return (words, vectors)
+    return (words, np.array(vectors, dtype=np.float32))
 
 def _getFileSize(inf):
     curIx = inf.tell()
@@ -47,51 +59,72 @@ def _getFileSize(inf):
     inf.seek(curIx)
     return file_size
 
-def _readBin(fname):
-    import sys
-    words, vectors = [], []
-
-    inf = open(fname, 'rb')
-
-    # get summary info about vectors file
-    summary = inf.readline().decode('utf-8')
-    summary_chunks = [int(s.strip()) for s in summary.split(' ')]
-    (numWords, dim) = summary_chunks[:2]
-    if len(summary_chunks) > 2: float_size = 8
-    else: float_size = 4
-
-    # make best guess about byte size of floats in file
-    #float_size = 4
-
-    chunksize = 10*float_size*1024
-    curIx, nextChunk = inf.tell(), inf.read(chunksize)
-    #while len(nextChunk) > 0 and len(words) < numWords:
-    while len(nextChunk) > 0:
-        inf.seek(curIx)
-
-        splitix = nextChunk.index(b' ')
-        #print('splitIx: %d   nextChunk: %s' % (splitix, nextChunk[:splitix]))
-        word = inf.read(splitix).decode('utf-8')
-        #word = inf.read(splitix).decode('utf-8', errors='replace')
-        #print('word: %s' % word)
-        inf.seek(1,1) # skip the space
-        vector = array.array('f', inf.read(dim*float_size))
-        #print(vector)
-        inf.seek(1,1) # skip the newline
+def _readBin(fname, matrix_file=None):
+    '''Returns list of words and (numWords x dim) float32 embedding matrix
 
-        words.append(word)
-        vectors.append(vector)
-        curIx, nextChunk = inf.tell(), inf.read(chunksize)
-        #print('curIx: %d' % curIx)
-        #input()
-        #sys.stdout.write('  >> Read %d words\r' % len(words))
-
-    inf.close()
+    The file is memory-mapped and scanned once to find the offset of each
+    vector, which are then copied into the matrix in large blocks.  If
+    matrix_file is given, the matrix is created as a memory-mapped .npy
+    file at that path, so that it can be shared between processes
+    through the page cache.
+    '''
+    with open(fname, 'rb') as inf:
+        # get summary info about vectors file
+        summary = inf.readline().decode('utf-8')
+        summary_chunks = [int(s.strip()) for s in summary.split(' ')]
+        (numWords, dim) = summary_chunks[:2]
+        if len(summary_chunks) > 2: float_size = 8
+        else: float_size = 4
+        curIx = inf.tell()
+
+        stream = mmap.mmap(inf.fileno(), 0, access=mmap.ACCESS_READ)
+
+    # each entry is at least a space and its vector
+    words, offsets = [], np.empty(numWords, dtype=np.int64)
+    vector_size, file_size = dim*float_size, len(stream)
+    if file_size - curIx < numWords * (vector_size + 1):
+        stream.close()
+        raise ValueError('%s is too short for the %d %d-d vectors in its header' % (fname, numWords, dim))
+
+    # find each word and the offset of its vector
+    while curIx < file_size and len(words) < numWords:
+        splitix = stream.find(b' ', curIx)
+        if splitix < 0 or splitix + 1 + vector_size > file_size:
+            stream.close()
+            raise ValueError('Truncated vector for word %d of %d in %s' % (len(words)+1, numWords, fname))
+        words.append(stream[curIx:splitix].decode('utf-8'))
+        offsets[len(words)-1] = splitix + 1
+        curIx = splitix + 1 + vector_size
+        # skip the newline, if there is one
+        if stream[curIx:curIx+1] == b'\n': curIx += 1
+
+    if len(words) != numWords:
+        stream.close()
+        raise ValueError('Read %d vectors from %s, but its header gives %d' % (len(words), fname, numWords))
+
+    if matrix_file:
+        vectors = np.lib.format.open_memmap(matrix_file, mode='w+', dtype=np.float32, shape=(numWords, dim))
+    else:
+        vectors = np.empty((numWords, dim), dtype=np.float32)
+    _gatherVectors(stream, offsets, float_size, vectors)
+    if matrix_file: vectors.flush()
+    stream.close()
 
-    # verify that we read properly
-    assert len(words) == numWords
     return (words, vectors)
 
+def _gatherVectors(stream, offsets, float_size, vectors):
+    '''Copies the vectors starting at each byte offset in stream into
+    the rows of vectors, a block of rows at a time
+    '''
+    raw = np.frombuffer(stream, dtype=np.uint8)
+    vector_size = vectors.shape[1] * float_size
+    byte_ixes = np.arange(vector_size, dtype=np.int64)
+    block_size = max(1, (1 << 24) // max(vector_size, 1))
+    for start in range(0, len(offsets), block_size):
+        block_offsets = offsets[start:start+block_size]
+        block = raw[block_offsets[:, np.newaxis] + byte_ixes]
+        vectors[start:start+len(block_offsets)] = block.view('<f%d' % float_size)
+
 #def _write(wordmap, fname, mode):
 def write(embeds, fname, mode=Mode.Binary, verbose=False):
     '''Writes a dictionary of embeddings { term : embed}
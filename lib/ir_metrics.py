@@ -2,7 +2,8 @@
 Implements some Information Retrieval relevant metrics.
 '''
 
-__all__= ['AveragePrecision', 'ReciprocalRank', 'AP_RR', 'MeanReciprocalRank']
+__all__= ['AveragePrecision', 'ReciprocalRank', 'AP_RR', 'MeanReciprocalRank',
+    'RankedAP_RR', 'BatchAP_RR', 'BatchAccuracy', 'BatchMetrics']
 
 import numpy as np
 
@@ -51,40 +52,124 @@ def AP_RR(truth, ranked):
     '''
     return _AP_RR(truth, ranked, rr_only=False)
 
+def RankedAP_RR(truth_ranks):
+    '''Calculates average precision and reciprocal rank for a batch
+    of queries, given the (1-based) rank of each "true" element in the
+    complete ranking of candidates; no sorting of candidates is needed.
+
+    Parameters
+        truth_ranks :: (queries x truth) matrix of ranks; entries < 1 are
+                       padding, np.inf marks a "true" element that was not
+                       ranked, and repeated ranks are counted once
+
+    Returns (avg_precisions, reciprocal_ranks) as arrays; reciprocal
+    rank is -1 for queries where no "true" element was ranked
+    '''
+    truth_ranks = np.asarray(truth_ranks, dtype=np.float64)
+    # padding sorts to the end as NaN
+    ranks = np.sort(np.where(truth_ranks > 0, truth_ranks, np.nan), axis=1)
+    counted = ~np.isnan(ranks)
+    counted[:, 1:] &= (ranks[:, 1:] != ranks[:, :-1]) | np.isinf(ranks[:, 1:])
+    found = counted & np.isfinite(ranks)
+
+    num_truth = counted.sum(axis=1)
+    num_found = np.cumsum(found, axis=1)
+    ap_summer = np.where(found, num_found / np.where(found, ranks, 1), 0).sum(axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ap = np.where(num_truth > 0, ap_summer / num_truth, 0)
+    rr = np.where(found[:, 0], 1. / np.where(found[:, 0], ranks[:, 0], 1), -1)
+    return (ap, rr)
+
+def BatchAP_RR(truth, ranked):
+    '''Calculates average precision and reciprocal rank for a batch of
+    ranked sequences of indices.
+
+    Parameters
+        truth  :: (queries x truth) matrix of "true" indices, padded with
+                  negative values (e.g., -1/-2)
+        ranked :: (queries x depth) matrix of ranked indices
+
+    Returns (avg_precisions, reciprocal_ranks) as arrays
+    '''
+    return RankedAP_RR(_truthRanks(truth, ranked))
+
+def BatchAccuracy(truth, ranked, exclude=None, depth=4):
+    '''Checks for a batch of ranked sequences of indices whether the
+    first element not in exclude (looking at most depth elements down
+    the ranking) is one of the "true" elements.
+
+    Parameters
+        truth   :: (queries x truth) matrix of "true" indices, padded with
+                   negative values
+        ranked  :: (queries x depth) matrix of ranked indices
+        exclude :: optional (queries x N) matrix of indices to skip over
+                   (e.g., the query terms themselves)
+
+    Returns a Boolean array of correct queries
+    '''
+    truth = np.asarray(truth)
+    window = np.asarray(ranked)[:, :depth]
+    is_truth = (
+        (window[:, :, np.newaxis] == truth[:, np.newaxis, :])
+        & (truth[:, np.newaxis, :] >= 0)
+    ).any(axis=2)
+    if exclude is None:
+        keep = np.ones(window.shape, dtype=bool)
+    else:
+        exclude = np.asarray(exclude)
+        keep = ~(window[:, :, np.newaxis] == exclude[:, np.newaxis, :]).any(axis=2)
+    first_kept = keep.argmax(axis=1)
+    rows = np.arange(window.shape[0])
+    return keep.any(axis=1) & is_truth[rows, first_kept]
+
+def BatchMetrics(truth, ranked, exclude=None):
+    '''Calculates average precision, reciprocal rank, and accuracy
+    (see BatchAccuracy) for a batch of ranked sequences of indices.
+
+    Returns (avg_precisions, reciprocal_ranks, correct) as arrays
+    '''
+    (ap, rr) = BatchAP_RR(truth, ranked)
+    correct = BatchAccuracy(truth, ranked, exclude=exclude)
+    return (ap, rr, correct)
+
+def _truthRanks(truth, ranked):
+    '''Returns the (1-based) position of each "true" index in ranked,
+    with 0 for padding and np.inf for "true" indices not in ranked
+    '''
+    ranked = np.asarray(ranked)
+    truth = np.array(truth, dtype=np.int64, ndmin=2)
+    if truth.shape[1] == 0:
+        truth = -np.ones((truth.shape[0], 1), dtype=np.int64)
+    # repeated "true" indices only count once
+    truth.sort(axis=1)
+    truth[:, 1:][truth[:, 1:] == truth[:, :-1]] = -1
+
+    ranks = np.where(truth >= 0, np.inf, 0)
+    for j in range(truth.shape[1]):
+        matches = (ranked == truth[:, j:j+1])
+        hits = np.flatnonzero(matches.any(axis=1) & (truth[:, j] >= 0))
+        ranks[hits, j] = matches[hits].argmax(axis=1) + 1
+    return ranks
+
 def _AP_RR(truth, ranked, rr_only=False):
     if not type(truth) in [set,list,tuple]:
         truth = set([truth])
     else:
         truth = set(truth)
 
-    cur_ix, num_found = 0, 0
-    ap_summer, rr = 0, -1
-    while num_found < len(truth) and cur_ix < len(ranked):
-        if ranked[cur_ix] in truth:
-            num_found += 1
-            in_truth = True
-        else:
-            in_truth = False
-
-        cur_ix += 1
-
-        # save reciprocal rank (first correct index)
-        if in_truth and rr == -1:
-            rr = 1./cur_ix
-            if rr_only: break  # can quit here
-
-        # if a "true" value, get precision at this recall level
-        if in_truth:
-            ap_summer += num_found / cur_ix
-
-        #print('  %10s  %12s  Precision: %.4f' % (
-        #    ranked[cur_ix-1],
-        #    ('Found!' if (ranked[cur_ix-1] in truth) else ''),
-        #    ap_summer / cur_ix
-        #))
-    ap = ap_summer / len(truth)
+    if rr_only:
+        # only the first "true" element is needed
+        for i in range(len(ranked)):
+            if ranked[i] in truth: return (None, 1./(i+1))
+        return (None, -1)
 
-    return (ap, rr)
+    # map arbitrary elements to indices for the batch calculation
+    element_ixes = {}
+    ranked_ixes = [element_ixes.setdefault(r, len(element_ixes)) for r in ranked]
+    truth_ixes = [element_ixes.setdefault(t, len(element_ixes)) for t in truth]
+
+    (ap, rr) = BatchAP_RR([truth_ixes], [ranked_ixes])
+    return (ap[0], rr[0])
 
 def _testmetrics():
     '''Tests IR metrics. calculation with data taken from
@@ -1,5 +1,15 @@
+import os
 import sys
+import json
 import time
+import io
+import cProfile
+import pstats
+import resource
+import threading
+import multiprocessing
+import contextlib
+import tracemalloc
 
 class log:
     logfile=sys.stdout
@@ -7,6 +17,7 @@ class log:
     stopped=False
     tracker=None
     timer=None
+    trace=None
     autoflush=True
 
     @staticmethod
@@ -57,32 +68,34 @@ class log:
         sys.stderr = log.getstream()
 
     @staticmethod
-    def track(total=None, message='{0}%', writeInterval=1, stdoutOnly=True):
+    def track(total=None, message='{0}%', interval=0.5, stdoutOnly=True, shared=False):
+        '''Starts a ProgressTracker for tick() to count towards total,
+        rendering message over the current line at most once every
+        interval seconds.
+
+        message is either a function of (tracker, tick arguments), or a
+        format string given the percentage complete (or the count, with
+        no total) and the tick arguments as positional fields, and
+        current, total, percent, elapsed, rate and eta as named fields
+        (see ProgressTracker.format).
+        '''
         # if message was given as a string, convert it to a lambda function
         if type(message) == type('str'):
-            msgFormat = message 
-            # default to percentage with a total
-            if total: message = lambda current, total, args: str.format(msgFormat, int((float(current)/total)*100), *args)
-            # default to printing current with no total
-            else: message = lambda current, args: str.format(msgFormat, current, *args)
-
-        # set up the onIncrement lambda for current/total or current only
-        if total:
-            onIncrement = lambda current, total, args: log.write(
-                str.format('\r{0}', message(current, total, args)), stdoutOnly=stdoutOnly
-            )
-        else:
-            onIncrement = lambda current, args: log.write(
-                str.format('\r{0}', message(current, args)), stdoutOnly=stdoutOnly
-            )
+            msgFormat = message
+            message = lambda tracker, args: tracker.format(msgFormat, *args)
+
+        onIncrement = lambda tracker, args: log.write(
+            str.format('\r{0}', message(tracker, args)), stdoutOnly=stdoutOnly
+        )
 
-        log.tracker = ProgressTracker(total, onIncrement=onIncrement, writeInterval=writeInterval)
+        log.tracker = ProgressTracker(total, onIncrement=onIncrement, interval=interval, shared=shared)
+        return log.tracker
 
     @staticmethod
-    def tick(*args):
+    def tick(*args, by=1):
         if log.tracker != None:
             if not log.tracker.total or log.tracker.current < log.tracker.total:
-                log.tracker.increment(*args)
+                log.tracker.increment(*args, by=by)
             else:
                 raise Exception('Tracker is complete!')
 
@@ -117,30 +130,135 @@ class log:
         else:
             raise Exception('No timer to stop!')
 
+    @staticmethod
+    def startTrace(trace_memory=False, profile=None):
+        '''Starts recording spans (see span) in a new Trace, replacing any
+        current one; with trace_memory, the peak memory allocated in each
+        span is traced as well (slow), and spans named profile are run
+        under cProfile
+        '''
+        if log.trace is not None: log.trace.close()
+        log.trace = Trace(trace_memory=trace_memory, profile=profile)
+        return log.trace
+
+    @staticmethod
+    def span(name):
+        '''Returns a context manager recording a span of the given name in
+        the current trace, nested in any span open in the same thread;
+        does nothing if no trace is running
+        '''
+        if log.trace is None: return contextlib.nullcontext()
+        return log.trace.span(name)
+
+    @staticmethod
+    def stopTrace(fname=None):
+        '''Stops the current trace and returns it, writing it as JSON to
+        fname (if given); if profiling, the most expensive functions are
+        logged, and the full statistics saved to <fname>.<stage>.prof
+        '''
+        trace = log.trace
+        if trace is None: return None
+        log.trace = None
+        trace.close()
+        if fname:
+            trace.write(fname)
+        if trace.profile and trace.profiled:
+            if fname:
+                trace.writeProfile('%s.%s.prof' % (os.path.splitext(fname)[0], trace.profile))
+            log.writeln('Profile of "%s" spans:' % trace.profile)
+            log.writeln(trace.profileSummary())
+        return trace
+
 class ProgressTracker:
-    def __init__(self, total=None, onIncrement=None, writeInterval=1):
+    '''Counts progress towards an (optional) total, calling
+    onIncrement(tracker, args) to render it at most once every interval
+    seconds.  The count may be updated from several threads or, if
+    shared, from processes forked after the tracker is created.
+    '''
+
+    def __init__(self, total=None, onIncrement=None, interval=0.5, shared=False):
         self.total = total
-        self.current = 0
-        self.sinceLastWrite = 0
         self.onIncrement = onIncrement
-        self.writeInterval = writeInterval
+        self.interval = interval
+        if shared:
+            self._shared = multiprocessing.Value('q', 0)
+            self._lock = self._shared.get_lock()
+        else:
+            self._shared = None
+            self._lock = threading.Lock()
+        self.reset()
+
+    @property
+    def current(self):
+        return self._shared.value if self._shared is not None else self._current
+
+    def add(self, by=1):
+        '''Updates the count, without rendering it
+        '''
+        with self._lock:
+            if self._shared is not None: self._shared.value += by
+            else: self._current += by
 
-    def increment(self, *args):
-        self.current += 1
-        self.sinceLastWrite += 1
-        if self.sinceLastWrite >= self.writeInterval:
-            self.sinceLastWrite = 0
-            self.showProgress(*args)
+    def increment(self, *args, by=1):
+        self.add(by)
+        self.update(*args)
+
+    def update(self, *args):
+        '''Renders the progress if interval seconds have passed since it
+        was last rendered
+        '''
+        now = time.monotonic()
+        # only take the lock when a render looks due
+        if now < self._nextWrite: return
+        with self._lock:
+            due = now >= self._nextWrite
+            if due: self._nextWrite = now + self.interval
+        if due: self.showProgress(*args)
 
     def reset(self):
-        self.current = 0
-        self.sinceLastWrite = 0
+        with self._lock:
+            if self._shared is not None: self._shared.value = 0
+            else: self._current = 0
+        self._started = time.monotonic()
+        self._nextWrite = self._started + self.interval
+
+    def elapsed(self):
+        return time.monotonic() - self._started
+
+    def rate(self):
+        '''Returns the count per second so far
+        '''
+        elapsed = self.elapsed()
+        return (self.current / elapsed) if elapsed > 0 else 0.
+
+    def eta(self):
+        '''Returns the estimated seconds until the total is reached, or
+        None if there is no total or no progress yet
+        '''
+        rate = self.rate()
+        if not self.total or rate <= 0: return None
+        return max(self.total - self.current, 0) / rate
+
+    def format(self, message, *args):
+        '''Formats message with the percentage complete (or the count, with
+        no total) and args as positional fields, and the current count,
+        total, percent, elapsed and eta (as H:MM:SS) and rate (per second)
+        as named fields
+        '''
+        current = self.current
+        percent = int((float(current)/self.total)*100) if self.total else 0
+        return str.format(message, (percent if self.total else current), *args,
+            current=current, total=self.total, percent=percent, rate=self.rate(),
+            elapsed=_formatSeconds(self.elapsed()), eta=_formatSeconds(self.eta()))
 
     def showProgress(self, *args):
         if self.onIncrement:
-            # only call 3-arg onIncrement if we have a total we're counting towards
-            if self.total: self.onIncrement(self.current, self.total, args)
-            else: self.onIncrement(self.current, args)
+            self.onIncrement(self, args)
+
+def _formatSeconds(seconds):
+    if seconds is None: return '?'
+    seconds = int(round(seconds))
+    return '%d:%02d:%02d' % (seconds // 3600, (seconds // 60) % 60, seconds % 60)
 
 class Timer:
     def __init__(self):
@@ -167,3 +285,185 @@ class Timer:
             return self.stopTime - self.startTime
         else:
             return time.time() - self.startTime
+
+def _maxRSS():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+class SpanNode:
+    '''Aggregate of all spans of one name under the same parent:
+        count         :: number of spans
+        wall          :: total wall-clock seconds
+        cpu           :: total CPU seconds (of the whole process)
+        rss_growth    :: total growth in the peak resident set size
+        rss_peak      :: peak resident set size at the end of any span
+        traced_peak   :: largest peak of traced allocations in any span,
+                         over the allocations at its start (None if
+                         memory was not traced)
+    '''
+
+    def __init__(self, name):
+        self.name = name
+        self.count = 0
+        self.wall = 0.
+        self.cpu = 0.
+        self.rss_growth = 0
+        self.rss_peak = 0
+        self.traced_peak = None
+        self.children = {}
+
+    def child(self, name):
+        if not name in self.children:
+            self.children[name] = SpanNode(name)
+        return self.children[name]
+
+    def add(self, wall, cpu, rss_growth, rss_peak, traced_peak=None):
+        self.count += 1
+        self.wall += wall
+        self.cpu += cpu
+        self.rss_growth += rss_growth
+        self.rss_peak = max(self.rss_peak, rss_peak)
+        if traced_peak is not None:
+            self.traced_peak = max(self.traced_peak or 0, traced_peak)
+
+    def toDict(self):
+        return {
+            'name': self.name,
+            'count': self.count,
+            'wall_seconds': self.wall,
+            'cpu_seconds': self.cpu,
+            'rss_growth_bytes': self.rss_growth,
+            'rss_peak_bytes': self.rss_peak,
+            'traced_peak_bytes': self.traced_peak,
+            'children': [child.toDict() for child in self.children.values()],
+        }
+
+class Span:
+    '''Context manager timing one span of a Trace (see Trace.span)
+    '''
+
+    def __init__(self, trace, name):
+        self._trace = trace
+        self.name = name
+        self._peak = 0
+
+    def __enter__(self):
+        trace = self._trace
+        self._stack = stack = trace._stack()
+        with trace._lock:
+            self._node = (stack[-1]._node if stack else trace.root).child(self.name)
+
+        # allocations are only traced in the main thread, where the peak
+        # seen so far is handed to the enclosing span before resetting it
+        self._traced = trace.trace_memory and threading.current_thread() is threading.main_thread()
+        if self._traced:
+            (current, peak) = tracemalloc.get_traced_memory()
+            if stack: stack[-1]._peak = max(stack[-1]._peak, peak)
+            tracemalloc.reset_peak()
+            self._start_traced = self._peak = current
+        self._profiled = self.name == trace.profile and threading.current_thread() is threading.main_thread()
+        if self._profiled: trace._startProfile()
+
+        stack.append(self)
+        self._start_rss = _maxRSS()
+        self._start_cpu = time.process_time()
+        self._timer = Timer()
+        self._timer.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._timer.stop()
+        cpu = time.process_time() - self._start_cpu
+        rss = _maxRSS()
+        # close any spans left open within this one along with it
+        if self in self._stack:
+            while self._stack.pop() is not self: pass
+        if self._profiled: self._trace._stopProfile()
+
+        traced_peak = None
+        if self._traced:
+            peak = max(self._peak, tracemalloc.get_traced_memory()[1])
+            if self._stack: self._stack[-1]._peak = max(self._stack[-1]._peak, peak)
+            traced_peak = peak - self._start_traced
+
+        with self._trace._lock:
+            self._node.add(self._timer.elapsed(), cpu, rss - self._start_rss, rss, traced_peak)
+        return False
+
+class Trace:
+    '''Tree of the named spans recorded in one run, with the spans of the
+    same name under the same parent aggregated into one SpanNode.  Spans
+    nest within each thread; the first spans of other threads go at the
+    root.
+
+    If trace_memory is True, allocations are traced with tracemalloc (in
+    the main thread); if profile is given, spans of that name (in the
+    main thread) are run under cProfile.
+    '''
+
+    def __init__(self, trace_memory=False, profile=None):
+        self.trace_memory = trace_memory
+        self.profile = profile
+        self.profiled = False
+        self.root = SpanNode('run')
+        self.started = time.time()
+        self._start_cpu = time.process_time()
+        self._start_rss = _maxRSS()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._profiler = cProfile.Profile() if profile else None
+        self._profile_depth = 0
+        self._started_tracemalloc = trace_memory and not tracemalloc.is_tracing()
+        if self._started_tracemalloc: tracemalloc.start()
+
+    def span(self, name):
+        return Span(self, name)
+
+    def close(self):
+        if self._profile_depth > 0:
+            self._profiler.disable()
+            self._profile_depth = 0
+        if self._started_tracemalloc:
+            tracemalloc.stop()
+            self._started_tracemalloc = False
+        if self.root.count == 0:
+            rss = _maxRSS()
+            self.root.add(time.time() - self.started, time.process_time() - self._start_cpu, rss - self._start_rss, rss)
+
+    def toDict(self):
+        return {
+            'started': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(self.started)),
+            'argv': sys.argv,
+            'pid': os.getpid(),
+            'trace_memory': self.trace_memory,
+            'profile': self.profile,
+            'spans': self.root.toDict(),
+        }
+
+    def write(self, fname):
+        with open(fname, 'w') as stream:
+            json.dump(self.toDict(), stream, indent=1)
+
+    def writeProfile(self, fname):
+        self._profiler.dump_stats(fname)
+
+    def profileSummary(self, top=20, sort='cumulative'):
+        stream = io.StringIO()
+        pstats.Stats(self._profiler, stream=stream).sort_stats(sort).print_stats(top)
+        return stream.getvalue()
+
+    def _stack(self):
+        if not hasattr(self._local, 'stack'):
+            self._local.stack = []
+        return self._local.stack
+
+    def _startProfile(self):
+        if self._profile_depth == 0:
+            self._profiler.enable()
+        self._profile_depth += 1
+        self.profiled = True
+
+    def _stopProfile(self):
+        self._profile_depth -= 1
+        if self._profile_depth == 0:
+            self._profiler.disable()
@@ -0,0 +1,102 @@
+'''
+Store of per-relation analogy results, as a single SQLite table.
+
+Each row holds the results for one relation under one combination of
+embeddings, setting and analogy method; rows are appended by a single
+writer (other processes write their own stores, to be merged in), and a
+whole table read back in one query.
+'''
+
+import sqlite3
+import numpy as np
+
+# (name, SQL type) of each column; the first four identify a row
+COLUMNS = [
+    ('embeddings', 'TEXT'),
+    ('setting', 'TEXT'),
+    ('method', 'TEXT'),
+    ('relation', 'TEXT'),
+    ('accuracy', 'REAL'),
+    ('map', 'REAL'),
+    ('mrr', 'REAL'),
+    ('correct', 'INTEGER'),
+    ('answered', 'INTEGER'),
+    ('total', 'INTEGER'),
+]
+KEY_COLUMNS = [name for (name, _) in COLUMNS[:4]]
+
+class ResultsStore:
+    '''Results table in the SQLite database at path (created if needed);
+    reads are waited on for up to timeout seconds while it is written
+    '''
+
+    def __init__(self, path, timeout=600):
+        self.path = path
+        self._connection = sqlite3.connect(path, timeout=timeout)
+        with self._connection:
+            self._connection.execute('CREATE TABLE IF NOT EXISTS results (%s, PRIMARY KEY (%s))' % (
+                ', '.join('%s %s' % column for column in COLUMNS), ', '.join(KEY_COLUMNS)
+            ))
+
+    def append(self, rows):
+        '''Adds rows (dictionaries of column values) in a single transaction,
+        replacing any existing rows with the same key
+        '''
+        names = [name for (name, _) in COLUMNS]
+        with self._connection:
+            self._connection.executemany(
+                'INSERT OR REPLACE INTO results (%s) VALUES (%s)' % (', '.join(names), ', '.join('?' * len(names))),
+                [tuple(row[name] for name in names) for row in rows]
+            )
+
+    def merge(self, path):
+        '''Adds all rows of the store at path in a single transaction, in
+        the order they were written there, replacing any existing rows
+        with the same key
+        '''
+        names = ', '.join(name for (name, _) in COLUMNS)
+        self._connection.execute('ATTACH DATABASE ? AS other', (path,))
+        try:
+            with self._connection:
+                self._connection.execute('INSERT OR REPLACE INTO results (%s) SELECT %s FROM other.results ORDER BY rowid' % (
+                    names, names
+                ))
+        finally:
+            self._connection.execute('DETACH DATABASE other')
+
+    def query(self, **filters):
+        '''Returns { column : array of values } for all rows matching the
+        given key column values (e.g., setting='Multi-Answer'), in the
+        order they were (last) written
+        '''
+        for name in filters.keys():
+            if not name in KEY_COLUMNS:
+                raise ValueError('Cannot filter results on "%s"' % name)
+        where = ' AND '.join('%s = ?' % name for name in filters.keys())
+        rows = self._connection.execute('SELECT %s FROM results%s ORDER BY rowid' % (
+            ', '.join(name for (name, _) in COLUMNS), (' WHERE %s' % where) if where else ''
+        ), tuple(filters.values())).fetchall()
+
+        results = {}
+        for i in range(len(COLUMNS)):
+            (name, sql_type) = COLUMNS[i]
+            values = [row[i] for row in rows]
+            if sql_type == 'TEXT': results[name] = np.array(values, dtype=object)
+            elif sql_type == 'REAL': results[name] = np.array(values, dtype=np.float64)
+            else: results[name] = np.array(values, dtype=np.int64)
+        return results
+
+    def close(self):
+        self._connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+def readResults(path, **filters):
+    '''Returns the results in the store at path (see ResultsStore.query)
+    '''
+    with ResultsStore(path) as store:
+        return store.query(**filters)
@@ -66,6 +66,27 @@ def readList(fname, encoding='ascii', readas=str):
 def toCSV(data, sep=',', writeas=str):
     return '\n'.join([sep.join([writeas(c) for c in row]) for row in data])
 
+def formatBytes(nbytes):
+    '''Returns a human-readable version of a size in bytes (e.g., 1.5G)
+    '''
+    for unit in ['B', 'K', 'M', 'G']:
+        if nbytes < 1024: break
+        nbytes /= 1024.
+    else:
+        unit = 'T'
+    return '%.1f%s' % (nbytes, unit)
+
+def parseBytes(size):
+    '''Returns the number of bytes in a size given as a number with an
+    optional unit suffix (e.g., 4G, 512M, 1.5T, 1000)
+    '''
+    match = re.match(r'^\s*([0-9]*\.?[0-9]+)\s*([BKMGT]?)B?\s*$', str(size), re.IGNORECASE)
+    if match is None:
+        raise ValueError('Invalid size "%s"' % size)
+    (number, unit) = match.groups()
+    power = { '': 0, 'B': 0, 'K': 1, 'M': 2, 'G': 3, 'T': 4 }[unit.upper()]
+    return int(float(number) * (1024 ** power))
+
 def bitflag(bln):
     if bln: return 1
     else: return 0
@@ -121,6 +142,47 @@ def prepareForParallel(data, threads, data_only=False):
     if data_only: return [d for (ix, d) in threadchunks]
     else: return threadchunks
 
+def budgetedExecute(jobs, max_processes, memory_budget=None, onStart=None, onFinish=None):
+    '''Runs each job in a forked process, keeping at most max_processes
+    running at once and, if memory_budget is given, only starting a job
+    while the total memory estimate of running jobs stays within it (a
+    job too large for the budget on its own is run alone).  Jobs are
+    started in order, except that a later job may fill room left by an
+    earlier one that doesn't fit yet.
+
+    Parameters:
+        jobs          :: list of (function, estimated bytes)
+        max_processes :: maximum number of concurrent processes
+        memory_budget :: bytes available to running jobs (optional)
+        onStart       :: called with the job index when a job starts
+        onFinish      :: called with (job index, exit code) when it ends
+
+    Returns the exit code of each job, in order.
+    '''
+    import multiprocessing
+    import multiprocessing.connection
+    ctx = multiprocessing.get_context('fork')
+
+    pending, running, exitcodes = list(range(len(jobs))), {}, [None] * len(jobs)
+    while len(pending) > 0 or len(running) > 0:
+        in_use = sum(jobs[i][1] for (i, _) in running.values())
+        for i in list(pending):
+            if len(running) >= max_processes: break
+            fits = (memory_budget is None) or (in_use + jobs[i][1] <= memory_budget)
+            if fits or len(running) == 0:
+                p = ctx.Process(target=jobs[i][0])
+                p.start()
+                running[p.sentinel] = (i, p)
+                pending.remove(i)
+                in_use += jobs[i][1]
+                if onStart: onStart(i)
+        for sentinel in multiprocessing.connection.wait(list(running.keys())):
+            (i, p) = running.pop(sentinel)
+            p.join()
+            exitcodes[i] = p.exitcode
+            if onFinish: onFinish(i, exitcodes[i])
+    return exitcodes
+
 def parallelExecute(processes):
     '''Takes instances of multiprocessing.Process, starts them all executing,
     and returns when they finish.
@@ -0,0 +1,74 @@
+import numpy as np
+from lib.embeddings import cache
+
+def _write(path, contents):
+    with open(path, 'w') as stream:
+        stream.write(contents)
+    return str(path)
+
+def test_cache_depends_on_inputs(tmp_path):
+    fname = _write(tmp_path / 'vectors.bin', 'vectors')
+    vocab = _write(tmp_path / 'vocab.txt', 'a 1\nb 1\n')
+    options = { 'format': 'glove', 'reader': { 'vocab': vocab } }
+    cache.write(fname, ['a', 'b'], np.eye(2), options, inputs=[vocab])
+    assert cache.isFresh(fname, options, inputs=[vocab])
+    assert cache.isFresh(fname, options, verify=True, inputs=[vocab])
+    (words, matrix) = cache.read(fname)
+    assert words == ['a', 'b'] and (matrix == np.eye(2)).all()
+
+    # a changed vocabulary invalidates the cache, as a changed source does
+    _write(tmp_path / 'vocab.txt', 'a 1\nb 1\nc 1\n')
+    assert not cache.isFresh(fname, options, inputs=[vocab])
+    cache.write(fname, ['a', 'b'], np.eye(2), options, inputs=[vocab])
+    assert cache.isFresh(fname, options, inputs=[vocab])
+    _write(tmp_path / 'vectors.bin', 'changed vectors')
+    assert not cache.isFresh(fname, options, inputs=[vocab])
+
+def _corrupt(cache_files):
+    for cache_file in cache_files:
+        with open(cache_file, 'r+b') as stream:
+            stream.truncate(len(stream.read()) // 2)
+
+def test_corrupt_alias_cache_is_rebuilt(tmp_path):
+    from lib.embeddings import alias
+    words = ['a', 'b', 'c']
+    terms = ['a b', 'c', 'a d', 'd']
+    embed_array = np.arange(9, dtype=np.float32).reshape((3, 3))
+    cache_prefix = str(tmp_path / 'terms')
+    expected = alias.aliasEmbeddings(terms, words, embed_array, cache_prefix=cache_prefix)
+
+    _corrupt(tmp_path.glob('*.alias.npz'))
+    (alias_terms, alias_array) = alias.aliasEmbeddings(terms, words, embed_array, cache_prefix=cache_prefix)
+    assert alias_terms == expected[0] and (alias_array == expected[1]).all()
+    # and rewritten
+    assert alias._readCache(next(tmp_path.glob('*.alias.npz')), alias._cacheKey(terms, words)) is not None
+
+def test_corrupt_ivf_cache_is_rebuilt(tmp_path):
+    from lib.embeddings import ivf
+    embed_array = np.random.RandomState(0).randn(200, 8).astype(np.float32)
+    cache_prefix = str(tmp_path / 'vectors')
+    expected = ivf.loadOrBuild(embed_array, cache_prefix=cache_prefix, num_lists=4)
+
+    _corrupt(tmp_path.glob('*.ivf.npz'))
+    index = ivf.loadOrBuild(embed_array, cache_prefix=cache_prefix, num_lists=4)
+    assert (index.order == expected.order).all() and (index.offsets == expected.offsets).all()
+
+def test_float64_read_bypasses_cache(tmp_path):
+    from lib import embeddings
+    from lib.embeddings import Format
+    # GloVe stores float64, with a bias at the end of each half
+    stored = np.random.RandomState(0).randn(3, 2*4)
+    fname = str(tmp_path / 'vectors.bin')
+    stored.tofile(fname)
+    vocab = _write(tmp_path / 'vocab.txt', 'a 1\nb 1\nc 1\n')
+    embeddings.buildCache(fname, Format.Glove, normed=False, vocab=vocab)
+    assert cache.isFresh(fname, embeddings._cacheOptions(Format.Glove, False, False, { 'vocab': vocab }), inputs=[vocab])
+
+    (_, uncached) = embeddings.readMatrix(fname, Format.Glove, use_cache=False, dtype='float64', vocab=vocab)
+    (_, vectors) = embeddings.readMatrix(fname, Format.Glove, dtype='float64', vocab=vocab)
+    assert vectors.dtype == np.float64 and (vectors == uncached).all()
+    assert not (uncached == uncached.astype(np.float32)).all()
+
+    # float32 reads still come from the cache
+    (_, vectors) = embeddings.readMatrix(fname, Format.Glove, dtype='float32', vocab=vocab)
+    assert isinstance(vectors, np.memmap) and (vectors == uncached.astype(np.float32)).all()
@@ -0,0 +1,73 @@
+import array
+import numpy as np
+import pytest
+from lib.embeddings import glove, word2vec
+
+def _readBinReference(fname):
+    # the original word-at-a-time reader
+    words, vectors = [], []
+    with open(fname, 'rb') as inf:
+        (num_words, dim) = [int(s) for s in inf.readline().decode('utf-8').split()][:2]
+        (cur_ix, next_chunk) = (inf.tell(), inf.read(40960))
+        while len(next_chunk) > 0:
+            inf.seek(cur_ix)
+            splitix = next_chunk.index(b' ')
+            words.append(inf.read(splitix).decode('utf-8'))
+            inf.seek(1, 1)
+            vectors.append(array.array('f', inf.read(dim*4)))
+            inf.seek(1, 1)
+            (cur_ix, next_chunk) = (inf.tell(), inf.read(40960))
+    assert len(words) == num_words
+    return (words, np.array(vectors, dtype=np.float32))
+
+def _writeWord2Vec(path, num_words=3, dim=4):
+    vectors = np.random.RandomState(0).randn(num_words, dim).astype(np.float32)
+    word2vec.write({ ('w%d' % i) if i != 1 else 'wörd': vectors[i] for i in range(num_words) }, str(path))
+    return str(path)
+
+def test_read_binary_matches_original_reader(tmp_path):
+    fname = _writeWord2Vec(tmp_path / 'emb.bin')
+    (words, vectors) = word2vec.read(fname)
+    (expected_words, expected_vectors) = _readBinReference(fname)
+    assert words == expected_words
+    assert vectors.dtype == np.float32 and np.array_equal(vectors, expected_vectors)
+    assert word2vec.readShape(fname) == (3, 4)
+
+    # likewise into a memory-mapped matrix
+    (words, vectors) = word2vec.read(fname, matrix_file=str(tmp_path / 'emb.npy'))
+    assert words == expected_words and np.array_equal(vectors, expected_vectors)
+
+@pytest.mark.parametrize('cut', [2, 17, 20, 40])
+def test_read_truncated_binary_fails(tmp_path, cut):
+    fname = _writeWord2Vec(tmp_path / 'emb.bin')
+    with open(fname, 'r+b') as stream:
+        stream.truncate(len(stream.read()) - cut)
+    with pytest.raises(ValueError):
+        word2vec.read(fname)
+
+def test_read_glove_modes(tmp_path):
+    # 3 words, with 4-d word and context vectors, each ending in its bias
+    stored = np.random.RandomState(0).randn(3, 2*4)
+    fname = str(tmp_path / 'vectors.bin')
+    stored.tofile(fname)
+    vocab = str(tmp_path / 'vocab.txt')
+    with open(vocab, 'w') as stream:
+        stream.write('a 5\nb 3\nc 1\n')
+    (word_vectors, context_vectors) = (stored[:, :4], stored[:, 4:])
+
+    for include_bias in (False, True):
+        out_dim = 4 if include_bias else 3
+        expected = {
+            glove.GloveMode.IgnoreContexts: word_vectors[:, :out_dim],
+            glove.GloveMode.SumContexts: word_vectors[:, :out_dim] + context_vectors[:, :out_dim],
+            glove.GloveMode.GetContexts: np.stack([word_vectors[:, :out_dim], context_vectors[:, :out_dim]], axis=1),
+        }
+        assert glove.readShape(fname, vocab, include_bias=include_bias) == (3, out_dim)
+        for (mode, mode_expected) in expected.items():
+            (words, vectors) = glove.read(fname, vocab=vocab, mode=mode, include_bias=include_bias)
+            assert words == ['a', 'b', 'c']
+            assert vectors.dtype == np.float64 and np.array_equal(vectors, mode_expected)
+
+            # converted in the same step, as from the full-precision sums
+            (_, vectors) = glove.read(fname, vocab=['a', 'b', 'c'], mode=mode, include_bias=include_bias, dtype='float32')
+            assert vectors.dtype == np.float32 and np.array_equal(vectors, mode_expected.astype(np.float32))
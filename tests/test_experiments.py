@@ -0,0 +1,21 @@
+import numpy as np
+from analogy_task.analogy_model import Backend
+from analogy_task.experiments_for_paper import estimateMemory
+from analogy_task.quantized_model import Precision
+from lib import embeddings
+
+def test_memory_estimate_follows_backend(tmp_path):
+    embedf = str(tmp_path / 'emb.bin')
+    (vocab_size, dim) = (2000, 50)
+    vectors = np.random.RandomState(0).randn(vocab_size, dim).astype(np.float32)
+    embeddings.word2vec.write({ 'w%d' % i: vectors[i] for i in range(vocab_size) }, embedf)
+    estimate = lambda **kwargs: estimateMemory(embedf, row_cache_bytes=0, **kwargs)
+
+    dense = estimate()
+    # scoring memory grows with the candidates scored at once, and the number of workers
+    assert estimate(tile_size=100) < dense < estimate(num_aliases=2*vocab_size)
+    assert estimate(workers=2) - estimate(max_scoring_bytes=0) == 2 * (dense - estimate(max_scoring_bytes=0))
+    assert estimate(max_scoring_bytes=1<<20) == estimate(max_scoring_bytes=0) + (1<<20)
+    # the quantized copy is kept alongside the candidates
+    assert (estimate(backend=Backend.Quantized, quantized_options={ 'precision': Precision.Float16 }) -
+        estimate(backend=Backend.Quantized, quantized_options={ 'precision': Precision.Int8 })) == vocab_size * (dim - 4)
@@ -0,0 +1,51 @@
+import numpy as np
+from lib.ir_metrics import AP_RR, AveragePrecision, ReciprocalRank, BatchAP_RR, RankedAP_RR
+
+def _scalarAP_RR(truth, ranked):
+    '''The original one-query-at-a-time calculation, for reference
+    '''
+    cur_ix, num_found = 0, 0
+    ap_summer, rr = 0, -1
+    while num_found < len(truth) and cur_ix < len(ranked):
+        in_truth = ranked[cur_ix] in truth
+        cur_ix += 1
+        if in_truth:
+            num_found += 1
+            if rr == -1: rr = 1./cur_ix
+            ap_summer += num_found / cur_ix
+    return (ap_summer / len(truth), rr)
+
+def _cases(num_queries=200, vocab_size=50, depth=20, max_truth=4, seed=0):
+    random_state = np.random.RandomState(seed)
+    ranked = np.array([random_state.permutation(vocab_size)[:depth] for _ in range(num_queries)])
+    truth = random_state.randint(-2, vocab_size, size=(num_queries, max_truth))
+    # at least one "true" element per query, some of them repeated
+    truth[:, 0] = random_state.randint(0, vocab_size, size=num_queries)
+    truth[::7, 1] = truth[::7, 0]
+    return (truth, ranked)
+
+def test_batch_matches_scalar():
+    (truth, ranked) = _cases()
+    (ap, rr) = BatchAP_RR(truth, ranked)
+    for i in range(len(truth)):
+        expected = _scalarAP_RR(set(truth[i][truth[i] >= 0].tolist()), ranked[i].tolist())
+        assert np.isclose(ap[i], expected[0]) and np.isclose(rr[i], expected[1])
+
+def test_ranked_matches_scalar():
+    (truth, ranked) = _cases(depth=50)
+    # ranks in the complete ranking, from each candidate's position
+    positions = np.argsort(ranked, axis=1)
+    ranks = np.where(truth >= 0, np.take_along_axis(positions, np.maximum(truth, 0), axis=1) + 1, 0)
+    (ap, rr) = RankedAP_RR(ranks)
+    for i in range(len(truth)):
+        expected = _scalarAP_RR(set(truth[i][truth[i] >= 0].tolist()), ranked[i].tolist())
+        assert np.isclose(ap[i], expected[0]) and np.isclose(rr[i], expected[1])
+
+def test_single_query():
+    truth = set([1,2,3,4,5])
+    ranked = [6,4,7,1,2]
+    assert np.isclose(AveragePrecision(truth, ranked), 0.32)
+    assert np.isclose(ReciprocalRank(truth, ranked), 0.5)
+    assert np.allclose(AP_RR(truth, ranked), _scalarAP_RR(truth, ranked))
+    assert ReciprocalRank('cats', ['catten', 'cati', 'cats']) == 1./3
+    assert ReciprocalRank('cats', ['catten', 'cati']) == -1
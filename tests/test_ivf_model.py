@@ -0,0 +1,40 @@
+import os
+import numpy as np
+from analogy_task.analogy_model import Mode
+from analogy_task.ivf_model import IVFAnalogyModel
+from analogy_task.numpy_model import NumpyAnalogyModel
+from lib.embeddings import ivf
+from tests.test_numpy_model import _embeddings, _queries
+
+def test_rerank_matches_exact_search_over_all_lists():
+    # float64, so that gathered and exact scores agree to well within
+    # the gaps between candidates
+    embeds = _embeddings(vocab_size=200).astype(np.float64)
+    analogy_embs = _queries(embeds)
+    modes = [Mode.ThreeCosAdd, Mode.ThreeCosMul, Mode.PairwiseDistance]
+    index = ivf.buildIndex(embeds / np.linalg.norm(embeds, axis=1, keepdims=True), num_lists=4)
+    # a small gather budget, so that the queries are scored in several chunks
+    model = IVFAnalogyModel(embeds, index=index, probes=4, rerank_depth=len(embeds), recall_sample=0, gather_bytes=1<<14)
+    exact = NumpyAnalogyModel(embeds, full_sort=True)
+    approximate = { mode: ix for (mode, ix, _) in model._rankModes(analogy_embs, 10, modes) }
+    for (mode, ix, _) in exact._rankModes(analogy_embs, 10, modes):
+        assert (approximate[mode] == ix).all()
+
+def test_cache_key_depends_on_sources(tmp_path):
+    embeds = _embeddings(vocab_size=50)
+    source = tmp_path / 'vectors.txt'
+    source.write_text('vectors')
+    key = ivf._cacheKey(embeds, [str(source)], 4, 10, 0)
+    assert key == ivf._cacheKey(embeds, [str(source)], 4, 10, 0)
+    assert key != ivf._cacheKey(embeds, [str(source)], 8, 10, 0)
+
+    # a rewritten source invalidates the key, though the matrix is unchanged
+    source.write_text('changed vectors')
+    assert key != ivf._cacheKey(embeds, [str(source)], 4, 10, 0)
+    stats = os.stat(source)
+    key = ivf._cacheKey(embeds, [str(source)], 4, 10, 0)
+    os.utime(source, ns=(stats.st_atime_ns, stats.st_mtime_ns + 10**9))
+    assert key != ivf._cacheKey(embeds, [str(source)], 4, 10, 0)
+
+    # without sources, the contents are hashed
+    assert ivf._cacheKey(embeds, [], 4, 10, 0) != ivf._cacheKey(embeds * 2, [], 4, 10, 0)
@@ -0,0 +1,97 @@
+import multiprocessing
+import pytest
+from lib import logging
+from lib.logging import log, Trace, ProgressTracker
+
+def test_span_closes_spans_left_open_within_it():
+    trace = Trace()
+    outer = trace.span('outer').__enter__()
+    # never exited, e.g. a timer span whose block raised
+    trace.span('inner').__enter__()
+    outer.__exit__(None, None, None)
+    assert trace._stack() == []
+    with trace.span('after'):
+        pass
+    assert set(trace.root.children.keys()) == {'outer', 'after'}
+
+def test_span_exit_leaves_other_spans_alone():
+    trace = Trace()
+    outer = trace.span('outer').__enter__()
+    inner = trace.span('inner').__enter__()
+    outer.__exit__(None, None, None)
+    other = trace.span('other').__enter__()
+    # already closed along with outer, so other stays open
+    inner.__exit__(None, None, None)
+    assert trace._stack() == [other]
+    other.__exit__(None, None, None)
+    assert trace.root.children['outer'].children['inner'].count == 1
+
+def test_span_is_closed_when_block_raises():
+    trace = log.startTrace()
+    try:
+        with pytest.raises(ValueError):
+            with log.span('failing'):
+                raise ValueError()
+        assert trace._stack() == []
+        assert trace.root.children['failing'].count == 1
+    finally:
+        log.stopTrace()
+    # without a trace, spans do nothing
+    with log.span('untraced'):
+        pass
+
+class _Clock:
+    def __init__(self):
+        self.now = 100.
+    def monotonic(self):
+        return self.now
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = _Clock()
+    monkeypatch.setattr(logging, 'time', clock)
+    return clock
+
+def test_progress_renders_by_time_not_count(clock):
+    rendered = []
+    tracker = ProgressTracker(1000, onIncrement=lambda tracker, args: rendered.append(tracker.current), interval=10)
+    for _ in range(500): tracker.increment()
+    assert rendered == []
+    clock.now += 10
+    for _ in range(500): tracker.increment()
+    # once when the interval passed, not again for the rest
+    assert rendered == [501]
+    clock.now += 9.5
+    tracker.update()
+    assert rendered == [501]
+    clock.now += 0.5
+    tracker.update()
+    assert rendered == [501, 1000]
+
+def test_progress_rate_and_eta(clock):
+    tracker = ProgressTracker(100)
+    assert tracker.rate() == 0. and tracker.eta() is None
+    clock.now += 4
+    tracker.add(20)
+    assert tracker.rate() == 5. and tracker.eta() == 16.
+    assert tracker.format('{0}% {current}/{total} {rate:.1f}/s {elapsed} ETA {eta}') == '20% 20/100 5.0/s 0:00:04 ETA 0:00:16'
+    tracker.add(90)
+    assert tracker.eta() == 0.
+    # with no total, there is no ETA
+    tracker = ProgressTracker()
+    clock.now += 2
+    tracker.add(3)
+    assert tracker.format('{0} {rate:.1f}/s ETA {eta}') == '3 1.5/s ETA ?'
+
+@pytest.mark.skipif(not 'fork' in multiprocessing.get_all_start_methods(), reason='needs fork()')
+def test_shared_progress_counts_forked_increments():
+    rendered = []
+    tracker = ProgressTracker(10, onIncrement=lambda tracker, args: rendered.append(tracker.current), interval=0, shared=True)
+    tracker.add(2)
+    process = multiprocessing.get_context('fork').Process(target=tracker.increment, kwargs={ 'by': 5 })
+    process.start()
+    process.join()
+    assert process.exitcode == 0
+    assert tracker.current == 7
+    tracker.update()
+    assert rendered == [7]
@@ -0,0 +1,186 @@
+import numpy as np
+from analogy_task.analogy_model import Mode
+from analogy_task.embedding_wrapper import EmbeddingWrapper
+from analogy_task.numpy_model import NumpyAnalogyModel
+
+def _embeddings(vocab_size=300, dim=16, seed=0):
+    random_state = np.random.RandomState(seed)
+    embeds = random_state.randn(vocab_size, dim).astype(np.float32)
+    # norms well away from 1, so that scale matters
+    embeds *= random_state.uniform(0.2, 5, size=(vocab_size, 1)).astype(np.float32)
+    return embeds
+
+def _queries(embeds, num_queries=40, seed=1):
+    random_state = np.random.RandomState(seed)
+    ixes = random_state.randint(0, len(embeds), size=(num_queries, 3))
+    return embeds[ixes]
+
+def test_pairwise_distance_uses_original_scale():
+    embeds = _embeddings().astype(np.float64)
+    analogy_embs = _queries(embeds)
+    (a, b, c) = (analogy_embs[:,0,:], analogy_embs[:,1,:], analogy_embs[:,2,:])
+
+    # cos(b-a, v-c), directly
+    offsets = embeds[np.newaxis, :, :] - c[:, np.newaxis, :]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        expected = np.einsum('bd,bvd->bv', b - a, offsets) / (
+            np.linalg.norm(b - a, axis=1)[:, np.newaxis] * np.linalg.norm(offsets, axis=2))
+    # c itself has no offset, and is ranked last
+    expected[np.linalg.norm(offsets, axis=2) == 0] = -np.inf
+
+    model = NumpyAnalogyModel(embeds, mode=Mode.PairwiseDistance)
+    assert np.allclose(model._scoreBatch(analogy_embs), expected, rtol=1e-6, atol=1e-9)
+
+    # given already unit-normed, with the original norms from the wrapper
+    emb_wrapper = EmbeddingWrapper((list(range(len(embeds))), embeds), dtype=np.float64)
+    model = NumpyAnalogyModel(emb_wrapper.asArray(), mode=Mode.PairwiseDistance, normed=True, norms=emb_wrapper.norms())
+    assert np.allclose(model._scoreBatch(analogy_embs), expected, rtol=1e-6, atol=1e-9)
+
+def _analogies(vocab_size, num_queries=40, max_answers=3, seed=2):
+    random_state = np.random.RandomState(seed)
+    analogies = np.hstack([
+        random_state.randint(0, vocab_size, size=(num_queries, 3)),
+        random_state.randint(-2, vocab_size, size=(num_queries, max_answers)),
+    ])
+    # one query with no valid answers, to be skipped
+    analogies[0, 3:] = -1
+    return analogies
+
+def _tiedScores(seed=3):
+    # few distinct values, so that many candidates tie (including at the top-k cutoff)
+    return np.random.RandomState(seed).randint(0, 8, size=(30, 200)).astype(np.float32)
+
+def test_top_k_matches_full_sort():
+    dists = _tiedScores()
+    model = NumpyAnalogyModel(_embeddings(vocab_size=200))
+    full = np.argsort(-dists, axis=1, kind='stable')
+    for k in (1, 4, 17, 199, 200):
+        assert (model._topK(dists, k) == full[:, :k]).all()
+
+def test_answer_ranks_match_full_sort():
+    dists = _tiedScores()
+    model = NumpyAnalogyModel(_embeddings(vocab_size=200))
+    answers = _analogies(200, num_queries=30)[:, 3:]
+    full = np.argsort(-dists, axis=1, kind='stable')
+    positions = np.argsort(full, axis=1)
+    expected = np.where(answers >= 0, np.take_along_axis(positions, np.maximum(answers, 0), axis=1) + 1, 0)
+    assert (model._answerRanks(dists, answers) == expected).all()
+
+def test_eval_matches_full_sort():
+    embeds = _embeddings()
+    analogies = _analogies(len(embeds))
+    analogy_embs = embeds[analogies[:, :3]]
+    for mode in (Mode.ThreeCosAdd, Mode.PairwiseDistance, Mode.ThreeCosMul):
+        full = NumpyAnalogyModel(embeds, mode=mode, full_sort=True).eval(analogies, analogy_embs, batch_size=16)
+        top = NumpyAnalogyModel(embeds, mode=mode).eval(analogies, analogy_embs, batch_size=16)
+        assert full[0] == top[0] and full[3:5] == top[3:5]
+        assert np.isclose(full[1], top[1]) and np.isclose(full[2], top[2])
+        (full_correct, _, full_top_k, _) = full[5]
+        (top_correct, _, top_top_k, _) = top[5]
+        assert (full_correct == top_correct).all() and (full_top_k == top_top_k).all()
+
+def test_eval_scores_in_model_dtype():
+    embeds = _embeddings().astype(np.float64)
+    analogies = _analogies(len(embeds))
+    model = NumpyAnalogyModel(embeds)
+    (rank_modes, dtypes) = (model._rankModes, [])
+    def _rankModes(analogy_embs, *args, **kwargs):
+        dtypes.append(analogy_embs.dtype)
+        return rank_modes(analogy_embs, *args, **kwargs)
+    model._rankModes = _rankModes
+    model.eval(analogies, embeds[analogies[:, :3]], batch_size=16)
+    assert len(dtypes) > 0 and all(dtype == np.float64 for dtype in dtypes)
+
+def test_kernels_match_direct_formulas():
+    embeds = _embeddings().astype(np.float64)
+    analogy_embs = _queries(embeds)
+    (a, b, c) = (analogy_embs[:,0,:], analogy_embs[:,1,:], analogy_embs[:,2,:])
+    unit = lambda m: m / np.linalg.norm(m, axis=-1, keepdims=True)
+    candidates = unit(embeds)
+
+    expected = {
+        Mode.ThreeCosAdd: np.dot(b - a + c, candidates.T),
+        Mode.ThreeCosMul: (np.dot(unit(b), candidates.T) * np.dot(unit(c), candidates.T)) /
+            (np.dot(unit(a), candidates.T) + 0.000001),
+    }
+    for (mode, mode_expected) in expected.items():
+        model = NumpyAnalogyModel(embeds, mode=mode)
+        assert np.allclose(model._scoreBatch(analogy_embs), mode_expected, rtol=1e-6, atol=1e-9)
+
+def _assertSameResults(results, expected):
+    assert results[0] == expected[0] and results[1:5] == expected[1:5]
+    for (array, expected_array) in zip(results[5], expected[5]):
+        assert np.array_equal(array, expected_array, equal_nan=True)
+
+def test_cold_and_warm_row_cache_match():
+    embeds = _embeddings(vocab_size=500)
+    analogies = _analogies(len(embeds), num_queries=60)
+    analogy_embs = embeds[analogies[:, :3]]
+    for mode in (Mode.ThreeCosAdd, Mode.PairwiseDistance, Mode.ThreeCosMul):
+        expected = NumpyAnalogyModel(embeds, mode=mode, row_cache_bytes=0).eval(analogies, analogy_embs, batch_size=60)
+
+        # warm the cache with some of the same terms, scored in other batches
+        model = NumpyAnalogyModel(embeds, mode=mode)
+        model.eval(analogies[::3], analogy_embs[::3], batch_size=7)
+        hits = model.rowCache().hits
+        _assertSameResults(model.eval(analogies, analogy_embs, batch_size=13), expected)
+        assert model.rowCache().hits > hits
+
+def test_tiled_matches_dense():
+    embeds = _embeddings(vocab_size=500)
+    analogies = _analogies(len(embeds), num_queries=60)
+    analogy_embs = embeds[analogies[:, :3]]
+    for mode in (Mode.ThreeCosAdd, Mode.PairwiseDistance, Mode.ThreeCosMul):
+        expected = NumpyAnalogyModel(embeds, mode=mode).eval(analogies, analogy_embs, batch_size=16)
+        for tile_size in (1, 7, 64, 100, 499, 500, 1000):
+            model = NumpyAnalogyModel(embeds, mode=mode, tile_size=tile_size)
+            _assertSameResults(model.eval(analogies, analogy_embs, batch_size=16), expected)
+
+def test_tiled_answers_are_recounted_from_their_tiles():
+    embeds = _embeddings(vocab_size=300)
+    analogies = _analogies(len(embeds))
+    analogy_embs = embeds[analogies[:, :3]]
+    expected = NumpyAnalogyModel(embeds, mode=Mode.ThreeCosMul).eval(analogies, analogy_embs, batch_size=16)
+
+    # provisional scores that are all off: every answer is recounted
+    model = NumpyAnalogyModel(embeds, mode=Mode.ThreeCosMul, tile_size=64)
+    provisional_scores = model._provisionalScores
+    model._provisionalScores = lambda *args: { mode: dists + 1 for (mode, dists) in provisional_scores(*args).items() }
+    _assertSameResults(model.eval(analogies, analogy_embs, batch_size=16), expected)
+
+def test_memory_error_backoff_matches_no_backoff():
+    embeds = _embeddings(vocab_size=300)
+    analogies = _analogies(len(embeds), num_queries=50)
+    analogy_embs = embeds[analogies[:, :3]]
+    modes = [Mode.ThreeCosAdd, Mode.PairwiseDistance, Mode.ThreeCosMul]
+    for tile_size in (None, 64):
+        expected = NumpyAnalogyModel(embeds, tile_size=tile_size).evalMethods(
+            analogy_embs, [(analogies, np.arange(len(analogies)))], modes, batch_size=50)
+
+        # batches of more than 12 queries run out of memory, part-way through scoring
+        model = NumpyAnalogyModel(embeds, tile_size=tile_size)
+        rank_modes = model._rankModes
+        def _rankModes(analogy_embs, *args, **kwargs):
+            for (i, ranking) in enumerate(rank_modes(analogy_embs, *args, **kwargs)):
+                if i > 0 and len(analogy_embs) > 12: raise MemoryError()
+                yield ranking
+        model._rankModes = _rankModes
+        results = model.evalMethods(analogy_embs, [(analogies, np.arange(len(analogies)))], modes, batch_size=50)
+        assert model.scoringStats()['batch_backoffs'] == 2
+        for mode in modes:
+            _assertSameResults(results[mode][0], expected[mode][0])
+
+def test_methods_match_single_method_eval():
+    embeds = _embeddings(vocab_size=300)
+    analogies = _analogies(len(embeds), num_queries=50)
+    analogy_embs = embeds[analogies[:, :3]]
+    modes = [Mode.ThreeCosAdd, Mode.PairwiseDistance, Mode.ThreeCosMul]
+    for tile_size in (None, 64):
+        # two sets asking the same queries, in a different order
+        order = np.arange(len(analogies))[::-1]
+        results = NumpyAnalogyModel(embeds, tile_size=tile_size).evalMethods(
+            analogy_embs, [(analogies, np.arange(len(analogies))), (analogies[order], order)], modes, batch_size=16)
+        for mode in modes:
+            model = NumpyAnalogyModel(embeds, mode=mode, tile_size=tile_size)
+            _assertSameResults(results[mode][0], model.eval(analogies, analogy_embs, batch_size=16))
+            _assertSameResults(results[mode][1], model.eval(analogies[order], analogy_embs[order], batch_size=16))
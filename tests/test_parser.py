@@ -0,0 +1,70 @@
+import pytest
+from BMASS import parser, settings
+
+def _baselineEntries(entry):
+    '''The original character-by-character split, for reference
+    '''
+    entries = []
+    cur_entry, in_string = [], False
+    for char in entry:
+        if char == ',' and not in_string:
+            entries.append(''.join(cur_entry))
+            cur_entry = []
+        else:
+            cur_entry.append(char)
+            if char == '"': in_string = not in_string
+    entries.append(''.join(cur_entry))
+    return entries
+
+def _write(tmp_path, lines):
+    path = tmp_path / 'analogies.txt'
+    path.write_text('\n'.join(lines) + '\n', encoding='utf-8')
+    return str(path)
+
+def test_multiple_entries_match_baseline():
+    for entry in ['C1:"a"', 'C1:"a",C2:"b"', 'C1:"a, b",C2:"c"', 'C1:"a",,C2:"b"', 'C1:"a",', ',C1:"a"',
+            'C1:"a "" b",C2:"c, d"', 'C1:"unclosed, x', '']:
+        assert parser._readMultipleEntries(entry) == _baselineEntries(entry)
+
+def test_parse_multiple_entries(tmp_path):
+    analogy_file = _write(tmp_path, [
+        '# R0: first',
+        'C1:"a, b"\tC2:"b"\tC3:"c"\tC4:"d, e",C5:"f"',
+    ])
+    analogies = parser.read(analogy_file, settings.MULTI_ANSWER)
+    assert analogies == { 'R0: first': [(('C1', 'a, b'), ('C2', 'b'), ('C3', 'c'), [('C4', 'd, e'), ('C5', 'f')])] }
+
+@pytest.mark.parametrize('line', [
+    'C1:"a"\tC2:"b"\tC3:"c"\tC4:"d",,C5:"f"',
+    'C1:"a"\tC2:"b"\tC3:"c"\tC4:"d",',
+    'C1:"a"\tC2:"b"\tC3:"c"\t',
+    'C1:"a"\tC2:"b"\tC3:"c"',
+])
+def test_malformed_lines_fail(tmp_path, line):
+    analogy_file = _write(tmp_path, ['# R0: first', 'C1:"a"\tC2:"b"\tC3:"c"\tC4:"d"', line])
+    for use_cache in (False, True):
+        with pytest.raises(ValueError, match='line 3'):
+            parser.read(analogy_file, settings.MULTI_ANSWER, use_cache=use_cache)
+
+def test_cache_matches_parse(tmp_path):
+    analogy_file = _write(tmp_path, [
+        '# R0: first',
+        'C1:"a, b"\tC2:"x:y"\tC3:"c"\tC4:"d, e",C5:"f",C6:"g:h, i"',
+        '# R1: second',
+        'C9:"q"\tC8:"r"\tC7:"s"\tC6:"t"',
+    ])
+    for setting in (settings.ALL_INFO, settings.MULTI_ANSWER, settings.SINGLE_ANSWER):
+        for strings_only in (False, True):
+            expected = parser.read(analogy_file, setting, strings_only=strings_only)
+            assert list(expected.keys()) == ['R0: first', 'R1: second']
+            # compiled, then read back from the cache
+            assert parser.read(analogy_file, setting, strings_only=strings_only, use_cache=True) == expected
+            assert parser.read(analogy_file, setting, strings_only=strings_only, use_cache=True) == expected
+
+def test_cache_without_headers(tmp_path):
+    # analogies in a file with no relation headers go under relation None
+    analogy_file = _write(tmp_path, ['C1:"a"\tC2:"b"\tC3:"c"\tC4:"d"'])
+    expected = parser.read(analogy_file, settings.SINGLE_ANSWER)
+    assert expected == { None: [(('C1', 'a'), ('C2', 'b'), ('C3', 'c'), ('C4', 'd'))] }
+    assert parser.read(analogy_file, settings.SINGLE_ANSWER, use_cache=True) == expected
+    assert parser.read(analogy_file, settings.SINGLE_ANSWER, use_cache=True) == expected
@@ -0,0 +1,41 @@
+import numpy as np
+import pytest
+from analogy_task.predictions import Format, RelationPredictions, PredictionsWriter
+
+def _predictions():
+    return RelationPredictions([('a', 'b', 'c', 'd')], np.array([[0, 1, 2, 3]]), np.array([True]),
+        np.array([4]), np.array([[3, 2]]), np.array([[0.5, 0.25]]))
+
+class _BrokenPredictions:
+    def strings(self, vocab):
+        raise KeyError('broken')
+
+def test_writes_text_and_binary(tmp_path):
+    vocab = ['a', 'b', 'c', 'd']
+    with PredictionsWriter(str(tmp_path / 'predictions.txt'), vocab) as writer:
+        writer.write('rel', _predictions())
+    assert not writer._thread.is_alive()
+    text = (tmp_path / 'predictions.txt').read_text()
+    assert 'a:b::c:d' in text and 'Correct: True' in text
+
+    with PredictionsWriter(str(tmp_path / 'binary'), vocab, format=Format.Binary, setting=1) as writer:
+        writer.write('rel', _predictions())
+    with np.load(str(tmp_path / 'binary' / 'rel.npz')) as arrays:
+        assert (arrays['top_k'] == [[3, 2]]).all()
+    assert (tmp_path / 'binary' / 'vocab.txt').read_text().split() == vocab
+
+def test_writing_errors_are_raised_in_caller(tmp_path):
+    writer = PredictionsWriter(str(tmp_path / 'predictions.txt'), ['a'])
+    writer.write('rel', _BrokenPredictions())
+    with pytest.raises(IOError) as error:
+        writer.close()
+    assert isinstance(error.value.__cause__, KeyError)
+    assert not writer._thread.is_alive()
+
+def test_writer_is_closed_when_block_fails(tmp_path):
+    # the original error is raised, not the writer's
+    with pytest.raises(ValueError):
+        with PredictionsWriter(str(tmp_path / 'predictions.txt'), ['a']) as writer:
+            writer.write('rel', _BrokenPredictions())
+            raise ValueError('failed')
+    assert not writer._thread.is_alive()
@@ -0,0 +1,48 @@
+import numpy as np
+from analogy_task.analogy_model import Mode
+from analogy_task.embedding_wrapper import EmbeddingWrapper
+from analogy_task.numpy_model import NumpyAnalogyModel
+from analogy_task.quantized_model import Precision, QuantizedAnalogyModel
+from tests.test_numpy_model import _embeddings, _analogies, _assertSameResults
+
+_modes = [Mode.ThreeCosAdd, Mode.PairwiseDistance, Mode.ThreeCosMul]
+
+def _evalMethods(model, analogies, analogy_embs):
+    return model.evalMethods(analogy_embs, [(analogies, np.arange(len(analogies)))], _modes, batch_size=16)
+
+def test_full_depth_rerank_matches_exact():
+    embeds = _embeddings(vocab_size=500)
+    analogies = _analogies(len(embeds), num_queries=60)
+    analogy_embs = embeds[analogies[:, :3]]
+    emb_wrapper = EmbeddingWrapper((list(range(len(embeds))), embeds), copy=False)
+    for (embed_array, kwargs) in ((embeds, {}), (emb_wrapper.asArray(), { 'normed': True, 'norms': emb_wrapper.norms() })):
+        expected = _evalMethods(NumpyAnalogyModel(embed_array, **kwargs), analogies, analogy_embs)
+        # quantized candidates scored in several tiles, and all re-ranked
+        for precision in (Precision.Int8, Precision.Float16):
+            model = QuantizedAnalogyModel(embed_array, precision=precision, rerank_depth=len(embeds),
+                tile_bytes=64 * 4 * embeds.shape[1], gather_bytes=1<<16, **kwargs)
+            assert model._tile_size == 64
+            results = _evalMethods(model, analogies, analogy_embs)
+            for mode in _modes:
+                _assertSameResults(results[mode][0], expected[mode][0])
+                assert model.scoringStats()[('quantized_ranks_differ', mode)] == 0
+
+def test_shallow_rerank_is_close_to_exact():
+    embeds = _embeddings(vocab_size=500)
+    analogies = _analogies(len(embeds), num_queries=60)
+    analogy_embs = embeds[analogies[:, :3]]
+    expected = _evalMethods(NumpyAnalogyModel(embeds), analogies, analogy_embs)
+
+    model = QuantizedAnalogyModel(embeds, rerank_depth=20, tile_bytes=100 * 4 * embeds.shape[1], check_sample=60)
+    results = _evalMethods(model, analogies, analogy_embs)
+    stats = model.scoringStats()
+    for mode in _modes:
+        assert abs(results[mode][0][0] - expected[mode][0][0]) <= 2
+        assert stats[('quantized_checked', mode)] == np.count_nonzero((analogies[:, 3:] >= 0).any(axis=1))
+        assert stats[('quantized_correct_differs', mode)] <= 2
+
+def test_candidates_are_not_copied():
+    embeds = _embeddings(vocab_size=100)
+    assert QuantizedAnalogyModel(embeds)._embeds is embeds
+    normed = embeds / np.linalg.norm(embeds, axis=1, keepdims=True)
+    assert QuantizedAnalogyModel(normed, normed=True)._embeds is normed
@@ -0,0 +1,34 @@
+from BMASS import settings
+from analogy_task.analogy_model import Mode
+from analogy_task.experiments_for_paper import saveResults
+from lib.results_store import ResultsStore, readResults
+
+def test_empty_relations_are_marked(tmp_path):
+    path = str(tmp_path / 'results.db')
+    with ResultsStore(path) as store:
+        saveResults(store, 'emb', settings.MULTI_ANSWER, Mode.ThreeCosAdd, {
+            'rel 0': (3, 0.5, 0.75, 4, 1, None),
+            'rel 1': (0, 0, 0, 0, 0, None),
+        })
+    results = readResults(path)
+    assert list(results['relation']) == ['rel 0', 'rel 1']
+    assert list(results['accuracy']) == [0.75, -1]
+    assert list(results['correct']) == [3, -1]
+    assert list(results['answered']) == [3, -1]
+    assert list(results['total']) == [4, 0]
+
+def test_merge_keeps_order_and_replaces(tmp_path):
+    row = lambda embeddings, relation, correct: { 'embeddings': embeddings, 'setting': 'Multi-Answer', 'method': '3CosAdd',
+        'relation': relation, 'accuracy': 1, 'map': 1, 'mrr': 1, 'correct': correct, 'answered': 1, 'total': 1 }
+    (main, other) = (str(tmp_path / 'results.db'), str(tmp_path / 'results.emb.db'))
+    with ResultsStore(main) as store:
+        store.append([row('old', 'rel 0', 1), row('emb', 'rel 1', 1)])
+    with ResultsStore(other) as store:
+        store.append([row('emb', 'rel 1', 2), row('emb', 'rel 0', 3)])
+    with ResultsStore(main) as store:
+        store.merge(other)
+        store.merge(other)
+    results = readResults(main)
+    assert list(results['embeddings']) == ['old', 'emb', 'emb']
+    assert list(results['relation']) == ['rel 0', 'rel 1', 'rel 0']
+    assert list(results['correct']) == [1, 2, 3]
@@ -0,0 +1,76 @@
+import multiprocessing
+import numpy as np
+import pytest
+from BMASS import settings
+from analogy_task import task
+from analogy_task.analogy_model import Mode
+from analogy_task.embedding_wrapper import EmbeddingWrapper
+
+def _wrapper(vocab_size=200, dim=16, seed=0):
+    embeds = np.random.RandomState(seed).randn(vocab_size, dim).astype(np.float32)
+    return EmbeddingWrapper((['w%d' % i for i in range(vocab_size)], embeds))
+
+def _analogies(setting, relations=('rel1', 'rel2'), num_analogies=30, vocab_size=200, seed=1):
+    '''{ relation : analogies } as read by BMASS.parser.read with
+    strings_only=True, with some terms out of the vocabulary
+    '''
+    random_state = np.random.RandomState(seed)
+    term = lambda: 'w%d' % random_state.randint(0, vocab_size + 10)
+    analogies = {}
+    for relation in relations:
+        analogies[relation] = []
+        for _ in range(num_analogies):
+            (a, b, c) = (term(), term(), term())
+            if setting == settings.ALL_INFO: b = [b, term()]
+            d = term() if setting == settings.SINGLE_ANSWER else [term() for _ in range(random_state.randint(1, 4))]
+            analogies[relation].append((a, b, c, d))
+    return analogies
+
+def _assertSameResults(results, expected):
+    assert results.keys() == expected.keys()
+    for (relation, (correct, MAP, MRR, total, skipped, predictions)) in results.items():
+        (exp_correct, exp_MAP, exp_MRR, exp_total, exp_skipped, exp_predictions) = expected[relation]
+        assert (correct, MAP, MRR, total, skipped) == (exp_correct, exp_MAP, exp_MRR, exp_total, exp_skipped)
+        assert predictions.analogies == exp_predictions.analogies
+        for field in ('ixes', 'correct', 'candidates', 'top_k', 'scores'):
+            assert np.array_equal(getattr(predictions, field), getattr(exp_predictions, field), equal_nan=True)
+
+@pytest.mark.skipif(not 'fork' in multiprocessing.get_all_start_methods(), reason='needs fork()')
+def test_parallel_relations_match_serial(tmp_path):
+    emb_wrapper = _wrapper()
+    analogies = { settings.MULTI_ANSWER: _analogies(settings.MULTI_ANSWER, relations=('rel1', 'rel2', 'rel3')) }
+    modes = [Mode.ThreeCosAdd, Mode.ThreeCosMul]
+    all_results = {}
+    for workers in (1, 2):
+        predictions_files = { (mode, settings.MULTI_ANSWER): str(tmp_path / ('%d.%d.txt' % (mode, workers))) for mode in modes }
+        all_results[workers] = task.analogyMethodsTask({ settings.MULTI_ANSWER: None }, emb_wrapper, modes,
+            analogies=analogies, workers=workers, predictions_files=predictions_files)
+
+    for mode in modes:
+        _assertSameResults(all_results[2][mode][settings.MULTI_ANSWER], all_results[1][mode][settings.MULTI_ANSWER])
+        serial = (tmp_path / ('%d.1.txt' % mode)).read_bytes()
+        assert len(serial) > 0 and (tmp_path / ('%d.2.txt' % mode)).read_bytes() == serial
+
+def test_shared_settings_match_separate_runs():
+    emb_wrapper = _wrapper()
+    single = _analogies(settings.SINGLE_ANSWER)
+    analogies = {
+        settings.SINGLE_ANSWER: single,
+        # the same a:b::c queries, with more answers, are scored once for both
+        settings.MULTI_ANSWER: { relation: [(a, b, c, [d, 'w%d' % i]) for (i, (a, b, c, d)) in enumerate(rel_analogies)]
+            for (relation, rel_analogies) in single.items() },
+        settings.ALL_INFO: _analogies(settings.ALL_INFO, relations=('rel2', 'rel3'), seed=2),
+    }
+    modes = [Mode.ThreeCosAdd, Mode.PairwiseDistance, Mode.ThreeCosMul]
+    shared = task.analogyMethodsTask({ setting: None for setting in analogies }, emb_wrapper, modes, analogies=analogies)
+    for mode in modes:
+        for (setting, set_analogies) in analogies.items():
+            alone = task.analogyTask(None, setting, emb_wrapper, mode=mode, analogies=set_analogies)
+            _assertSameResults(shared[mode][setting], alone)
+
+    # and each query the settings share was scored once
+    grph = task.buildModel(emb_wrapper.asArray(), normed=True, norms=emb_wrapper.norms())
+    task.completeAnalogyMethods({ setting: analogies[setting]['rel1'] for setting in (settings.SINGLE_ANSWER, settings.MULTI_ANSWER) },
+        emb_wrapper, grph, modes)
+    queries = { (a, b, c) for (a, b, c, d) in single['rel1'] if all(emb_wrapper.index(term) > -1 for term in (a, b, c)) }
+    assert grph.scoringStats()['queries_scored'] == len(queries)